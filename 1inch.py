@@ -6,18 +6,12 @@ import requests
 from typing import List, Dict
 from dotenv import load_dotenv
 
+from inch_client import CHAIN_ID, build_limit_orderbook
+
 load_dotenv(override=True)
 
 INCH_API = os.getenv('1INCH_API')
 
-CHAIN_ID = {
-    'ethereum': 1,
-    'bsc': 56,
-    'polygon': 137,
-    'optimism': 10,
-    'arbitrum': 42161,
-}
-
 def _headers():
     return {'accept': 'accept: application/json', 'Authorization': f'Bearer {INCH_API}'}
 
@@ -69,64 +63,19 @@ def get_1inch_limit_orderbook(symbol: str,
                               depth: int = 20):
     """
     Creates an orderbook of bids/asks using the 1inch limit orderbook API
+
+    Blocking, one HTTP call per side; inch_client.InchClient.get_limit_orderbook
+    is the async, cached and rate limited version
     """
     symbols = symbol.split('/')
     token0 = tokens[symbols[0]]
     token1 = tokens[symbols[1]]
     
-    _tokens = {v.lower(): k for k, v in tokens.items()}
-    _decimals = {tokens[k].lower(): v for k, v in decimals.items()}
-    
     bids_orderbook = get_orderbook(buy_token=token1, sell_token=token0, depth=depth)
     time.sleep(1)  # rate limit (429 error)
     asks_orderbook = get_orderbook(buy_token=token0, sell_token=token1, depth=depth)
     
-    bids = []
-    asks = []
-    
-    for o in bids_orderbook:
-        depth = {
-            'hash': o['orderHash'],
-            'created': o['createDateTime'],
-            'selling_token': _tokens[o['data']['makerAsset'].lower()],
-            'buying_token': _tokens[o['data']['takerAsset'].lower()],
-            'selling_decimals': _decimals[o['data']['makerAsset'].lower()],
-            'buying_decimals': _decimals[o['data']['takerAsset'].lower()],
-            'selling_amount': int(o['data']['makingAmount']),
-            'buying_amount': int(o['data']['takingAmount']),
-            'maker_rate': float(o['makerRate']),
-            'taker_rate': float(o['takerRate']),
-            'remaining': int(o['remainingMakerAmount']),
-        }
-        selling_amount = float(depth['selling_amount']) / 10 ** depth['selling_decimals']
-        buying_amount = float(depth['buying_amount']) / 10 ** depth['buying_decimals']
-        price_1 = selling_amount / buying_amount
-        price_2 = buying_amount / selling_amount
-        quantity = depth['remaining'] / 10 ** depth['selling_decimals']
-        bids.append({'price': price_1, 'quantity': quantity, 'created': depth['created']})
-        
-    for o in asks_orderbook:
-        depth = {
-            'hash': o['orderHash'],
-            'created': o['createDateTime'],
-            'selling_token': _tokens[o['data']['makerAsset'].lower()],
-            'buying_token': _tokens[o['data']['takerAsset'].lower()],
-            'selling_decimals': _decimals[o['data']['makerAsset'].lower()],
-            'buying_decimals': _decimals[o['data']['takerAsset'].lower()],
-            'selling_amount': int(o['data']['makingAmount']),
-            'buying_amount': int(o['data']['takingAmount']),
-            'maker_rate': float(o['makerRate']),
-            'taker_rate': float(o['takerRate']),
-            'remaining': int(o['remainingMakerAmount']),
-        }
-        selling_amount = float(depth['selling_amount']) / 10 ** depth['selling_decimals']
-        buying_amount = float(depth['buying_amount']) / 10 ** depth['buying_decimals']
-        price_1 = selling_amount / buying_amount
-        price_2 = buying_amount / selling_amount
-        quantity = depth['remaining'] / 10 ** depth['selling_decimals']
-        asks.append({'price': price_2, 'quantity': quantity, 'created': depth['created']})
-        
-    return {'bids': bids, 'asks': asks}
+    return build_limit_orderbook(bids_orderbook, asks_orderbook, tokens, decimals)
     
     
     
@@ -1,15 +1,22 @@
 import os
 import json
-import eth_abi
+import time
 import asyncio
-import eth_utils
 import websockets
 import aioprocessing
 
-from web3 import Web3
 from typing import List
 from functools import partial
 
+from abi_decoder import decode_address, decode_bytes32_uint256
+from events import OrderEvent
+from profiling import stage
+
+
+# keccak('OrderCanceled(address,bytes32,uint256)'), keccak('OrderFilled(address,bytes32,uint256)')
+ORDER_CANCELED_TOPIC = '0xcbfa7d191838ece7ba4783ca3a30afd316619b7f368094b57ee7ffde9a923db1'
+ORDER_FILLED_TOPIC = '0xb9ed0243fdf00f0545c63a0af8850c090d86bb46682baec4bf3c496814fe4f02'
+
 
 async def stream_1inch_limit_orderbook_events(http_rpc_url: str,
                                               ws_rpc_url: str,
@@ -17,10 +24,8 @@ async def stream_1inch_limit_orderbook_events(http_rpc_url: str,
                                               event_queue: aioprocessing.AioQueue,
                                               debug: bool = False):
     
-    w3 = Web3(Web3.HTTPProvider(http_rpc_url))
-    
-    order_canceled_event_selector = w3.keccak(text='OrderCanceled(address,bytes32,uint256)').hex()
-    order_filled_event_selector = w3.keccak(text='OrderFilled(address,bytes32,uint256)').hex()
+    order_canceled_event_selector = ORDER_CANCELED_TOPIC
+    order_filled_event_selector = ORDER_FILLED_TOPIC
     
     async with websockets.connect(ws_rpc_url) as ws:
         if debug:
@@ -39,9 +44,12 @@ async def stream_1inch_limit_orderbook_events(http_rpc_url: str,
         ack = await ws.recv()
         if debug:
             print(f"Subscribed 1inch logs ack: {ack}")
+
+        decode_stage = stage('1inch.decode')
         
         while True:
             msg = await asyncio.wait_for(ws.recv(), timeout=60 * 10)
+            start = time.perf_counter_ns()
             event = json.loads(msg)['params']['result']
             address = event['address'].lower()
             
@@ -49,17 +57,17 @@ async def stream_1inch_limit_orderbook_events(http_rpc_url: str,
                 block_number = int(event['blockNumber'], base=16)
                 topic = event['topics'][0]
                 event_type = 'order_cancel' if topic == order_canceled_event_selector else 'order_filled'
-                maker = eth_abi.decode(['address'], eth_utils.decode_hex(event['topics'][1]))[0]
-                data = eth_abi.decode(['bytes32', 'uint256'], eth_utils.decode_hex(event['data']))
-                order_update = {
-                    'source': 'dex',
-                    'type': event_type,
-                    'block_number': block_number,
-                    'exchange': address,
-                    'maker': maker,
-                    'order_hash': data[0].hex(),
-                    'remaining': data[1],
-                }
+                maker = decode_address(event['topics'][1])
+                data = decode_bytes32_uint256(event['data'])
+                order_update = OrderEvent(
+                    event_type,
+                    block_number,
+                    address,
+                    maker,
+                    data[0].hex(),
+                    data[1],
+                )
+                decode_stage.since(start)
                 
                 if not debug:
                     event_queue.put(order_update)
@@ -1,7 +1,22 @@
-import aioprocessing
+import time
+from bisect import bisect_left, bisect_right
 from decimal import Decimal
 from operator import itemgetter
-from typing import Any, Dict, List
+from typing import Any, Dict, List, Optional, Sequence, Tuple, TYPE_CHECKING
+
+from events import event_type
+from profiling import stage
+
+if TYPE_CHECKING:
+    # optional handler components, only needed by callers that pass them in
+    # (keeps importing the aggregator free of numpy / eth_abi / websockets)
+    import aioprocessing
+    from instruments import InstrumentIndex
+    from journal import OpportunityJournal
+    from mempool_streams import PendingSwapPredictor
+    from monitor import FeedMonitor
+    from pool_graph import PoolGraph
+    from tick_store import TickRecorder
 
 
 def aggregate_cex_orderbooks(orderbooks: Dict[str, Dict[str, Any]]) -> Dict[str, List[List[Decimal]]]:
@@ -22,55 +37,379 @@ def aggregate_cex_orderbooks(orderbooks: Dict[str, Dict[str, Any]]) -> Dict[str,
     asks = sorted(asks, key=itemgetter(0))
     
     return {'bids': bids, 'asks': asks}
-    
 
-async def event_handler(event_queue: aioprocessing.AioQueue):
+
+class LadderSide:
+    """
+    One side of a DepthLadder: merged levels sorted best first, with cumulative
+    quantity and notional. Bids are keyed by -price so both sides sort ascending
+    """
+
+    __slots__ = ('sign', 'levels', 'prices', 'cum_qty', 'cum_notional', '_arrays')
+
+    def __init__(self, is_bid: bool):
+        self.sign = -1.0 if is_bid else 1.0
+        self.levels: List[Tuple[float, float, float, str]] = []  # (key, price, qty, venue)
+        self.prices: List[float] = []
+        self.cum_qty: List[float] = []
+        self.cum_notional: List[float] = []
+        self._arrays = None
+
+    def replace(self, venue: str, levels: Sequence[Sequence[Any]]):
+        """
+        Swaps `venue`'s levels for new ones and recomputes the prefix sums
+        from the first position that changed
+        """
+        sign = self.sign
+        new = [(sign * price, price, qty, venue)
+               for price, qty in ((float(level[0]), float(level[1])) for level in levels) if qty > 0]
+        merged = [level for level in self.levels if level[3] != venue]
+        merged.extend(new)
+        merged.sort()
+
+        old = self.levels
+        first, n = 0, min(len(old), len(merged))
+        while first < n and old[first] == merged[first]:
+            first += 1
+        self.levels = merged
+        self._rebuild(first)
+
+    def _rebuild(self, first: int):
+        del self.prices[first:], self.cum_qty[first:], self.cum_notional[first:]
+        qty = self.cum_qty[first - 1] if first else 0.0
+        notional = self.cum_notional[first - 1] if first else 0.0
+        for _, price, level_qty, _ in self.levels[first:]:
+            qty += level_qty
+            notional += price * level_qty
+            self.prices.append(price)
+            self.cum_qty.append(qty)
+            self.cum_notional.append(notional)
+        self._arrays = None
+
+    @property
+    def best(self) -> Optional[float]:
+        return self.prices[0] if self.prices else None
+
+    @property
+    def depth(self) -> float:
+        return self.cum_qty[-1] if self.cum_qty else 0.0
+
+    def notional(self, size: float) -> Optional[float]:
+        """
+        Cost (asks) or proceeds (bids) of filling `size`, None if the book is too thin
+        """
+        i = bisect_left(self.cum_qty, size)
+        if i == len(self.cum_qty):
+            return None
+        if i == 0:
+            return size * self.prices[0]
+        return self.cum_notional[i - 1] + (size - self.cum_qty[i - 1]) * self.prices[i]
+
+    def vwap(self, size: float) -> Optional[float]:
+        notional = self.notional(size)
+        return None if notional is None or size <= 0 else notional / size
+
+    def max_size(self, limit_price: float) -> float:
+        """
+        Quantity available at prices no worse than `limit_price`
+        """
+        i = bisect_right(self.levels, (self.sign * limit_price, float('inf')))
+        return self.cum_qty[i - 1] if i else 0.0
+
+    def price_impact(self, size: float) -> Optional[float]:
+        """
+        Relative VWAP slippage from the best price, positive = worse
+        """
+        vwap = self.vwap(size)
+        if vwap is None:
+            return None
+        return self.sign * (vwap - self.prices[0]) / self.prices[0]
+
+    def arrays(self):
+        import numpy as np
+
+        if self._arrays is None:
+            self._arrays = (np.asarray(self.prices), np.asarray(self.cum_qty), np.asarray(self.cum_notional))
+        return self._arrays
+
+    def vwap_many(self, sizes):
+        """
+        Vectorized vwap: one searchsorted over all sizes, NaN where the book is too thin
+        """
+        import numpy as np
+
+        sizes = np.asarray(sizes, dtype=np.float64)
+        out = np.full(sizes.shape, np.nan)
+        if not self.prices:
+            return out
+        prices, cum_qty, cum_notional = self.arrays()
+        i = np.searchsorted(cum_qty, sizes, side='left')
+        filled = (i < len(cum_qty)) & (sizes > 0)
+        i = i[filled]
+        prev = i - 1
+        qty_before = np.where(prev >= 0, cum_qty[prev], 0.0)
+        notional_before = np.where(prev >= 0, cum_notional[prev], 0.0)
+        out[filled] = (notional_before + (sizes[filled] - qty_before) * prices[i]) / sizes[filled]
+        return out
+
+
+class DepthLadder:
+    """
+    Merged depth of one symbol across venues, answering size queries by binary
+    search over cumulative quantity / notional instead of walking levels
+
+    ladder = DepthLadder()
+    ladder.update(binance_event)          # {'exchange', 'bids', 'asks', ...}
+    ladder.update(okx_event)
+    ladder.vwap('buy', 25)                # average price lifting 25 from the asks
+    ladder.max_size('sell', 1995.0)       # bid quantity at 1995 or better
+    ladder.price_impact('buy', 25)
+    ladder.vwap_many('sell', [1, 5, 25])  # numpy array
+    """
+
+    __slots__ = ('bids', 'asks', 'venues')
+
+    def __init__(self):
+        self.bids = LadderSide(is_bid=True)
+        self.asks = LadderSide(is_bid=False)
+        self.venues = set()
+
+    def update(self, orderbook: Dict[str, Any]):
+        venue = orderbook['exchange']
+        self.bids.replace(venue, orderbook['bids'])
+        self.asks.replace(venue, orderbook['asks'])
+        self.venues.add(venue)
+
+    def remove(self, venue: str):
+        self.bids.replace(venue, [])
+        self.asks.replace(venue, [])
+        self.venues.discard(venue)
+
+    def side(self, direction: str) -> LadderSide:
+        """
+        'buy' takes liquidity from the asks, 'sell' from the bids
+        """
+        return self.asks if direction == 'buy' else self.bids
+
+    def vwap(self, direction: str, size: float) -> Optional[float]:
+        return self.side(direction).vwap(size)
+
+    def max_size(self, direction: str, limit_price: float) -> float:
+        return self.side(direction).max_size(limit_price)
+
+    def price_impact(self, direction: str, size: float) -> Optional[float]:
+        return self.side(direction).price_impact(size)
+
+    def vwap_many(self, direction: str, sizes):
+        return self.side(direction).vwap_many(sizes)
+
+
+async def event_handler(event_queue: 'aioprocessing.AioQueue',
+                        recorder: Optional['TickRecorder'] = None,
+                        pool_graph: Optional['PoolGraph'] = None,
+                        instruments: Optional['InstrumentIndex'] = None,
+                        predictor: Optional['PendingSwapPredictor'] = None,
+                        stale_after: Optional[float] = None,
+                        monitor: Optional['FeedMonitor'] = None,
+                        depth_sizes: Optional[List[float]] = None,
+                        chain_id: int = 1,
+                        journal: Optional['OpportunityJournal'] = None):
+    """
+    :param recorder: optional TickRecorder, every CEX orderbook event is
+                     appended to its (exchange, symbol) tick store
+    :param pool_graph: optional PoolGraph, every pool_update re-evaluates
+                       the multi-hop DEX cycles through that pool
+    :param instruments: optional InstrumentIndex, CEX-CEX and CEX-DEX spreads
+                        are recomputed only for instruments whose price changed
+    :param predictor: optional PendingSwapPredictor shared with stream_pending_swaps,
+                      kept in sync with the mined pool states seen here
+    :param stale_after: drop a venue's book from the MultiOrderbook when it has not
+                        updated for this many seconds, until it updates again
+    :param monitor: optional FeedMonitor, stale drops are counted there
+    :param depth_sizes: base quantities to print buy / sell VWAPs for, read off
+                        each symbol's DepthLadder (kept in sync with the MultiOrderbook)
+    :param chain_id: chain of the pools behind pool_graph and predictor; pool
+                     updates of other chains (chains.ChainScheduler) are logged
+                     but not fed to them
+    :param journal: optional journal.OpportunityJournal; spreads of at least
+                    journal.min_spread and profitable DEX cycles are recorded
+                    with the books, pool states, fees and block they were
+                    computed from and how old each input was
+    """
     orderbooks = {}
-    last_pool_updates: Dict[str, Dict[str, Any]] = {}
-    
+    ladders: Dict[str, DepthLadder] = {}
+    received: Dict[str, Dict[str, float]] = {}
+    last_pool_updates: Dict[Tuple[int, str], Dict[str, Any]] = {}
+    # journal context: latest block per chain, latest state per pool address
+    last_blocks: Dict[int, Dict[str, Any]] = {}
+    pool_states: Dict[str, Dict[str, Any]] = {}
+    instrument_addresses = {instrument.key: address for address, instrument in instruments.by_address.items()} \
+        if instruments is not None else {}
+    # always-on timers, see profiling.stats()
+    aggregate_stage = stage('aggregate_cex_orderbooks')
+    pool_update_stage = stage('pool_update')
+    spreads_stage = stage('spreads')
+
+    def on_orderbook(data):
+        symbol = data['symbol']
+        exchange = data['exchange']
+        if symbol not in orderbooks:
+            orderbooks[symbol] = {}
+            received[symbol] = {}
+            ladders[symbol] = DepthLadder()
+
+        orderbooks[symbol][exchange] = data
+        ladders[symbol].update(data)
+        now = time.monotonic()
+        received[symbol][exchange] = now
+        if stale_after is not None:
+            for venue, last in list(received[symbol].items()):
+                if now - last > stale_after:
+                    del orderbooks[symbol][venue]
+                    del received[symbol][venue]
+                    ladders[symbol].remove(venue)
+                    if monitor is not None:
+                        monitor.on_stale_drop(venue)
+                    print({'type': 'stale_orderbook', 'exchange': venue, 'symbol': symbol})
+        if recorder is not None:
+            recorder.record(data)
+        start = time.perf_counter_ns()
+        multi_orderbook = aggregate_cex_orderbooks(orderbooks[symbol])
+        aggregate_stage.since(start)
+        print(multi_orderbook)
+        if depth_sizes:
+            ladder = ladders[symbol]
+            print({
+                'type': 'depth',
+                'symbol': symbol,
+                'sizes': depth_sizes,
+                'buy_vwap': [ladder.vwap('buy', size) for size in depth_sizes],
+                'sell_vwap': [ladder.vwap('sell', size) for size in depth_sizes],
+            })
+
+    def on_block(data):
+        last_blocks[data.get('chain_id', 1)] = data
+        # Light block log
+        print({
+            'type': 'block',
+            'chain_id': data.get('chain_id', 1),
+            'block_number': data.get('block_number'),
+            'base_fee': data.get('base_fee'),
+            'next_base_fee': data.get('next_base_fee'),
+        })
+
+    def on_pool_update(data):
+        # Track last pool update per chain and symbol and print
+        sym = data.get('symbol')
+        event_chain_id = data.get('chain_id', 1)
+        last_pool_updates[(event_chain_id, sym)] = data
+        if journal is not None:
+            pool_states[data.get('address', '').lower()] = data
+        print({'type': 'pool_update', 'chain_id': event_chain_id, 'symbol': sym,
+               'tick': data.get('tick'), 'liquidity': data.get('liquidity')})
+        if event_chain_id != chain_id:
+            return
+        start = time.perf_counter_ns()
+        if predictor is not None:
+            predictor.on_pool_update(data)
+        cycles = pool_graph.update_from_event(data) if pool_graph is not None else []
+        pool_update_stage.since(start)
+        for cycle in cycles:
+            print({'type': 'dex_cycle', 'cycle': cycle})
+            if journal is not None:
+                journal_cycle(cycle, event_chain_id)
+
+    def journal_inputs(keys: Sequence[str]) -> Dict[str, Any]:
+        """
+        Books (top journal.depth levels, exchange timestamp, ms since received)
+        or pool states and fees of the instruments behind a spread
+        """
+        now = time.monotonic()
+        books, pools, fees = {}, {}, {}
+        for key in keys:
+            instrument = instruments.instruments[key]
+            fees[key] = instrument.fee
+            if instrument.source == 'cex':
+                book = orderbooks.get(instrument.symbol, {}).get(instrument.venue)
+                if book is not None:
+                    books[key] = {'bids': book['bids'][:journal.depth], 'asks': book['asks'][:journal.depth],
+                                  'timestamp': book.get('timestamp'),
+                                  'age_ms': (now - received[instrument.symbol][instrument.venue]) * 1000}
+            else:
+                pools[key] = pool_states.get(instrument_addresses.get(key))
+        return {'books': books, 'pools': pools, 'fees': fees}
+
+    def journal_spread(spread: Dict[str, Any], trigger: Dict[str, Any], start: int):
+        journal.record({
+            **spread,
+            'ts': time.time(),
+            **journal_inputs((spread['sell'], spread['buy'])),
+            'block': last_blocks.get(chain_id),
+            'trigger': {'type': trigger.get('type'), 'exchange': trigger.get('exchange'),
+                        'symbol': trigger.get('symbol'), 'timestamp': trigger.get('timestamp')},
+            'detect_us': (time.perf_counter_ns() - start) / 1000,
+        })
+
+    def journal_cycle(cycle, event_chain_id: int):
+        addresses = [edge.pool.address for edge in cycle.edges]
+        journal.record({
+            'type': 'dex_cycle',
+            'ts': time.time(),
+            'chain_id': event_chain_id,
+            'path': cycle.path,
+            'profit': cycle.profit,
+            'pools': {address: pool_states.get(address) for address in addresses},
+            'fees': {edge.pool.address: edge.pool.fee for edge in cycle.edges},
+            'block': last_blocks.get(event_chain_id),
+        })
+
+    def on_predicted_pool_update(data):
+        print({'type': 'predicted_pool_update', 'symbol': data.get('symbol'), 'tx_hash': data.get('tx_hash'),
+               'tick': data.get('tick'), 'pending_count': data.get('pending_count')})
+
+    def on_other(data):
+        if data.get('source') not in ('cex', 'dex'):
+            # Unknown event source; keep handler alive and log
+            print({'type': 'unknown_event', 'event': data})
+
+    # dispatch on the event type (typed events from events.py or the equivalent dicts)
+    handlers = {
+        'orderbook': on_orderbook,
+        'block': on_block,
+        'pool_update': on_pool_update,
+        'predicted_pool_update': on_predicted_pool_update,
+    }
+    # whole handling of each event type, printing included
+    handler_stages = {kind: stage(f'handler.{kind}') for kind in handlers}
+    other_stage = stage('handler.other')
+
     while True:
         data = await event_queue.coro_get()
 
+        start = time.perf_counter_ns()
         try:
-            source = data.get('source')
-
-            if source == 'cex':
-                # Only access symbol for CEX events
-                symbol = data['symbol']
-                if symbol not in orderbooks:
-                    orderbooks[symbol] = {}
-
-                orderbooks[symbol][data['exchange']] = data
-                multi_orderbook = aggregate_cex_orderbooks(orderbooks[symbol])
-                print(multi_orderbook)
-
-            elif source == 'dex':
-                etype = data.get('type')
-                if etype == 'block':
-                    # Light block log
-                    print({
-                        'type': 'block',
-                        'block_number': data.get('block_number'),
-                        'base_fee': data.get('base_fee'),
-                        'next_base_fee': data.get('next_base_fee'),
-                    })
-                elif etype == 'pool_update':
-                    # Track last pool update per symbol and print
-                    sym = data.get('symbol')
-                    last_pool_updates[sym] = data
-                    print({'type': 'pool_update', 'symbol': sym, 'tick': data.get('tick'), 'liquidity': data.get('liquidity')})
+            kind = event_type(data)
+            handlers.get(kind, on_other)(data)
 
-            else:
-                # Unknown event source; keep handler alive and log
-                print({'type': 'unknown_event', 'event': data})
+            if instruments is not None:
+                spreads_start = time.perf_counter_ns()
+                spreads = instruments.recompute() if instruments.update(data) else []
+                spreads_stage.since(spreads_start)
+                for spread in spreads:
+                    print(spread)
+                    if journal is not None and spread['spread'] >= journal.min_spread:
+                        journal_spread(spread, data, start)
 
         except Exception as e:
             # Prevent handler from dying on malformed events
             print({'type': 'event_handler_error', 'error': str(e)})
+            kind = None
+        handler_stages.get(kind, other_stage).since(start)
     
     
 if __name__ == '__main__':
     import asyncio
+    import aioprocessing
     import nest_asyncio
     from functools import partial
     import os
@@ -80,37 +419,44 @@ if __name__ == '__main__':
     from cex_streams import stream_binance_usdm_orderbook, stream_okx_usdm_orderbook
     from dex_streams import stream_new_blocks, stream_uniswap_v3_events
     from constants import TOKENS, POOLS
+    from monitor import FeedMonitor
     
     nest_asyncio.apply()
     load_dotenv(override=True)
     
     symbols = ['ETH/USDT']
     event_queue = aioprocessing.AioQueue()
+    # feed health metrics on http://127.0.0.1:9100/metrics
+    monitor = FeedMonitor(event_queue, stale_after=5)
     
     # Testing CEX aggregator
     binance_stream = reconnecting_websocket_loop(
-        partial(stream_binance_usdm_orderbook, symbols, event_queue, False),
-        tag='binance_stream'
+        partial(stream_binance_usdm_orderbook, symbols, monitor.queue('binance'), False),
+        tag='binance_stream',
+        on_reconnect=monitor.reconnect_hook('binance'),
     )
     
     okx_stream = reconnecting_websocket_loop(
-        partial(stream_okx_usdm_orderbook, symbols, event_queue, False),
-        tag='okx_stream'
+        partial(stream_okx_usdm_orderbook, symbols, monitor.queue('okx'), False),
+        tag='okx_stream',
+        on_reconnect=monitor.reconnect_hook('okx'),
     )
     
     # DEX streams (Ethereum mainnet)
     HTTP_RPC_URL = os.getenv('HTTP_RPC_URL')
     WS_RPC_URL = os.getenv('WS_RPC_URL')
     new_blocks_stream = reconnecting_websocket_loop(
-        partial(stream_new_blocks, WS_RPC_URL, event_queue, False),
-        tag='new_blocks_stream'
+        partial(stream_new_blocks, WS_RPC_URL, monitor.queue('new_blocks'), False),
+        tag='new_blocks_stream',
+        on_reconnect=monitor.reconnect_hook('new_blocks'),
     )
     uniswap_v3_stream = reconnecting_websocket_loop(
-        partial(stream_uniswap_v3_events, HTTP_RPC_URL, WS_RPC_URL, TOKENS, POOLS, event_queue, False),
-        tag='uniswap_v3_stream'
+        partial(stream_uniswap_v3_events, HTTP_RPC_URL, WS_RPC_URL, TOKENS, POOLS, monitor.queue('uniswap_v3'), False),
+        tag='uniswap_v3_stream',
+        on_reconnect=monitor.reconnect_hook('uniswap_v3'),
     )
     
-    event_handler_loop = event_handler(event_queue)
+    event_handler_loop = event_handler(event_queue, stale_after=monitor.stale_after, monitor=monitor)
     
     loop = asyncio.get_event_loop()
     # Create tasks before waiting (Python 3.12+ forbids bare coroutines in wait)
@@ -119,6 +465,7 @@ if __name__ == '__main__':
     handler_task = loop.create_task(event_handler_loop)
     new_blocks_task = loop.create_task(new_blocks_stream)
     uniswap_v3_task = loop.create_task(uniswap_v3_stream)
+    metrics_task = loop.create_task(monitor.serve(port=9100))
 
     loop.run_until_complete(asyncio.wait([
         binance_task,
@@ -126,5 +473,6 @@ if __name__ == '__main__':
         handler_task,
         new_blocks_task,
         uniswap_v3_task,
+        metrics_task,
     ]))
     
@@ -0,0 +1,306 @@
+import numpy as np
+
+from itertools import permutations
+from typing import Any, Dict, List, Optional, Union
+
+from constants import TOKENS, FEE, GAS_USED
+
+Q96 = 2 ** 96
+ETH_SYMBOLS = ('ETH', 'WETH')
+
+
+def asof_indices(left: np.ndarray, right: np.ndarray) -> np.ndarray:
+    """
+    For every key in `left`, the index of the last row in `right` with key <= it
+    (-1 if there is none). Both arrays must be sorted ascending
+    """
+    return np.searchsorted(right, left, side='right') - 1
+
+
+def take_asof(values: np.ndarray, idx: np.ndarray) -> np.ndarray:
+    """
+    values[idx] with NaN wherever the as-of join found no row
+    """
+    out = values[np.maximum(idx, 0)].astype(np.float64)
+    out[idx < 0] = np.nan
+    return out
+
+
+def book_vwap(prices: np.ndarray, qtys: np.ndarray, size: float) -> np.ndarray:
+    """
+    Average fill price for `size` units, walking the (rows, depth) level arrays
+    of a recorded book. NaN where the recorded depth is not enough to fill
+    """
+    prices = np.nan_to_num(prices)
+    qtys = np.nan_to_num(qtys)
+    cum_qty = np.cumsum(qtys, axis=1)
+    prev_qty = cum_qty - qtys
+    filled = np.clip(size - prev_qty, 0, qtys)
+    notional = (filled * prices).sum(axis=1)
+    vwap = notional / size
+    vwap[cum_qty[:, -1] < size] = np.nan
+    return vwap
+
+
+def v2_amount_out(amount_in: np.ndarray,
+                  reserve_in: np.ndarray,
+                  reserve_out: np.ndarray,
+                  fee: float) -> np.ndarray:
+    """
+    UniswapV2Simulator.get_amount_out over arrays, fee given in the same
+    format (3000 = 0.3%)
+    """
+    amount_in_with_fee = amount_in * (1_000_000 - fee)
+    return amount_in_with_fee * reserve_out / (reserve_in * 1_000_000 + amount_in_with_fee)
+
+
+def v2_amount_in(amount_out: np.ndarray,
+                 reserve_in: np.ndarray,
+                 reserve_out: np.ndarray,
+                 fee: float) -> np.ndarray:
+    """
+    UniswapV2Simulator.get_amount_in over arrays, NaN if the pool can't pay out
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        amount_in = reserve_in * amount_out * 1_000_000 / ((reserve_out - amount_out) * (1_000_000 - fee))
+    amount_in[amount_out >= reserve_out] = np.nan
+    return amount_in
+
+
+def v3_virtual_reserves(sqrt_price_x96: np.ndarray, liquidity: np.ndarray):
+    """
+    Virtual reserves of the active tick: x = L / sqrtP, y = L * sqrtP
+    Swaps that stay inside the tick follow the constant product of these
+    """
+    sqrt_price = sqrt_price_x96 / Q96
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return liquidity / sqrt_price, liquidity * sqrt_price
+
+
+class SpreadBacktester:
+    """
+    Batch version of the notebook's cex_event_handler / cex_dex_event_handler
+
+    Inputs are recorded arrays instead of queue events:
+
+    - books: {exchange: structured array} as returned by TickStore.records()/range()
+    - pool states: {'timestamp', 'block_number', and either 'reserve0'/'reserve1' (V2)
+                   or 'sqrtPriceX96'/'liquidity' (V3)} as arrays, in raw token units
+    - blocks: {'block_number', 'timestamp', 'next_base_fee'} with next_base_fee in ETH
+              (the units stream_new_blocks publishes)
+    - eth_price: {'timestamp', 'price'} arrays of ETH in the quote token, to
+                 convert gas when neither side of the pair is ETH
+
+    All timestamps are milliseconds.
+    """
+
+    def __init__(self,
+                 fees: Dict[str, float] = FEE,
+                 gas_used: Dict[int, int] = GAS_USED,
+                 tokens: Dict[str, List[Any]] = TOKENS):
+        self.fees = fees
+        self.gas_used = gas_used
+        self.tokens = tokens
+
+    def cex_cex(self, books: Dict[str, np.ndarray]) -> Dict[str, np.ndarray]:
+        """
+        Fee-adjusted top-of-book spread (%) for every ordered venue pair,
+        sell at `bid_exchange`'s bid and buy at `ask_exchange`'s ask,
+        same formula as cex_event_handler
+
+        Returns arrays on the union of all venues' timestamps
+        """
+        # each book is already sorted, so a stable (merge) sort is close to linear here
+        timestamps = np.sort(np.concatenate([b['timestamp'] for b in books.values()]), kind='stable')
+        timestamps = timestamps[np.concatenate([[True], timestamps[1:] != timestamps[:-1]])]
+        best_bid, best_ask = {}, {}
+        for exchange, book in books.items():
+            idx = asof_indices(timestamps, book['timestamp'])
+            best_bid[exchange] = take_asof(book['bid_price'][:, 0], idx)
+            best_ask[exchange] = take_asof(book['ask_price'][:, 0], idx)
+
+        result = {'timestamp': timestamps}
+        for bid_exchange, ask_exchange in permutations(books, 2):
+            spread = (best_bid[bid_exchange] / best_ask[ask_exchange] - 1) * 100
+            fee = (self.fees[bid_exchange] + self.fees[ask_exchange]) * 2 * 100  # buy, sell fee (x2)
+            result[f'{bid_exchange}/{ask_exchange}'] = spread - fee
+        return result
+
+    def dex_reserves(self,
+                     pool: Dict[str, Any],
+                     states: Dict[str, np.ndarray],
+                     base: str):
+        """
+        (reserve_base, reserve_quote) in raw units for the given pool states,
+        virtual reserves for V3 pools
+        """
+        if pool['version'] == 2:
+            reserve0 = states['reserve0'].astype(np.float64)
+            reserve1 = states['reserve1'].astype(np.float64)
+        else:
+            reserve0, reserve1 = v3_virtual_reserves(states['sqrtPriceX96'].astype(np.float64),
+                                                     states['liquidity'].astype(np.float64))
+        if pool['token0'] == base:
+            return reserve0, reserve1
+        return reserve1, reserve0
+
+    def cex_dex(self,
+                exchange: str,
+                book: np.ndarray,
+                pool: Dict[str, Any],
+                states: Dict[str, np.ndarray],
+                blocks: Dict[str, np.ndarray],
+                base: str,
+                size: float,
+                on: str = 'timestamp',
+                eth_price: Optional[Union[float, Dict[str, np.ndarray]]] = None) -> Dict[str, np.ndarray]:
+        """
+        Sized PnL (in quote units, net of CEX fee, pool fee and gas) of trading
+        `size` units of `base` between a CEX book and a DEX pool, evaluated on
+        every CEX snapshot
+
+        - cex_to_dex: buy on CEX at the ask VWAP, sell into the pool
+        - dex_to_cex: buy from the pool, sell on CEX at the bid VWAP
+
+        :param on: 'timestamp' joins pool states by time, 'block' first maps each
+                   CEX snapshot to the latest mined block and joins by block number
+        :param eth_price: price of ETH in the quote token that gas is converted with,
+                          a constant or a {'timestamp', 'price'} series joined as of
+                          each CEX snapshot; required unless base or quote is ETH
+        """
+        quote = pool['token1'] if pool['token0'] == base else pool['token0']
+        if eth_price is None and base not in ETH_SYMBOLS and quote not in ETH_SYMBOLS:
+            raise ValueError(f'Gas is paid in ETH: pass eth_price (ETH in {quote}) for a {base}/{quote} pool')
+        base_decimals = self.tokens[base][1]
+        quote_decimals = self.tokens[quote][1]
+
+        timestamps = book['timestamp']
+        block_idx = asof_indices(timestamps, blocks['timestamp'])
+        if on == 'timestamp':
+            idx = asof_indices(timestamps, states['timestamp'])
+        elif on == 'block':
+            block_numbers = np.where(block_idx >= 0, blocks['block_number'][np.maximum(block_idx, 0)], -1)
+            idx = asof_indices(block_numbers, states['block_number'])
+            idx[block_idx < 0] = -1
+        else:
+            raise ValueError(f'Unknown join key: {on}')
+
+        reserve_base, reserve_quote = self.dex_reserves(pool, states, base)
+        reserve_base = take_asof(reserve_base, idx)
+        reserve_quote = take_asof(reserve_quote, idx)
+
+        base_scale = 10 ** base_decimals
+        quote_scale = 10 ** quote_decimals
+        amount = np.full(len(timestamps), size * base_scale)
+
+        dex_price = reserve_quote / reserve_base * base_scale / quote_scale
+        sell_on_dex = v2_amount_out(amount, reserve_base, reserve_quote, pool['fee']) / quote_scale
+        buy_on_dex = v2_amount_in(amount, reserve_quote, reserve_base, pool['fee']) / quote_scale
+
+        cex_fee = self.fees[exchange]
+        ask_vwap = book_vwap(book['ask_price'], book['ask_qty'], size)
+        bid_vwap = book_vwap(book['bid_price'], book['bid_qty'], size)
+
+        # gas is paid in ETH: converted to quote with eth_price, or the CEX mid when ETH is the base
+        next_base_fee = take_asof(blocks['next_base_fee'], block_idx)
+        mid = (book['bid_price'][:, 0] + book['ask_price'][:, 0]) / 2
+        if eth_price is None:
+            eth_price = mid if base in ETH_SYMBOLS else 1.0
+        elif isinstance(eth_price, dict):
+            eth_price = take_asof(eth_price['price'], asof_indices(timestamps, eth_price['timestamp']))
+        gas_cost = next_base_fee * self.gas_used[pool['version']] * eth_price
+
+        cex_to_dex = sell_on_dex - size * ask_vwap * (1 + cex_fee) - gas_cost
+        dex_to_cex = size * bid_vwap * (1 - cex_fee) - buy_on_dex - gas_cost
+
+        return {
+            'timestamp': timestamps,
+            'dex_price': dex_price,
+            'spread': (dex_price / mid - 1) * 100,
+            'gas_cost': gas_cost,
+            'cex_to_dex': cex_to_dex,
+            'dex_to_cex': dex_to_cex,
+        }
+
+    @staticmethod
+    def summarize(pnl: np.ndarray) -> Dict[str, float]:
+        valid = pnl[~np.isnan(pnl)]
+        profitable = valid[valid > 0]
+        return {
+            'rows': len(pnl),
+            'valid': len(valid),
+            'profitable': len(profitable),
+            'total_pnl': float(profitable.sum()),
+            'max_pnl': float(valid.max()) if len(valid) else np.nan,
+        }
+
+
+if __name__ == '__main__':
+    import time
+
+    from constants import POOLS
+    from tick_store import book_dtype
+
+    """
+    Synthetic 3 day ETH/USDT replay: two CEX books at 100ms,
+    12s blocks and a pool update on every block
+    """
+    rng = np.random.default_rng(0)
+    days = 3
+    n = days * 24 * 60 * 60 * 10
+    t0 = 1_700_000_000_000
+    mid = 2000 * np.exp(np.cumsum(rng.normal(0, 2e-5, n)))
+
+    def synthetic_book(offset: int):
+        book = np.zeros(n, dtype=book_dtype(5))
+        book['timestamp'] = t0 + np.arange(n) * 100 + offset
+        noise = rng.normal(0, 0.05, n)
+        steps = np.arange(1, 6) * 0.01
+        book['bid_price'] = (mid + noise)[:, None] - steps
+        book['ask_price'] = (mid + noise)[:, None] + steps
+        book['bid_qty'] = rng.uniform(1, 20, (n, 5))
+        book['ask_qty'] = rng.uniform(1, 20, (n, 5))
+        return book
+
+    books = {'binance': synthetic_book(0), 'okx': synthetic_book(30)}
+
+    n_blocks = n // 120
+    blocks = {
+        'block_number': 18_000_000 + np.arange(n_blocks),
+        'timestamp': t0 + np.arange(n_blocks) * 12_000,
+        'next_base_fee': rng.uniform(10, 40, n_blocks) * 1e-9,
+    }
+    pool_mid = mid[::120][:n_blocks] * (1 + rng.normal(0, 1e-3, n_blocks))
+    reserve0 = np.full(n_blocks, 20_000.0) * 1e18
+    states = {
+        'block_number': blocks['block_number'],
+        'timestamp': blocks['timestamp'] + 500,
+        'reserve0': reserve0,
+        'reserve1': reserve0 / 1e18 * pool_mid * 1e6,
+    }
+    pool = next(p for p in POOLS if p['version'] == 2)
+
+    bt = SpreadBacktester()
+
+    s = time.perf_counter()
+    cex = bt.cex_cex(books)
+    print(f'CEX-CEX over {len(cex["timestamp"]):,} rows: {time.perf_counter() - s:.2f}s')
+
+    s = time.perf_counter()
+    result = bt.cex_dex('binance', books['binance'], pool, states, blocks, 'ETH', size=1.0, on='block')
+    print(f'CEX-DEX over {n:,} rows: {time.perf_counter() - s:.2f}s')
+    print('cex_to_dex', bt.summarize(result['cex_to_dex']))
+    print('dex_to_cex', bt.summarize(result['dex_to_cex']))
+
+    # gas of a pair without ETH needs an ETH/quote series; here the same mid as a series must match
+    eth_usdt = {'timestamp': books['okx']['timestamp'],
+                'price': (books['okx']['bid_price'][:, 0] + books['okx']['ask_price'][:, 0]) / 2}
+    priced = bt.cex_dex('binance', books['binance'], pool, states, blocks, 'ETH', size=1.0, on='block',
+                        eth_price=eth_usdt)
+    assert np.allclose(priced['gas_cost'][1:], result['gas_cost'][1:], rtol=1e-3, equal_nan=True)
+    stable_pool = next(p for p in POOLS if {p['token0'], p['token1']} == {'USDC', 'USDT'})
+    try:
+        bt.cex_dex('binance', books['binance'], stable_pool, states, blocks, 'USDC', size=1.0)
+        raise AssertionError('USDC/USDT gas converted without an ETH price')
+    except ValueError as e:
+        print('USDC/USDT without eth_price:', e)
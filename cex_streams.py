@@ -1,30 +1,71 @@
+import os
+import hmac
 import json
+import time
 import asyncio
+import hashlib
+import aiohttp
 import requests
 import websockets
 import aioprocessing
 
-from typing import List
+from typing import Any, Dict, List, Optional
 from decimal import Decimal
 
+from events import OrderbookEvent
+from profiling import stage
+from utils import BookChangeFilter
+
+
+BINANCE_WS_URLS = [
+    'wss://fstream.binance.com/ws/',
+    'wss://fstream.binance.com/stream/',
+    'wss://stream.binance.com:9443/ws/'
+]
+
+
+"""
+Default change filters of the single connection per exchange, kept at module
+level so the counters survive reconnects: CHANGE_FILTERS['binance'].stats().
+Never share one between parallel connections, utils.RedundantFeed gives each
+of its connections a filter of its own
+"""
+CHANGE_FILTERS: Dict[str, BookChangeFilter] = {
+    'binance': BookChangeFilter(heartbeat=1.0),
+    'okx': BookChangeFilter(heartbeat=1.0),
+    'connex': BookChangeFilter(heartbeat=1.0),
+}
+
 
 # Binance USDM-Futures orderbook stream
 async def stream_binance_usdm_orderbook(symbols: List[str],
                                         event_queue: aioprocessing.AioQueue,
-                                        debug: bool = False):
+                                        debug: bool = False,
+                                        ws_urls: Optional[List[str]] = None,
+                                        change_filter: Optional[BookChangeFilter] = None,
+                                        rest_url: str = 'https://fapi.binance.com'):
+    """
+    :param ws_urls: endpoints to try in order, pin a single one per connection
+                    when running several connections through utils.RedundantFeed.
+                    Passed endpoints raise on failure so the caller reconnects
+    :param rest_url: base URL of the REST depth endpoint polled when none of the
+                     default BINANCE_WS_URLS connects
+    :param change_filter: skips books identical to the last one published,
+                          defaults to CHANGE_FILTERS['binance']
+    """
+    change_filter = change_filter or CHANGE_FILTERS['binance']
+    decode_stage = stage('binance.decode')
     try:
         if debug:
             print(f"Connecting to Binance...")
             print(f"Symbols: {symbols}")
         
         # WebSocket接続を試行
-        ws_urls = [
-            'wss://fstream.binance.com/ws/',
-            'wss://fstream.binance.com/stream/',
-            'wss://stream.binance.com:9443/ws/'
-        ]
+        pinned = ws_urls is not None
+        ws_urls = ws_urls or BINANCE_WS_URLS
         
         for ws_url in ws_urls:
+            connected = False
             try:
                 if debug:
                     print(f"Trying WebSocket URL: {ws_url}")
@@ -76,10 +117,12 @@ async def stream_binance_usdm_orderbook(symbols: List[str],
 
                     if debug:
                         print("Successfully subscribed to Binance WebSocket")
+                    connected = True
 
                     while True:
                         try:
                             msg = await asyncio.wait_for(ws.recv(), timeout=15)
+                            start = time.perf_counter_ns()
                             data = json.loads(msg)
                             
                             # データの検証
@@ -87,15 +130,22 @@ async def stream_binance_usdm_orderbook(symbols: List[str],
                                 if debug:
                                     print(f"Skipping invalid message: {data}")
                                 continue
+
+                            forward, prev_update_id = change_filter.check(
+                                data['s'], (data['b'], data['a']), data.get('u'), data.get('pu'))
+                            if not forward:
+                                continue
                             
-                            orderbook = {
-                                'source': 'cex',
-                                'type': 'orderbook',
-                                'exchange': 'binance',
-                                'symbol': data['s'],
-                                'bids': [[Decimal(d[0]), Decimal(d[1])] for d in data['b']],
-                                'asks': [[Decimal(d[0]), Decimal(d[1])] for d in data['a']],
-                            }
+                            orderbook = OrderbookEvent(
+                                'binance',
+                                data['s'],
+                                data['E'],
+                                data.get('u'),
+                                prev_update_id,
+                                [[Decimal(d[0]), Decimal(d[1])] for d in data['b']],
+                                [[Decimal(d[0]), Decimal(d[1])] for d in data['a']],
+                            )
+                            decode_stage.since(start)
                             
                             if not debug:
                                 event_queue.put(orderbook)
@@ -107,12 +157,13 @@ async def stream_binance_usdm_orderbook(symbols: List[str],
                                 print("Binance stream timeout, sending ping...")
                             await ws.ping()
                     
-                    # 接続が成功したらループを抜ける
-                    break
-                    
             except Exception as e:
                 if debug:
                     print(f"Failed to connect to {ws_url}: {e}")
+                # a pinned endpoint or a dropped live connection is reconnected by the
+                # caller (reconnecting_websocket_loop, RedundantFeed), not replaced by REST
+                if pinned or connected:
+                    raise
                 continue
         
         # WebSocket接続が失敗した場合、REST APIを使用
@@ -120,48 +171,53 @@ async def stream_binance_usdm_orderbook(symbols: List[str],
             print("WebSocket connection failed, trying REST API...")
         
         # REST APIを使用したオーダーブック取得
-        while True:
-            try:
-                for symbol in symbols:
-                    # シンボル名の正規化
-                    normalized_symbol = symbol.replace("/", "").upper()
-                    
-                    # Binance REST APIを使用してオーダーブックを取得
-                    url = f"https://fapi.binance.com/fapi/v1/depth?symbol={normalized_symbol}&limit=5"
+        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=10)) as session:
+            while True:
+                try:
+                    for symbol in symbols:
+                        # シンボル名の正規化
+                        normalized_symbol = symbol.replace("/", "").upper()
                     
-                    if debug:
-                        print(f"Fetching orderbook from: {url}")
+                        # Binance REST APIを使用してオーダーブックを取得
+                        url = f"{rest_url}/fapi/v1/depth?symbol={normalized_symbol}&limit=5"
                     
-                    response = requests.get(url, timeout=10)
-                    response.raise_for_status()
+                        if debug:
+                            print(f"Fetching orderbook from: {url}")
                     
-                    data = response.json()
+                        async with session.get(url) as response:
+                            response.raise_for_status()
+                            data = await response.json()
                     
-                    if 'bids' in data and 'asks' in data:
-                        orderbook = {
-                            'source': 'cex',
-                            'type': 'orderbook',
-                            'exchange': 'binance',
-                            'symbol': normalized_symbol,
-                            'bids': [[Decimal(d[0]), Decimal(d[1])] for d in data['bids']],
-                            'asks': [[Decimal(d[0]), Decimal(d[1])] for d in data['asks']],
-                        }
+                        if 'bids' in data and 'asks' in data:
+                            forward, _ = change_filter.check(normalized_symbol, (data['bids'], data['asks']))
+                            if not forward:
+                                continue
+
+                            orderbook = OrderbookEvent(
+                                'binance',
+                                normalized_symbol,
+                                data['E'],
+                                data.get('lastUpdateId'),
+                                None,
+                                [[Decimal(d[0]), Decimal(d[1])] for d in data['bids']],
+                                [[Decimal(d[0]), Decimal(d[1])] for d in data['asks']],
+                            )
                         
-                        if not debug:
-                            event_queue.put(orderbook)
+                            if not debug:
+                                event_queue.put(orderbook)
+                            else:
+                                print(orderbook)
                         else:
-                            print(orderbook)
-                    else:
-                        if debug:
-                            print(f"Invalid response format: {data}")
+                            if debug:
+                                print(f"Invalid response format: {data}")
                 
-                # 100ms間隔で更新（WebSocketと同様）
-                await asyncio.sleep(0.1)
+                    # 100ms間隔で更新（WebSocketと同様）
+                    await asyncio.sleep(0.1)
                 
-            except Exception as e:
-                if debug:
-                    print(f"REST API error: {e}")
-                await asyncio.sleep(1)  # エラー時は1秒待機
+                except Exception as e:
+                    if debug:
+                        print(f"REST API error: {e}")
+                    await asyncio.sleep(1)  # エラー時は1秒待機
                     
     except Exception as e:
         if debug:
@@ -176,14 +232,19 @@ async def stream_binance_usdm_orderbook(symbols: List[str],
 # At OKX, they call perpetuals by the name of swaps.
 async def stream_okx_usdm_orderbook(symbols: List[str],
                                     event_queue: aioprocessing.AioQueue,
-                                    debug: bool = False):
-    instruments = requests.get('https://www.okx.com/api/v5/public/instruments?instType=SWAP').json()
+                                    debug: bool = False,
+                                    change_filter: Optional[BookChangeFilter] = None,
+                                    ws_url: str = 'wss://ws.okx.com:8443/ws/v5/public',
+                                    rest_url: str = 'https://www.okx.com'):
+    change_filter = change_filter or CHANGE_FILTERS['okx']
+    decode_stage = stage('okx.decode')
+    instruments = requests.get(f'{rest_url}/api/v5/public/instruments?instType=SWAP').json()
     multipliers = {
         d['instId'].replace('USD', 'USDT'): Decimal(d['ctMult']) / Decimal(d['ctVal'])
         for d in instruments['data']
     }
     
-    async with websockets.connect('wss://ws.okx.com:8443/ws/v5/public', ping_interval=20, ping_timeout=20) as ws:
+    async with websockets.connect(ws_url, ping_interval=20, ping_timeout=20) as ws:
         args = [{'channel': 'books5', 'instId': f'{s.replace("/", "-")}-SWAP'} for s in symbols]
         subscription = {
             'op': 'subscribe',
@@ -198,25 +259,195 @@ async def stream_okx_usdm_orderbook(symbols: List[str],
             except asyncio.TimeoutError:
                 await ws.ping()
                 continue
+            start = time.perf_counter_ns()
             data = json.loads(msg)
+            if 'data' not in data:
+                # one subscribe ack per instrument, only the first is read above
+                continue
+            book = data['data'][0]
+            forward, prev_update_id = change_filter.check(
+                data['arg']['instId'], (book['bids'], book['asks']), book.get('seqId'), book.get('prevSeqId'))
+            if not forward:
+                continue
             multiplier = multipliers[data['arg']['instId']]
             symbol = data['arg']['instId'].replace('-SWAP', '').replace('-', '')
-            bids = [[Decimal(d[0]), Decimal(d[1]) * multiplier] for d in data['data'][0]['bids']]
-            asks = [[Decimal(d[0]), Decimal(d[1]) * multiplier] for d in data['data'][0]['asks']]
-            orderbook = {
-                'source': 'cex',
-                'type': 'orderbook',
-                'exchange': 'okx',
-                'symbol': symbol,
-                'bids':  bids,
-                'asks': asks,
-            }
+            bids = [[Decimal(d[0]), Decimal(d[1]) * multiplier] for d in book['bids']]
+            asks = [[Decimal(d[0]), Decimal(d[1]) * multiplier] for d in book['asks']]
+            orderbook = OrderbookEvent('okx', symbol, int(book['ts']), book.get('seqId'), prev_update_id, bids, asks)
+            decode_stage.since(start)
             if not debug:
                 event_queue.put(orderbook)
             else:
                 print(orderbook)
-            
-            
+
+
+def connex_signature(api_secret: str, timestamp: str, method: str, path: str, body: str = '') -> str:
+    """
+    HMAC-SHA256 over timestamp + METHOD + path + body, hex encoded
+    """
+    message = f'{timestamp}{method.upper()}{path}{body}'
+    return hmac.new(api_secret.encode(), message.encode(), hashlib.sha256).hexdigest()
+
+
+def connex_auth_headers(api_key: str, api_secret: str, method: str, path: str, body: str = '') -> Dict[str, str]:
+    timestamp = str(int(time.time() * 1000))
+    return {
+        'X-CONNEX-APIKEY': api_key,
+        'X-CONNEX-TIMESTAMP': timestamp,
+        'X-CONNEX-SIGNATURE': connex_signature(api_secret, timestamp, method, path, body),
+    }
+
+
+class ConnexBook:
+    """
+    Local L2 book of one symbol, rebuilt from a REST snapshot and kept in sync
+    with WS deltas. A delta sets absolute quantities per price, 0 removes the level
+    """
+
+    __slots__ = ('symbol', 'seq', 'timestamp', 'bids', 'asks')
+
+    def __init__(self, symbol: str, snapshot: Dict[str, Any]):
+        self.symbol = symbol
+        self.seq = snapshot['seq']
+        self.timestamp = snapshot['timestamp']
+        self.bids = {Decimal(p): Decimal(q) for p, q in snapshot['bids']}
+        self.asks = {Decimal(p): Decimal(q) for p, q in snapshot['asks']}
+
+    def apply(self, update: Dict[str, Any]):
+        for side, levels in ((self.bids, update['bids']), (self.asks, update['asks'])):
+            for p, q in levels:
+                price, qty = Decimal(p), Decimal(q)
+                if qty:
+                    side[price] = qty
+                else:
+                    side.pop(price, None)
+        self.seq = update['seq']
+        self.timestamp = update['timestamp']
+
+    def top(self, depth: int):
+        bids = sorted(self.bids.items(), reverse=True)[:depth]
+        asks = sorted(self.asks.items())[:depth]
+        return [[p, q] for p, q in bids], [[p, q] for p, q in asks]
+
+
+async def fetch_connex_snapshot(session: aiohttp.ClientSession,
+                                rest_url: str,
+                                api_key: str,
+                                api_secret: str,
+                                symbol: str,
+                                limit: int = 100) -> Dict[str, Any]:
+    path = f'/api/v1/depth?symbol={symbol}&limit={limit}'
+    headers = connex_auth_headers(api_key, api_secret, 'GET', path)
+    async with session.get(rest_url.rstrip('/') + path, headers=headers,
+                           timeout=aiohttp.ClientTimeout(total=10)) as response:
+        response.raise_for_status()
+        return await response.json()
+
+
+# Connex orderbook stream: WS deltas on top of REST snapshots
+async def stream_connex_orderbook(symbols: List[str],
+                                  event_queue: aioprocessing.AioQueue,
+                                  debug: bool = False,
+                                  ws_url: Optional[str] = None,
+                                  rest_url: Optional[str] = None,
+                                  api_key: Optional[str] = None,
+                                  api_secret: Optional[str] = None,
+                                  depth: int = 5,
+                                  change_filter: Optional[BookChangeFilter] = None):
+    """
+    Authenticates the WS connection, subscribes to orderbook deltas and seeds
+    each symbol's book from a signed REST snapshot. Deltas carry seq / prev_seq:
+    one that doesn't continue the local book triggers a snapshot resync.
+    REST calls go through one pooled aiohttp session for the connection's lifetime
+
+    Endpoints and credentials default to the CONNEX_* environment variables.
+    Deltas that don't change the top `depth` levels are not published
+    (change_filter, defaults to CHANGE_FILTERS['connex'])
+    """
+    change_filter = change_filter or CHANGE_FILTERS['connex']
+    decode_stage = stage('connex.decode')
+    ws_url = ws_url or os.getenv('CONNEX_WS_URL')
+    rest_url = rest_url or os.getenv('CONNEX_REST_URL')
+    api_key = api_key or os.getenv('CONNEX_API_KEY')
+    api_secret = api_secret or os.getenv('CONNEX_API_SECRET')
+    symbols = [s.replace('/', '').upper() for s in symbols]
+
+    connector = aiohttp.TCPConnector(limit=max(4, len(symbols)), ttl_dns_cache=300)
+    async with aiohttp.ClientSession(connector=connector) as session, \
+            websockets.connect(ws_url, ping_interval=20, ping_timeout=20, max_size=None) as ws:
+        if debug:
+            print(f"Connecting to Connex: {ws_url}")
+
+        timestamp = str(int(time.time() * 1000))
+        await ws.send(json.dumps({
+            'op': 'auth',
+            'args': {
+                'key': api_key,
+                'timestamp': timestamp,
+                'signature': connex_signature(api_secret, timestamp, 'GET', '/ws/auth'),
+            },
+        }))
+        ack = json.loads(await ws.recv())
+        if not ack.get('success'):
+            raise Exception(f"Connex auth failed: {ack}")
+
+        await ws.send(json.dumps({'op': 'subscribe', 'channel': 'orderbook', 'symbols': symbols}))
+        ack = json.loads(await ws.recv())
+        if not ack.get('success'):
+            raise Exception(f"Connex subscription error: {ack}")
+        if debug:
+            print(f"Subscribed Connex orderbooks: {symbols}")
+
+        async def _resync(symbol: str) -> ConnexBook:
+            snapshot = await fetch_connex_snapshot(session, rest_url, api_key, api_secret, symbol)
+            books[symbol] = ConnexBook(symbol, snapshot)
+            return books[symbol]
+
+        # subscribed first, so deltas newer than the snapshots are already buffered on the socket
+        books: Dict[str, ConnexBook] = {}
+        await asyncio.gather(*[_resync(symbol) for symbol in symbols])
+
+        while True:
+            try:
+                msg = await asyncio.wait_for(ws.recv(), timeout=15)
+            except asyncio.TimeoutError:
+                await ws.ping()
+                continue
+
+            start = time.perf_counter_ns()
+            data = json.loads(msg)
+            if data.get('channel') != 'orderbook':
+                if data.get('event') == 'error':
+                    raise Exception(f"Connex stream error: {data}")
+                continue
+
+            symbol = data['symbol']
+            book = books.get(symbol)
+            if book is None or data['seq'] <= book.seq:
+                # older than the snapshot
+                continue
+            if data['prev_seq'] > book.seq:
+                if debug:
+                    print(f"Connex {symbol} gap: book at {book.seq}, update from {data['prev_seq']}, resyncing")
+                book = await _resync(symbol)
+                # either already in the snapshot, or the snapshot is still
+                # behind the stream and the next delta resyncs again
+                if data['seq'] <= book.seq or data['prev_seq'] > book.seq:
+                    continue
+
+            book.apply(data)
+            bids, asks = book.top(depth)
+            forward, prev_update_id = change_filter.check(symbol, (bids, asks), data['seq'], data['prev_seq'])
+            if not forward:
+                continue
+            orderbook = OrderbookEvent('connex', symbol, book.timestamp, data['seq'], prev_update_id, bids, asks)
+            decode_stage.since(start)
+            if not debug:
+                event_queue.put(orderbook)
+            else:
+                print(orderbook)
+
+
 if __name__ == '__main__':
     import nest_asyncio
     from functools import partial
@@ -0,0 +1,365 @@
+"""
+Streaming several EVM chains at once
+
+Every chain has its own token / pool registry (constants.CHAIN_TOKENS,
+CHAIN_POOLS), RPC endpoints and stream tasks, and the events its streams
+publish carry its chain_id. They all go to the same handler through a
+ChainScheduler: one queue (lane) per chain, served round-robin, so a chain
+with 250ms blocks and a steady flow of swaps (Arbitrum) can put at most
+`weight` of its events ahead of the next mainnet event, however far the
+handler is behind. Each lane keeps its own throughput, depth and delay stats.
+
+chains = load_chains(['ethereum', 'arbitrum'])     # RPC URLs from the environment
+scheduler = ChainScheduler()
+for chain in chains:
+    scheduler.lane(chain.name, chain.chain_id, policy='conflate' if chain.block_time < 1 else 'block')
+streams = [stream for chain in chains for stream in chain.streams(scheduler)]
+event_handler(scheduler)                           # the same handler, fed fairly across chains
+scheduler.stats()                                  # per chain: rate, blocks, depth, lag, delay
+"""
+import os
+import time
+import asyncio
+
+from collections import deque
+from functools import partial
+from typing import Any, Callable, Dict, Hashable, Iterable, List, Optional, TYPE_CHECKING
+
+from constants import CHAINS, CHAIN_TOKENS, CHAIN_POOLS, MULTICALL3
+from event_bus import Subscription, conflation_key
+from events import event_type
+from pool_registry import PoolRegistry
+
+if TYPE_CHECKING:
+    from monitor import FeedMonitor
+    from state_cache import StateCache
+
+
+CHAIN_FEEDS = ('new_blocks', 'uniswap_v3', 'uniswap_v2')
+
+
+class Chain:
+    """
+    One chain's registries, RPC endpoints and stream tasks
+    """
+
+    def __init__(self,
+                 name: str,
+                 chain_id: int,
+                 block_time: float,
+                 multicall3_block: int,
+                 tokens: Dict[str, List[Any]],
+                 pools: List[Dict[str, Any]],
+                 http_rpc_url: Optional[str] = None,
+                 ws_rpc_url: Optional[str] = None):
+        self.name = name
+        self.chain_id = chain_id
+        self.block_time = block_time
+        self.multicall3_block = multicall3_block
+        self.tokens = tokens
+        self.registry = PoolRegistry.from_pools(pools, tokens)
+        self.http_rpc_url = http_rpc_url
+        self.ws_rpc_url = ws_rpc_url
+
+    def __repr__(self):
+        return f'Chain({self.name}, {self.chain_id}, pools={len(self.registry.pools)})'
+
+    @classmethod
+    def from_constants(cls,
+                       name: str,
+                       http_rpc_url: Optional[str] = None,
+                       ws_rpc_url: Optional[str] = None) -> 'Chain':
+        """
+        The chain called `name` in constants.CHAINS. Endpoints default to
+        HTTP_RPC_URL / WS_RPC_URL for ethereum and <NAME>_HTTP_RPC_URL /
+        <NAME>_WS_RPC_URL for the other chains
+        """
+        if name not in CHAINS:
+            raise ValueError(f'Unknown chain {name}, expected one of {list(CHAINS)}')
+        prefix = '' if name == 'ethereum' else f'{name.upper()}_'
+        return cls(name,
+                   tokens=CHAIN_TOKENS[name],
+                   pools=CHAIN_POOLS[name],
+                   http_rpc_url=http_rpc_url or os.getenv(f'{prefix}HTTP_RPC_URL'),
+                   ws_rpc_url=ws_rpc_url or os.getenv(f'{prefix}WS_RPC_URL'),
+                   **CHAINS[name])
+
+    def state_cache(self, path: Optional[str] = None, **kwargs) -> 'StateCache':
+        """
+        A StateCache for this chain's HTTP endpoint, with its own SQLite file
+        (state_cache.<name>.sqlite by default) since cache keys carry no chain
+        """
+        from state_cache import StateCache
+
+        return StateCache(self.http_rpc_url,
+                          path=path or f'state_cache.{self.name}.sqlite',
+                          multicall=(MULTICALL3[0], self.multicall3_block),
+                          **kwargs)
+
+    def streams(self,
+                event_queue,
+                feeds: Iterable[str] = CHAIN_FEEDS,
+                monitor: Optional['FeedMonitor'] = None,
+                state_cache: Optional['StateCache'] = None) -> List[Any]:
+        """
+        Reconnecting stream coroutines of `feeds` for this chain, publishing
+        chain-tagged events into `event_queue`. With a monitor, each feed is
+        reported as '<feed>.<chain name>'
+        """
+        from utils import reconnecting_websocket_loop
+        from dex_streams import stream_new_blocks, stream_uniswap_v2_events, stream_uniswap_v3_events
+
+        coroutines = []
+        for feed in feeds:
+            if feed == 'new_blocks':
+                stream_fn = partial(stream_new_blocks, self.ws_rpc_url)
+            elif feed == 'uniswap_v3':
+                if not self.registry.filter(version=3).pools:
+                    continue
+                stream_fn = partial(stream_uniswap_v3_events, self.http_rpc_url, self.ws_rpc_url,
+                                    self.tokens, self.registry)
+            elif feed == 'uniswap_v2':
+                if not self.registry.filter(version=2).pools:
+                    continue
+                stream_fn = partial(stream_uniswap_v2_events, self.http_rpc_url, self.ws_rpc_url,
+                                    self.tokens, self.registry)
+            else:
+                raise ValueError(f'Unknown chain feed: {feed}, choose from {list(CHAIN_FEEDS)}')
+
+            name = f'{feed}.{self.name}'
+            queue = monitor.queue(name, event_queue) if monitor is not None else event_queue
+            kwargs: Dict[str, Any] = {'chain_id': self.chain_id}
+            if feed in ('uniswap_v3', 'uniswap_v2') and state_cache is not None:
+                kwargs['state_cache'] = state_cache
+            coroutines.append(reconnecting_websocket_loop(
+                partial(stream_fn, queue, False, **kwargs),
+                tag=f'{name}_stream',
+                on_reconnect=monitor.reconnect_hook(name) if monitor is not None else None,
+            ))
+        return coroutines
+
+
+def load_chains(names: Iterable[str], urls: Optional[Dict[str, Dict[str, str]]] = None) -> List[Chain]:
+    """
+    :param urls: optional {name: {'http_rpc_url', 'ws_rpc_url'}} overriding the environment
+    """
+    urls = urls or {}
+    return [Chain.from_constants(name, **urls.get(name, {})) for name in names]
+
+
+class Lane(Subscription):
+    """
+    One chain's queue in a ChainScheduler: an event_bus.Subscription (same
+    policies and delay stats) that also counts blocks and throughput
+    """
+
+    def __init__(self,
+                 scheduler: 'ChainScheduler',
+                 name: str,
+                 chain_id: Optional[int] = None,
+                 weight: int = 1,
+                 policy: str = 'block',
+                 maxsize: int = 10_000,
+                 key_fn: Callable[[Any], Hashable] = conflation_key):
+        super().__init__(name, policy, maxsize, key_fn)
+        self.scheduler = scheduler
+        self.chain_id = chain_id
+        self.weight = weight
+        self.blocks = 0
+        self.last_block: Optional[int] = None
+        self.last_block_at: Optional[float] = None
+        self.rate = 0.0
+        self.delivery_rate = 0.0
+        self._rate_counts = (0, 0)
+        self._rate_time = time.monotonic()
+
+    def put(self, event: Any):
+        now = time.monotonic()
+        was_empty = not self._queue
+        self.offer(event, now)
+        if event_type(event) == 'block':
+            self.blocks += 1
+            self.last_block = event.get('block_number')
+            self.last_block_at = now
+        if was_empty:
+            self.scheduler._ready(self)
+
+    put_nowait = put
+
+    def stats(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        elapsed = now - self._rate_time
+        if elapsed >= 1.0:
+            received, delivered = self._rate_counts
+            self.rate = (self.received - received) / elapsed
+            self.delivery_rate = (self.delivered - delivered) / elapsed
+            self._rate_counts, self._rate_time = (self.received, self.delivered), now
+        return {
+            **super().stats(),
+            'chain_id': self.chain_id,
+            'weight': self.weight,
+            'rate': self.rate,
+            'delivery_rate': self.delivery_rate,
+            'blocks': self.blocks,
+            'last_block': self.last_block,
+            'seconds_since_block': now - self.last_block_at if self.last_block_at is not None else None,
+        }
+
+
+class ChainScheduler:
+    """
+    Fair merge of per-chain lanes into one handler queue
+
+    put() routes an event to the lane of its chain_id (events without one,
+    such as CEX orderbooks, to the 'default' lane), coro_get() takes up to
+    `weight` events from the lane whose turn it is and moves on to the next
+    lane with events queued. Same put / coro_get / qsize interface as the
+    LoopQueue and AioQueue it replaces, so streams, MonitoredQueue,
+    TimedQueue and event_handler run unchanged
+    """
+
+    def __init__(self, default_weight: int = 1):
+        self.lanes: Dict[str, Lane] = {}
+        self.routes: Dict[Optional[int], Lane] = {}
+        self.default_weight = default_weight
+        self._turns: deque = deque()   # lanes with queued events, in turn order
+        self._served = 0
+        self._getter: Optional[asyncio.Future] = None
+
+    def lane(self,
+             name: str,
+             chain_id: Optional[int] = None,
+             weight: int = 1,
+             policy: str = 'block',
+             maxsize: int = 10_000,
+             key_fn: Callable[[Any], Hashable] = conflation_key) -> Lane:
+        """
+        :param chain_id: events with this chain_id are routed here by put()
+        :param weight: events taken from this lane per turn
+        :param policy: 'block', 'drop_oldest' or 'conflate' when the lane is full,
+                       see event_bus; 'conflate' keeps only the latest state per
+                       pool for a chain the handler cannot keep up with
+        """
+        if name in self.lanes:
+            raise ValueError(f'Lane {name} already exists')
+        lane = Lane(self, name, chain_id, weight, policy, maxsize, key_fn)
+        self.lanes[name] = lane
+        if chain_id is not None:
+            self.routes[chain_id] = lane
+        return lane
+
+    def _default(self) -> Lane:
+        lane = self.lanes.get('default')
+        if lane is None:
+            lane = self.lane('default', weight=self.default_weight)
+        return lane
+
+    def _ready(self, lane: Lane):
+        self._turns.append(lane)
+        getter = self._getter
+        if getter is not None and not getter.done():
+            getter.set_result(None)
+
+    def put(self, event: Any):
+        lane = self.routes.get(event.get('chain_id'))
+        (lane if lane is not None else self._default()).put(event)
+
+    put_nowait = put
+
+    def get_nowait(self) -> Any:
+        turns = self._turns
+        if not turns:
+            raise asyncio.QueueEmpty
+        lane = turns[0]
+        event = lane._pop()
+        self._served += 1
+        if not lane._queue:
+            turns.popleft()
+            self._served = 0
+        elif self._served >= lane.weight:
+            turns.rotate(-1)
+            self._served = 0
+        return event
+
+    async def coro_get(self) -> Any:
+        while not self._turns:
+            self._getter = asyncio.get_event_loop().create_future()
+            try:
+                await self._getter
+            finally:
+                self._getter = None
+        return self.get_nowait()
+
+    get = coro_get
+
+    def qsize(self) -> int:
+        return sum(len(lane) for lane in self.lanes.values())
+
+    def stats(self) -> List[Dict[str, Any]]:
+        return [lane.stats() for lane in self.lanes.values()]
+
+
+if __name__ == '__main__':
+    from events import BlockEvent, PoolUpdateEvent
+    from run import LoopQueue
+
+    """
+    Mainnet (12s blocks, 30 swaps each) and Arbitrum (250ms blocks, 150
+    swaps each) publishing their logs in per-block bursts, as nodes do, into
+    one handler that spends 2ms per event: less than Arbitrum alone needs.
+    With a single FIFO queue mainnet events wait behind the growing Arbitrum
+    backlog; with a ChainScheduler they wait for at most one Arbitrum event
+    each, even with the Arbitrum lane lossless
+    """
+
+    async def _run(mode: str, duration: float = 20.0):
+        chains = {chain.chain_id: chain for chain in load_chains(['ethereum', 'arbitrum'])}
+        if mode == 'fifo':
+            queue = LoopQueue()
+        else:
+            queue = ChainScheduler()
+            queue.lane('ethereum', 1)
+            queue.lane('arbitrum', 42161)
+
+        delays: Dict[int, List[float]] = {chain_id: [] for chain_id in chains}
+
+        async def _chain(chain: Chain, swaps: int):
+            pools = chain.registry.filter(version=3).pools
+            number = 0
+            started = time.monotonic()
+            while time.monotonic() - started < duration:
+                number += 1
+                now = time.monotonic()
+                queue.put(BlockEvent(number, chain_id=chain.chain_id, timestamp=now))
+                for i in range(swaps):
+                    pool = pools[i % len(pools)]
+                    queue.put(PoolUpdateEvent(number, pool.exchange, pool.version, pool.symbol, pool.address,
+                                              pool.fee, pool.token_idx, pool.decimals, log_index=i,
+                                              sqrtPriceX96=2 ** 96, tick=0, liquidity=10 ** 18,
+                                              chain_id=chain.chain_id, tx_hash=now))
+                await asyncio.sleep(chain.block_time)
+
+        async def _handler():
+            while True:
+                event = await queue.coro_get()
+                # publish time in the timestamp (blocks) / tx_hash (swaps) field
+                sent = event.get('tx_hash') or event.get('timestamp')
+                delays[event['chain_id']].append((time.monotonic() - sent) * 1000)
+                time.sleep(0.002)
+                # yield between events, as coro_get() on an aioprocessing.AioQueue does
+                await asyncio.sleep(0)
+
+        handler = asyncio.ensure_future(_handler())
+        await asyncio.gather(_chain(chains[1], 30), _chain(chains[42161], 150))
+        handler.cancel()
+
+        for chain_id, values in delays.items():
+            values = sorted(values)
+            print({'mode': mode, 'chain': chains[chain_id].name, 'handled': len(values),
+                   'p50_ms': round(values[len(values) // 2], 1), 'max_ms': round(values[-1], 1)})
+        if mode == 'scheduler':
+            for stats in queue.stats():
+                print({k: round(v, 3) if isinstance(v, float) else v for k, v in stats.items()})
+
+    asyncio.run(_run('fifo'))
+    asyncio.run(_run('scheduler'))
@@ -14,6 +14,104 @@ POOLS = [
     ['uniswap', 3, 'USDC/ETH', '0x8ad599c3A0ff1De082011EFDDc58f1908eb6e6D8', 3000, 'USDC', 'ETH'],  # 0.3% fee tier
     ['uniswap', 3, 'ETH/USDT', '0x4e68Ccd3E89f51C3074ca5072bbAC773960dFa36', 500, 'ETH', 'USDT'],   # 0.05% fee tier
     ['uniswap', 3, 'ETH/USDT', '0x11b815efB8f581194ae79006d24E0d814B7697F6', 3000, 'ETH', 'USDT'], # 0.3% fee tier (main ETH/USDT pool)
+    ['uniswap', 3, 'USDC/USDT', '0x3416cF6C708Da44DB2624D63ea0AAef7113527C6', 100, 'USDC', 'USDT'],  # 0.01% fee tier
 ]
 
-POOLS = [dict(zip(columns, pool)) for pool in POOLS]
\ No newline at end of file
+POOLS = [dict(zip(columns, pool)) for pool in POOLS]
+
+"""
+Taker fees used for spread calculations (Tier: LV 1)
+
+- OKX: https://www.okx.com/fees
+- Binance: https://www.binance.com/en/fee/futureFee
+"""
+FEE = {
+    'okx': 0.0005,      # 0.05%
+    'binance': 0.0004,  # 0.04%
+    'uniswap': 0.003,   # 0.3%
+    'sushiswap': 0.003, # 0.3%
+}
+
+# Approximate gas used by a single swap
+GAS_USED = {
+    2: 110_000,
+    3: 150_000,
+}
+
+# Factories used by PoolRegistry.load_from_factories
+FACTORIES = [
+    # exchange, version, address, deployed block
+    ['uniswap', 2, '0x5C69bEe701ef814a2B6a3EDD4B1652CB9cc5aA6f', 10000835],
+    ['sushiswap', 2, '0xC0AEe478e3658e2610c5F7A4A2E1777cE9e4f2Ac', 10794229],
+    ['uniswap', 3, '0x1F98431c8aD98523631AE4a59f267346ea31F984', 12369621],
+]
+
+# Routers whose pending swaps are decoded by mempool_streams
+ROUTERS = {
+    '0x7a250d5630b4cf539739df2c5dacb4c659f2488d': ['uniswap', 2],    # UniswapV2Router02
+    '0xd9e1ce17f2641f24ae83637ab66a2cca9c378b9f': ['sushiswap', 2],  # SushiSwapRouter
+    '0xe592427a0aece92de3edee1f18e0157c05861564': ['uniswap', 3],    # SwapRouter
+    '0x68b3465833fb72a70ecdf485e0e4c7bd8665fc45': ['uniswap', 3],    # SwapRouter02
+}
+
+# Multicall3, same address on every chain; block it was deployed at on mainnet
+MULTICALL3 = ['0xcA11bde05977b3631167028862bE2a173976CA11', 14353601]
+
+"""
+Chains the DEX streams can run on. block_time is the average in seconds,
+multicall3_block the block Multicall3 was deployed at on that chain.
+RPC endpoints come from HTTP_RPC_URL / WS_RPC_URL for ethereum and from
+<CHAIN>_HTTP_RPC_URL / <CHAIN>_WS_RPC_URL (e.g. ARBITRUM_WS_RPC_URL) for the others
+"""
+CHAINS = {
+    'ethereum': {'chain_id': 1, 'block_time': 12.0, 'multicall3_block': 14353601},
+    'optimism': {'chain_id': 10, 'block_time': 2.0, 'multicall3_block': 4286263},
+    'bsc': {'chain_id': 56, 'block_time': 3.0, 'multicall3_block': 15921452},
+    'polygon': {'chain_id': 137, 'block_time': 2.0, 'multicall3_block': 25770160},
+    'arbitrum': {'chain_id': 42161, 'block_time': 0.25, 'multicall3_block': 7654707},
+}
+
+# Token registries per chain, same symbols as on mainnet so pairs line up with the CEX symbols
+CHAIN_TOKENS = {
+    'ethereum': TOKENS,
+    'optimism': {
+        'ETH': ['0x4200000000000000000000000000000000000006', 18],
+        'USDT': ['0x94b008aA00579c1307B0EF2c499aD98a8ce58e58', 6],
+        'USDC': ['0x7F5c764cBc14f9669B88837ca1490cCa17c31607', 6],   # bridged USDC.e
+    },
+    'bsc': {
+        'ETH': ['0x2170Ed0880ac9A755fd29B2688956BD959F933F8', 18],
+        'USDT': ['0x55d398326f99059fF775485246999027B3197955', 18],
+        'USDC': ['0x8AC76a51cc950d9822D68b83fE1Ad97B32Cd580d', 18],
+    },
+    'polygon': {
+        'ETH': ['0x7ceB23fD6bC0adD59E62ac25578270cFf1b9f619', 18],
+        'USDT': ['0xc2132D05D31c914a87C6611C10748AEb04B58e8F', 6],
+        'USDC': ['0x2791Bca1f2de4661ED88A30C99A7a9449Aa84174', 6],   # bridged USDC.e
+    },
+    'arbitrum': {
+        'ETH': ['0x82aF49447D8a07e3bd95BD0d56f35241523fBab1', 18],
+        'USDT': ['0xFd086bC7CD5C481DCC9C85ebE478A1C0b69FCbb9', 6],
+        'USDC': ['0xaf88d065e77c8cC2239327C5EDb3A432268e5831', 6],
+    },
+}
+
+# Pool registries per chain, same columns as POOLS
+CHAIN_POOLS = {
+    'ethereum': POOLS,
+    'optimism': [
+        ['uniswap', 3, 'ETH/USDC', '0x85149247691df622eaF1a8Bd0CaFd40BC45154a9', 500, 'ETH', 'USDC'],
+    ],
+    # PancakeSwap V3 emits its own Swap event, not the Uniswap V3 one stream_uniswap_v3_events subscribes to
+    'bsc': [],
+    'polygon': [
+        ['uniswap', 3, 'USDC/ETH', '0x45dDa9cb7c25131DF268515131f647d726f50608', 500, 'USDC', 'ETH'],
+    ],
+    'arbitrum': [
+        ['uniswap', 3, 'ETH/USDC', '0xC6962004f452bE9203591991D15f6b388e09E8D0', 500, 'ETH', 'USDC'],
+        ['uniswap', 3, 'ETH/USDT', '0x641C00A822e8b671738d32a431a4Fb6074E5c79d', 500, 'ETH', 'USDT'],
+    ],
+}
+
+CHAIN_POOLS = {chain: [dict(zip(columns, pool)) if isinstance(pool, list) else pool for pool in pools]
+               for chain, pools in CHAIN_POOLS.items()}
@@ -1,23 +1,57 @@
 import os
 import json
-import eth_abi
+import time
 import asyncio
-import eth_utils
 import websockets
 import aioprocessing
 
-from web3 import Web3
 from functools import partial
-from typing import Any, Dict, List
+from typing import Any, Dict, List, Optional, Union, TYPE_CHECKING
 from multicall import Call, Multicall
 
 from constants import TOKENS, POOLS
+from events import BlockEvent, PoolUpdateEvent
+from pool_registry import Pool, PoolRegistry
+from profiling import stage
+from rpc_client import RPCClient, shared_client
+from state_cache import SLOT0, LIQUIDITY, GET_RESERVES
 from utils import calculate_next_block_base_fee
+from abi_decoder import decode_swap_v3, decode_sync_v2
+
+if TYPE_CHECKING:
+    from state_cache import StateCache
+
+
+# keccak('Swap(address,address,int256,int256,uint160,uint128,int24)')
+SWAP_V3_TOPIC = '0xc42079f94a6350d7e6235f29174924f928cc2ac818eb64fed8004e115fbcca67'
+# keccak('Sync(uint112,uint112)'), emitted by Uniswap V2 and Sushiswap pairs after every reserve change
+SYNC_V2_TOPIC = '0x1c411e9a96e071241c2f21f7726b17ae89e3cab4c78be50e062b03a9fffbbad1'
+
+
+def dex_event_key(event: Dict[str, Any]) -> tuple:
+    """
+    Identity of a DEX event across RPC providers, for utils.RedundantFeed:
+    blocks by hash, logs by (txHash, logIndex), initial pool snapshots by block
+    """
+    if event['type'] == 'block':
+        return ('block', event['block_hash'])
+    if event.get('tx_hash') is not None:
+        return ('log', event['tx_hash'], event['log_index'])
+    return ('snapshot', event.get('address'), event.get('block_number'))
+
+
+def _stage_name(name: str, chain_id: int) -> str:
+    # mainnet keeps the unsuffixed stage names
+    return name if chain_id == 1 else f'{name}.{chain_id}'
 
 
 async def stream_new_blocks(ws_rpc_url: str,
                             event_queue: aioprocessing.AioQueue,
-                            debug: bool = False):
+                            debug: bool = False,
+                            chain_id: int = 1):
+    """
+    :param chain_id: chain of ws_rpc_url, every BlockEvent is tagged with it
+    """
     
     async with websockets.connect(ws_rpc_url) as ws:
         if debug:
@@ -35,20 +69,26 @@ async def stream_new_blocks(ws_rpc_url: str,
             print(f"Subscribed newHeads ack: {ack}")
 
         WEI = 10 ** 18
+        decode_stage = stage(_stage_name('new_blocks.decode', chain_id))
 
         while True:
             msg = await asyncio.wait_for(ws.recv(), timeout=60 * 10)
+            start = time.perf_counter_ns()
             block = json.loads(msg)['params']['result']
             block_number = int(block['number'], base=16)
-            base_fee = int(block['baseFeePerGas'], base=16)
-            next_base_fee = calculate_next_block_base_fee(block)
-            event = {
-                'source': 'dex',
-                'type': 'block',
-                'block_number': block_number,
-                'base_fee': base_fee / WEI,
-                'next_base_fee': next_base_fee / WEI,
-            }
+            # chains without EIP-1559 headers have no base fee
+            has_base_fee = 'baseFeePerGas' in block
+            base_fee = int(block['baseFeePerGas'], base=16) if has_base_fee else None
+            next_base_fee = calculate_next_block_base_fee(block) if has_base_fee else None
+            event = BlockEvent(
+                block_number,
+                block['hash'],
+                int(block['timestamp'], base=16) * 1000,
+                base_fee / WEI if has_base_fee else None,
+                next_base_fee / WEI if has_base_fee else None,
+                chain_id,
+            )
+            decode_stage.since(start)
             if not debug:
                 event_queue.put(event)
             else:
@@ -59,74 +99,60 @@ async def stream_new_blocks(ws_rpc_url: str,
 async def stream_uniswap_v3_events(http_rpc_url: str,
                                    ws_rpc_url: str,
                                    tokens: Dict[str, List[Any]],
-                                   pools: List[List[Any]],
+                                   pools: Union[List[Dict[str, Any]], PoolRegistry],
                                    event_queue: aioprocessing.AioQueue,
-                                   debug: bool = False):
-    
-    # Web3インスタンスの作成
-    w3 = Web3(Web3.HTTPProvider(http_rpc_url))
-    
-    block_number = w3.eth.get_block_number()
-    
-    # Uniswap V3 uses slot0() to get current sqrt price and tick
-    # We'll also need to get liquidity from the pool
-    slot0_signature = 'slot0()((uint160,int24,uint16,uint16,uint16,uint8,bool))'
-    liquidity_signature = 'liquidity()(uint128)'
+                                   debug: bool = False,
+                                   state_cache: Optional['StateCache'] = None,
+                                   chain_id: int = 1,
+                                   rpc_client: Optional[RPCClient] = None):
+    """
+    :param tokens, pools: registries of the chain the RPC endpoints serve
+    :param state_cache: optional state_cache.StateCache for http_rpc_url; the
+                        initial pool reads are pinned to the current block, which
+                        is within the cache's confirmation depth, so they go to
+                        the node and a reorg cannot leave them cached
+    :param chain_id: chain of the RPC endpoints, every PoolUpdateEvent is tagged with it
+    :param rpc_client: rpc_client.RPCClient of http_rpc_url, shared_client(http_rpc_url) by default
+    """
     
-    # Filter to V3 pools first
-    filtered_pools = [pool for pool in pools if pool['version'] == 3]
-    pools = {pool['address'].lower(): pool for pool in filtered_pools}
+    client = rpc_client or shared_client(http_rpc_url)
+
+    block_number = await client.block_number()
+
+    # Filter to V3 pools first, descriptors (keys, token order, decimals) are precomputed once
+    if not isinstance(pools, PoolRegistry):
+        pools = PoolRegistry.from_pools(pools, tokens)
+    pools = pools.filter(version=3)
+
+    # Uniswap V3 uses slot0() to get current sqrt price and tick, and liquidity() for the liquidity.
+    # Every read is awaited together: one JSON-RPC batch, the loop keeps serving the other feeds meanwhile
+    calls = [(pool.address, selector, block_number) for pool in pools for selector in (SLOT0, LIQUIDITY)]
+    if state_cache is not None:
+        results = await state_cache.call_many_async(calls, client, head=block_number)
+    else:
+        results = await asyncio.gather(*[client.eth_call(address, data, block) for address, data, block in calls],
+                                       return_exceptions=True)
 
     # Get initial pool data for V3 pools only
     pool_data = {}
-    for pool in filtered_pools:
-        try:
-            pool_name = f'{pool["exchange"]}_{pool["version"]}_{pool["name"].replace("/", "")}'
-            
-            # Get slot0 data (sqrt price, tick, etc.)
-            contract = w3.eth.contract(
-                address=pool['address'],
-                abi=[
-                    {
-                        "inputs": [],
-                        "name": "slot0",
-                        "outputs": [
-                            {"name": "sqrtPriceX96", "type": "uint160"},
-                            {"name": "tick", "type": "int24"},
-                            {"name": "observationIndex", "type": "uint16"},
-                            {"name": "observationCardinality", "type": "uint16"},
-                            {"name": "observationCardinalityNext", "type": "uint16"},
-                            {"name": "feeProtocol", "type": "uint8"},
-                            {"name": "unlocked", "type": "bool"}
-                        ],
-                        "stateMutability": "view",
-                        "type": "function"
-                    },
-                    {
-                        "inputs": [],
-                        "name": "liquidity",
-                        "outputs": [{"name": "", "type": "uint128"}],
-                        "stateMutability": "view",
-                        "type": "function"
-                    }
-                ]
-            )
-            
-            slot0 = contract.functions.slot0().call()
-            liquidity = contract.functions.liquidity().call()
-            
+    for i, pool in enumerate(pools):
+        # keyed by address: pools of the same pair in different fee tiers share pool.key
+        pool_name = pool.address
+        slot0, liquidity = results[2 * i], results[2 * i + 1]
+        if isinstance(slot0, bytes) and isinstance(liquidity, bytes) and len(slot0) >= 64 and len(liquidity) >= 32:
             pool_data[pool_name] = {
-                'sqrtPriceX96': slot0[0],
-                'tick': slot0[1],
-                'liquidity': liquidity
+                'sqrtPriceX96': int.from_bytes(slot0[:32], 'big'),
+                'tick': int.from_bytes(slot0[32:64], 'big', signed=True),
+                'liquidity': int.from_bytes(liquidity[:32], 'big')
             }
-            
+
             if debug:
-                print(f"Initial data for {pool_name}: sqrtPriceX96={slot0[0]}, tick={slot0[1]}, liquidity={liquidity}")
-                
-        except Exception as e:
+                print(f"Initial data for {pool_name}: sqrtPriceX96={pool_data[pool_name]['sqrtPriceX96']}, "
+                      f"tick={pool_data[pool_name]['tick']}, liquidity={pool_data[pool_name]['liquidity']}")
+        else:
             if debug:
-                print(f"Error getting data for {pool['address']}: {e}")
+                error = slot0 if isinstance(slot0, Exception) else liquidity
+                print(f"Error getting data for {pool.address}: {error}")
             pool_data[pool_name] = {
                 'sqrtPriceX96': 0,
                 'tick': 0,
@@ -136,55 +162,46 @@ async def stream_uniswap_v3_events(http_rpc_url: str,
     """
     pool_data:
     {
-        'uniswap_3_ETHUSDT': {'sqrtPriceX96': 123456789, 'tick': 12345, 'liquidity': 987654321},
-        'sushiswap_3_ETHUSDT': {'sqrtPriceX96': 234567890, 'tick': 23456, 'liquidity': 876543210}
+        '0x4e68ccd3e89f51c3074ca5072bbac773960dfa36': {'sqrtPriceX96': 123456789, 'tick': 12345, 'liquidity': 987654321},
+        '0x11b815efb8f581194ae79006d24e0d814b7697f6': {'sqrtPriceX96': 234567890, 'tick': 23456, 'liquidity': 876543210}
     }
     """
     
     # pools dict already prepared above
     
     def _publish(block_number: int,
-                 pool: Dict[str, Any],
-                 data: List[Any] = []):
-        
-        exchange = pool['exchange']
-        version = pool['version']
-        symbol = f'{pool["token0"]}{pool["token1"]}'
+                 pool: Pool,
+                 data: List[Any] = [],
+                 tx_hash: Optional[str] = None,
+                 log_index: Optional[int] = None):
 
         # save to "pool_data" in memory
-        symbol_key = f'{exchange}_{version}_{symbol}'
+        symbol_key = pool.address
         
         if len(data) == 3:
             # Update pool data with new Swap event data
             pool_data[symbol_key]['sqrtPriceX96'] = data[0]
             pool_data[symbol_key]['tick'] = data[1]
             pool_data[symbol_key]['liquidity'] = data[2]
-            
-        token_idx = {
-            pool['token0']: 0,
-            pool['token1']: 1,
-        }
-        
-        decimals = {
-            pool['token0']: tokens[pool['token0']][1],
-            pool['token1']: tokens[pool['token1']][1],
-        }
         
         current_data = pool_data[symbol_key]
         
-        pool_update = {
-            'source': 'dex',
-            'type': 'pool_update',
-            'block_number': block_number,
-            'exchange': pool['exchange'],
-            'version': pool['version'],
-            'symbol': symbol,
-            'token_idx': token_idx,
-            'decimals': decimals,
-            'sqrtPriceX96': current_data['sqrtPriceX96'],
-            'tick': current_data['tick'],
-            'liquidity': current_data['liquidity'],
-        }
+        pool_update = PoolUpdateEvent(
+            block_number,
+            pool.exchange,
+            pool.version,
+            pool.symbol,
+            pool.address,
+            pool.fee,
+            pool.token_idx,
+            pool.decimals,
+            tx_hash=tx_hash,
+            log_index=log_index,
+            sqrtPriceX96=current_data['sqrtPriceX96'],
+            tick=current_data['tick'],
+            liquidity=current_data['liquidity'],
+            chain_id=chain_id,
+        )
         
         if not debug:
             event_queue.put(pool_update)
@@ -194,14 +211,11 @@ async def stream_uniswap_v3_events(http_rpc_url: str,
     """
     Send initial pool data so that price can be calculated even if the pool is idle
     """
-    for address, pool in pools.items():
+    for pool in pools:
         _publish(block_number, pool)
 
     # Uniswap V3 Swap event signature
-    # Ensure 0x-prefixed topic for subscription
-    swap_event_selector = w3.keccak(text='Swap(address,address,int256,int256,uint160,uint128,int24)').hex()
-    if not swap_event_selector.startswith('0x'):
-        swap_event_selector = '0x' + swap_event_selector
+    swap_event_selector = SWAP_V3_TOPIC
     
     async with websockets.connect(ws_rpc_url) as ws:
         if debug:
@@ -213,7 +227,7 @@ async def stream_uniswap_v3_events(http_rpc_url: str,
             'params': [
                 'logs',
                 {
-                    'address': list(pools.keys()),
+                    'address': pools.addresses(),
                     'topics': [swap_event_selector]
                 }
             ]
@@ -224,37 +238,132 @@ async def stream_uniswap_v3_events(http_rpc_url: str,
         if debug:
             print(f"Subscribed logs ack: {ack}")
 
+        decode_stage = stage(_stage_name('uniswap_v3.decode', chain_id))
+
         while True:
             msg = await asyncio.wait_for(ws.recv(), timeout=60 * 10)
+            start = time.perf_counter_ns()
             event = json.loads(msg)['params']['result']
-            address = event['address'].lower()
+            pool = pools.by_address.get(event['address'].lower())
 
-            if address in pools:
+            if pool is not None:
                 block_number = int(event['blockNumber'], base=16)
-                pool = pools[address]
                 
                 # Parse Swap event data (non-indexed parameters only):
                 # amount0, amount1, sqrtPriceX96, liquidity, tick
-                swap_data = eth_abi.decode(
-                    ['int256', 'int256', 'uint160', 'uint128', 'int24'],
-                    eth_utils.decode_hex(event['data'])
-                )
+                swap_data = decode_swap_v3(event['data'])
                 
                 # Extract relevant data: sqrtPriceX96, tick, liquidity
                 sqrtPriceX96 = swap_data[2]
                 liquidity = swap_data[3]
                 tick = swap_data[4]
+                decode_stage.since(start)
                 
-                _publish(block_number, pool, [sqrtPriceX96, tick, liquidity])
+                _publish(block_number,
+                         pool,
+                         [sqrtPriceX96, tick, liquidity],
+                         event['transactionHash'],
+                         int(event['logIndex'], base=16))
                 
 
+async def stream_uniswap_v2_events(http_rpc_url: str,
+                                   ws_rpc_url: str,
+                                   tokens: Dict[str, List[Any]],
+                                   pools: Union[List[Dict[str, Any]], PoolRegistry],
+                                   event_queue: aioprocessing.AioQueue,
+                                   debug: bool = False,
+                                   state_cache: Optional['StateCache'] = None,
+                                   chain_id: int = 1,
+                                   rpc_client: Optional[RPCClient] = None):
+    """
+    Reserves of the V2 pools (Uniswap V2, Sushiswap): getReserves() of every
+    pool at startup, then one pool_update with reserve0 / reserve1 per Sync log.
+    Parameters as in stream_uniswap_v3_events
+    """
+    client = rpc_client or shared_client(http_rpc_url)
+
+    if not isinstance(pools, PoolRegistry):
+        pools = PoolRegistry.from_pools(pools, tokens)
+    pools = pools.filter(version=2)
+
+    block_number = await client.block_number()
+    calls = [(pool.address, GET_RESERVES, block_number) for pool in pools]
+    if state_cache is not None:
+        results = await state_cache.call_many_async(calls, client, head=block_number)
+    else:
+        results = await asyncio.gather(*[client.eth_call(address, data, block) for address, data, block in calls],
+                                       return_exceptions=True)
+
+    def _publish(block_number: int, pool: Pool, reserve0: int, reserve1: int,
+                 tx_hash: Optional[str] = None, log_index: Optional[int] = None):
+        pool_update = PoolUpdateEvent(
+            block_number,
+            pool.exchange,
+            pool.version,
+            pool.symbol,
+            pool.address,
+            pool.fee,
+            pool.token_idx,
+            pool.decimals,
+            tx_hash=tx_hash,
+            log_index=log_index,
+            reserve0=reserve0,
+            reserve1=reserve1,
+            chain_id=chain_id,
+        )
+        if not debug:
+            event_queue.put(pool_update)
+        else:
+            print(pool_update)
+
+    # initial reserves, so that price can be calculated even if the pool is idle
+    for pool, reserves in zip(pools, results):
+        if isinstance(reserves, bytes) and len(reserves) >= 64:
+            _publish(block_number, pool, int.from_bytes(reserves[:32], 'big'), int.from_bytes(reserves[32:64], 'big'))
+        elif debug:
+            print(f"Error getting reserves for {pool.address}: {reserves}")
+
+    async with websockets.connect(ws_rpc_url) as ws:
+        if debug:
+            print(f"Connecting to WS for Uniswap V2 logs: {ws_rpc_url}")
+        subscription = {
+            'jsonrpc': '2.0',
+            'id': 1,
+            'method': 'eth_subscribe',
+            'params': ['logs', {'address': pools.addresses(), 'topics': [SYNC_V2_TOPIC]}]
+        }
+
+        await ws.send(json.dumps(subscription))
+        ack = await ws.recv()
+        if debug:
+            print(f"Subscribed logs ack: {ack}")
+
+        decode_stage = stage(_stage_name('uniswap_v2.decode', chain_id))
+
+        while True:
+            msg = await asyncio.wait_for(ws.recv(), timeout=60 * 10)
+            start = time.perf_counter_ns()
+            event = json.loads(msg)['params']['result']
+            pool = pools.by_address.get(event['address'].lower())
+
+            if pool is not None:
+                reserve0, reserve1 = decode_sync_v2(event['data'])
+                decode_stage.since(start)
+                _publish(int(event['blockNumber'], base=16),
+                         pool,
+                         reserve0,
+                         reserve1,
+                         event['transactionHash'],
+                         int(event['logIndex'], base=16))
+
+
 if __name__ == '__main__':
     import os
     import nest_asyncio
     from functools import partial
     from dotenv import load_dotenv
     
-    from utils import reconnecting_websocket_loop
+    from utils import RedundantFeed
     
     nest_asyncio.apply()
 
@@ -262,23 +371,40 @@ if __name__ == '__main__':
 
     HTTP_RPC_URL = os.getenv('HTTP_RPC_URL')
     WS_RPC_URL = os.getenv('WS_RPC_URL')
-    
-    new_blocks_stream = reconnecting_websocket_loop(
-        partial(stream_new_blocks, WS_RPC_URL, None, True),
-        tag='new_blocks_stream'
+    # optional comma separated list of WS endpoints to race against each other
+    WS_RPC_URLS = [u for u in os.getenv('WS_RPC_URLS', '').split(',') if u] or [WS_RPC_URL]
+
+    class _Printer:
+        def put(self, event):
+            print(event)
+
+    new_blocks_feed = RedundantFeed('new_blocks', _Printer(), key_fn=dex_event_key, max_avg_lag_ms=500)
+    uniswap_v3_feed = RedundantFeed('uniswap_v3', _Printer(), key_fn=dex_event_key, max_avg_lag_ms=500)
+
+    new_blocks_stream = new_blocks_feed.run(
+        [partial(stream_new_blocks, url) for url in WS_RPC_URLS],
+        names=WS_RPC_URLS,
     )
-    
-    uniswap_v3_stream = reconnecting_websocket_loop(
-        partial(stream_uniswap_v3_events, HTTP_RPC_URL, WS_RPC_URL, TOKENS, POOLS, None, True),
-        tag='uniswap_v3_stream'
+
+    uniswap_v3_stream = uniswap_v3_feed.run(
+        [partial(stream_uniswap_v3_events, HTTP_RPC_URL, url, TOKENS, POOLS) for url in WS_RPC_URLS],
+        names=WS_RPC_URLS,
     )
 
+    async def _report_stats():
+        while True:
+            await asyncio.sleep(60)
+            print(new_blocks_feed.stats())
+            print(uniswap_v3_feed.stats())
+
     loop = asyncio.get_event_loop()
 
     new_blocks_task = loop.create_task(new_blocks_stream)
     uniswap_v3_task = loop.create_task(uniswap_v3_stream)
+    stats_task = loop.create_task(_report_stats())
     
     loop.run_until_complete(asyncio.wait([
         new_blocks_task,
         uniswap_v3_task,
+        stats_task,
     ]))
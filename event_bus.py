@@ -0,0 +1,461 @@
+"""
+Fan-out event bus: every subscriber gets its own bounded queue
+
+Streams publish into the bus exactly as into a single event queue
+(bus.put(event)); each subscriber reads from its own Subscription, which has
+the same coro_get() interface as aioprocessing.AioQueue, so event_handler and
+the other consumers run unchanged. What happens when a subscriber falls
+behind is chosen per subscriber:
+
+    'block'        lossless. async publishers (await bus.publish(event)) wait
+                   for room; the synchronous put() streams use cannot wait
+                   inside the event loop, so it enqueues past maxsize and
+                   counts the overflow instead
+    'drop_oldest'  the oldest queued event is dropped to make room
+    'conflate'     at most one queued event per key (default: chain,
+                   exchange, symbol / pool address); a newer event replaces the queued
+                   one in place, so a slow consumer always gets the latest state.
+                   maxsize is the expected number of keys: a new key past it is
+                   still queued (counted as an overflow), never another key's state
+
+A put() only appends to the subscriber queues and never waits on a consumer,
+so a subscriber that falls behind only loses (drop_oldest) or merges
+(conflate) its own events. That isolates the opportunity path from slow
+subscribers only while they await: in-process subscribers share the event
+loop with the streams and the handler, and nothing else runs while one of
+them executes synchronous or CPU-bound code (rendering a chart, compressing
+and writing a recording). Such subscribers must use subscribe_process:
+coro_get raises once a subscriber has held the loop for more than
+`max_blocking` on one event, and yields to the loop when a run of back to
+back events takes that long. subscribe_process forwards events in batches,
+one inter-process put per batch, and the other process reads them one at a
+time from the returned ProcessQueue.
+
+bus = EventBus()
+opportunities = bus.subscribe('opportunities', policy='block')
+chart = bus.subscribe('chart', policy='conflate', maxsize=64)
+recorder = bus.subscribe('recorder', policy='drop_oldest', maxsize=100_000, types=('orderbook',))
+chart_queue = bus.subscribe_process('chart_process', policy='conflate')   # ProcessQueue for another process
+
+stream_binance_usdm_orderbook(symbols, bus)        # streams publish into the bus
+event_handler(opportunities)                       # consumers read their subscription
+await bus.run()                                    # forwards to cross-process subscribers
+"""
+import time
+import asyncio
+
+from collections import OrderedDict, deque
+from queue import Full
+from typing import Any, Callable, Dict, Hashable, Iterable, List, Optional, Tuple
+
+from events import event_type
+
+
+POLICIES = ('block', 'drop_oldest', 'conflate')
+
+
+def conflation_key(event: Any) -> Tuple:
+    """
+    One slot per book / pool / event type and chain: (type, chain id, exchange, symbol or pool address)
+    """
+    return event_type(event), event.get('chain_id'), event.get('exchange'), event.get('address') or event.get('symbol')
+
+
+class Subscription:
+    """
+    One subscriber's bounded queue. Queued entries carry their enqueue time,
+    so the subscriber's lag (age of the oldest queued event) and the delay
+    of every delivered event are measured
+    """
+
+    def __init__(self,
+                 name: str,
+                 policy: str = 'block',
+                 maxsize: int = 10_000,
+                 key_fn: Callable[[Any], Hashable] = conflation_key,
+                 types: Optional[Iterable[str]] = None,
+                 max_blocking: Optional[float] = 0.02):
+        if policy not in POLICIES:
+            raise ValueError(f'Unknown policy {policy}, expected one of {POLICIES}')
+        self.name = name
+        self.policy = policy
+        self.maxsize = maxsize
+        self.key_fn = key_fn
+        self.types = frozenset(types) if types is not None else None
+        self.max_blocking = max_blocking
+        self.closed = False
+        # 'conflate' keeps key -> (enqueued_at, event), the others (enqueued_at, event)
+        self._queue: Any = OrderedDict() if policy == 'conflate' else deque()
+        self._getter: Optional[asyncio.Future] = None
+        self._space: Optional[asyncio.Event] = None
+        # hand-out time of the last event, and of the first one since the loop last ran
+        self._handed_at = 0.0
+        self._loop_seen: Optional[float] = None
+
+        self.received = 0
+        self.delivered = 0
+        self.dropped = 0
+        self.conflated = 0
+        self.overflows = 0
+        self.max_depth = 0
+        self.delay_sum = 0.0
+        self.delay_max = 0.0
+        self.max_hold = 0.0
+
+    def __len__(self) -> int:
+        return len(self._queue)
+
+    def qsize(self) -> int:
+        return len(self._queue)
+
+    def full(self) -> bool:
+        return len(self._queue) >= self.maxsize
+
+    def wants(self, event: Any) -> bool:
+        return self.types is None or event_type(event) in self.types
+
+    def offer(self, event: Any, now: Optional[float] = None):
+        """
+        Enqueues without waiting, applying the subscriber's policy when full
+        """
+        now = time.monotonic() if now is None else now
+        self.received += 1
+        queue = self._queue
+
+        if self.policy == 'conflate':
+            key = self.key_fn(event)
+            queued = queue.get(key)
+            if queued is not None:
+                # keep the slot's position and first enqueue time, replace the event
+                queue[key] = (queued[0], event)
+                self.conflated += 1
+            else:
+                # evicting another key would lose its only copy of the latest state
+                if len(queue) >= self.maxsize:
+                    self.overflows += 1
+                queue[key] = (now, event)
+        else:
+            if len(queue) >= self.maxsize:
+                if self.policy == 'drop_oldest':
+                    queue.popleft()
+                    self.dropped += 1
+                else:
+                    self.overflows += 1
+            queue.append((now, event))
+
+        if len(queue) > self.max_depth:
+            self.max_depth = len(queue)
+        getter = self._getter
+        if getter is not None and not getter.done():
+            getter.set_result(None)
+
+    async def wait_for_space(self):
+        while self.full() and not self.closed:
+            if self._space is None:
+                self._space = asyncio.Event()
+            self._space.clear()
+            await self._space.wait()
+
+    def _pop(self) -> Any:
+        if self.policy == 'conflate':
+            _, (enqueued_at, event) = self._queue.popitem(last=False)
+        else:
+            enqueued_at, event = self._queue.popleft()
+        delay = time.monotonic() - enqueued_at
+        self.delay_sum += delay
+        if delay > self.delay_max:
+            self.delay_max = delay
+        self.delivered += 1
+        if self._space is not None and len(self._queue) < self.maxsize:
+            self._space.set()
+        return event
+
+    def get_nowait(self) -> Any:
+        if not self._queue:
+            raise asyncio.QueueEmpty
+        return self._pop()
+
+    def _loop_ran(self):
+        self._loop_seen = None
+
+    async def coro_get(self) -> Any:
+        if self._loop_seen is not None:
+            # the loop has not run since the subscriber got its previous event(s)
+            now = time.monotonic()
+            hold = now - self._handed_at
+            if hold > self.max_hold:
+                self.max_hold = hold
+            if self.max_blocking is not None:
+                if hold > self.max_blocking:
+                    raise RuntimeError(f'Subscriber {self.name} held the event loop for {hold * 1000:.1f}ms on one '
+                                       f'event; run synchronous or CPU-bound subscribers with subscribe_process')
+                if now - self._loop_seen > self.max_blocking:
+                    await asyncio.sleep(0)
+        while not self._queue:
+            self._getter = asyncio.get_event_loop().create_future()
+            try:
+                await self._getter
+            finally:
+                self._getter = None
+        event = self._pop()
+        self._handed_at = time.monotonic()
+        if self._loop_seen is None:
+            self._loop_seen = self._handed_at
+            asyncio.get_event_loop().call_soon(self._loop_ran)
+        return event
+
+    get = coro_get
+
+    def lag(self) -> float:
+        """
+        Seconds the oldest queued event has been waiting
+        """
+        if not self._queue:
+            return 0.0
+        if self.policy == 'conflate':
+            enqueued_at = next(iter(self._queue.values()))[0]
+        else:
+            enqueued_at = self._queue[0][0]
+        return time.monotonic() - enqueued_at
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'name': self.name,
+            'policy': self.policy,
+            'depth': len(self._queue),
+            'max_depth': self.max_depth,
+            'maxsize': self.maxsize,
+            'received': self.received,
+            'delivered': self.delivered,
+            'dropped': self.dropped,
+            'conflated': self.conflated,
+            'overflows': self.overflows,
+            'lag': self.lag(),
+            'avg_delay': self.delay_sum / self.delivered if self.delivered else 0.0,
+            'max_delay': self.delay_max,
+            'max_hold': self.max_hold,
+        }
+
+
+class EventBus:
+    """
+    Publishes every event to all subscriptions that want its type
+
+    Drop-in for the single event_queue: streams, MonitoredQueue and
+    RedundantFeed call put(), FeedMonitor reads qsize()
+    """
+
+    def __init__(self):
+        self.subscriptions: Dict[str, Subscription] = {}
+        self.published = 0
+        self._forwarders: List[Tuple[Subscription, Any, int]] = []
+
+    def subscribe(self,
+                  name: str,
+                  policy: str = 'block',
+                  maxsize: int = 10_000,
+                  key_fn: Callable[[Any], Hashable] = conflation_key,
+                  types: Optional[Iterable[str]] = None,
+                  max_blocking: Optional[float] = 0.02) -> Subscription:
+        """
+        :param policy: 'block', 'drop_oldest' or 'conflate', see the module docstring
+        :param key_fn: conflation key of an event, for policy='conflate'
+        :param types: event types to receive, e.g. ('orderbook',); all when None
+        :param max_blocking: seconds the subscriber may hold the event loop on one event
+                             before coro_get raises, None to never check
+        """
+        if name in self.subscriptions:
+            raise ValueError(f'Subscriber {name} already exists')
+        subscription = Subscription(name, policy, maxsize, key_fn, types, max_blocking)
+        self.subscriptions[name] = subscription
+        return subscription
+
+    def subscribe_process(self,
+                          name: str,
+                          policy: str = 'drop_oldest',
+                          maxsize: int = 10_000,
+                          key_fn: Callable[[Any], Hashable] = conflation_key,
+                          types: Optional[Iterable[str]] = None,
+                          queue_size: int = 16,
+                          batch_size: int = 1_000) -> 'ProcessQueue':
+        """
+        Subscriber in another process: returns a ProcessQueue for that
+        process to get() / coro_get() from. run() moves events from the local
+        subscription into it, up to `batch_size` per inter-process put; while
+        the other process is behind, `queue_size` batches wait and the local
+        subscription applies `policy`
+        """
+        import aioprocessing
+
+        subscription = self.subscribe(name, policy, maxsize, key_fn, types, max_blocking=None)
+        queue = aioprocessing.AioQueue(queue_size)
+        self._forwarders.append((subscription, queue, batch_size))
+        return ProcessQueue(queue)
+
+    def unsubscribe(self, name: str):
+        subscription = self.subscriptions.pop(name, None)
+        if subscription is not None:
+            subscription.closed = True
+            if subscription._space is not None:
+                subscription._space.set()
+
+    def put(self, event: Any):
+        now = time.monotonic()
+        self.published += 1
+        for subscription in self.subscriptions.values():
+            if subscription.types is None or event_type(event) in subscription.types:
+                subscription.offer(event, now)
+
+    put_nowait = put
+
+    async def publish(self, event: Any):
+        """
+        put() that first waits for room in every full 'block' subscription
+        """
+        for subscription in list(self.subscriptions.values()):
+            if subscription.policy == 'block' and subscription.wants(event):
+                await subscription.wait_for_space()
+        self.put(event)
+
+    def qsize(self) -> int:
+        """
+        Depth of the most backed-up subscription
+        """
+        return max((len(s) for s in self.subscriptions.values()), default=0)
+
+    async def _forward(self, subscription: Subscription, queue, batch_size: int):
+        while not subscription.closed:
+            batch = [await subscription.coro_get()]
+            while subscription.qsize() and len(batch) < batch_size:
+                batch.append(subscription.get_nowait())
+            try:
+                queue.put_nowait(batch)
+            except Full:
+                # the other process is behind: wait off the loop, new events queue up under the policy
+                await queue.coro_put(batch)
+
+    async def run(self):
+        """
+        Forwards to the cross-process subscribers until cancelled
+        """
+        await asyncio.gather(*[self._forward(*forwarder) for forwarder in self._forwarders])
+
+    def stats(self) -> List[Dict[str, Any]]:
+        return [subscription.stats() for subscription in self.subscriptions.values()]
+
+
+class ProcessQueue:
+    """
+    The other process' end of EventBus.subscribe_process: events arrive in
+    batches and are handed out one at a time, with the coro_get() of
+    aioprocessing.AioQueue for async consumers and get() for blocking ones
+    """
+
+    def __init__(self, queue):
+        self.queue = queue
+        self._events: deque = deque()
+
+    def get(self, timeout: Optional[float] = None) -> Any:
+        while not self._events:
+            self._events.extend(self.queue.get(timeout=timeout))
+        return self._events.popleft()
+
+    async def coro_get(self) -> Any:
+        while not self._events:
+            self._events.extend(await self.queue.coro_get())
+        return self._events.popleft()
+
+
+if __name__ == '__main__':
+    from decimal import Decimal
+    from events import OrderbookEvent
+
+    """
+    A 10k events/s stream into a fast opportunity handler, a chart that
+    blocks for 25ms per event and a recorder that blocks for 0.5s every
+    second, run twice: with the slow subscribers in-process and the
+    max_blocking check switched off (the opportunity delay grows with their
+    blocking work) and with them behind subscribe_process (the opportunity
+    delay stays flat). First, the check stopping the in-process chart
+    """
+
+    def _chart(event):
+        time.sleep(0.025)
+
+    def _recorder(event):
+        if event.update_id % 10_000 == 0:
+            time.sleep(0.5)
+
+    def _blocking_consumer(queue, work):
+        work = {'chart': _chart, 'recorder': _recorder}[work]
+        while True:
+            work(queue.get())
+
+    async def _enforced():
+        bus = EventBus()
+        chart = bus.subscribe('chart', policy='conflate', maxsize=64)
+        for i in range(3):
+            bus.put(OrderbookEvent('binance', f'SYM{i}USDT', 0, i, i - 1, [], []))
+        try:
+            while True:
+                _chart(await chart.coro_get())
+        except RuntimeError as e:
+            print({'in-process blocking chart': str(e), 'delivered': chart.delivered})
+
+    async def _main(isolated: bool):
+        import aioprocessing
+
+        bus = EventBus()
+        opportunities = bus.subscribe('opportunities', policy='block')
+
+        async def _consume(subscription, work):
+            while True:
+                work(await subscription.coro_get())
+
+        async def _stream(rate, duration):
+            # publishes every event due by now on each wake-up, so a blocked loop delivers them in a burst
+            n = int(rate * duration)
+            start = time.monotonic()
+            i = 0
+            while i < n:
+                due = min(n, int((time.monotonic() - start) * rate) + 1)
+                for i in range(i, due):
+                    symbol = ('ETHUSDT', 'BTCUSDT')[i % 2]
+                    bus.put(OrderbookEvent(('binance', 'okx')[i % 4 // 2], symbol, int(time.time() * 1000), i, i - 1,
+                                           [[Decimal('2000.1'), Decimal('1')]], [[Decimal('2000.2'), Decimal('1')]]))
+                i = due
+                await asyncio.sleep(max(0.0, start + i / rate - time.monotonic()))
+
+        tasks = [asyncio.ensure_future(_consume(opportunities, lambda event: None))]
+        processes = []
+        if isolated:
+            # the chart process takes one event at a time so its subscription keeps conflating to the latest
+            for name, policy, maxsize, queue_size in (('chart', 'conflate', 64, 1),
+                                                      ('recorder', 'drop_oldest', 2_000, 16)):
+                queue = bus.subscribe_process(name, policy=policy, maxsize=maxsize, queue_size=queue_size)
+                process = aioprocessing.AioProcess(target=_blocking_consumer, args=(queue, name), daemon=True)
+                process.start()
+                processes.append(process)
+            tasks.append(asyncio.ensure_future(bus.run()))
+        else:
+            chart = bus.subscribe('chart', policy='conflate', maxsize=64, max_blocking=None)
+            recorder = bus.subscribe('recorder', policy='drop_oldest', maxsize=2_000, max_blocking=None)
+            tasks += [asyncio.ensure_future(_consume(chart, _chart)),
+                      asyncio.ensure_future(_consume(recorder, _recorder))]
+        await _stream(rate=10_000, duration=3)
+        await asyncio.sleep(0.1)
+        for task in tasks:
+            task.cancel()
+        if processes:
+            # let the consumers take the puts already in flight before stopping them
+            await asyncio.sleep(1)
+        for process in processes:
+            process.terminate()
+
+        for stats in bus.stats():
+            print({'subscribers': 'subscribe_process' if isolated else 'in-process',
+                   **{k: round(v * 1000, 3) if k in ('lag', 'avg_delay', 'max_delay', 'max_hold') else v for k, v in stats.items()}})
+
+    asyncio.run(_enforced())
+    asyncio.run(_main(isolated=False))
+    asyncio.run(_main(isolated=True))
@@ -0,0 +1,509 @@
+"""
+Typed events for everything that goes through the event queue
+
+Each event type is a __slots__ class instead of a dict with repeated string
+keys. The classes keep the read side of the dict interface (event['bids'],
+event.get('tick'), 'reserve0' in event), so handlers written against the dicts
+work unchanged, while new code can use attributes and dispatch on the class.
+
+Orderbook events, the bulk of the traffic, pickle through a struct codec:
+exchange and symbol go as ids from the interners below (names are only
+written out when they are not part of the seeded tables, so ids never have
+to agree between processes), update ids and the timestamp as int64 and the
+price levels as one ascii string. Other events pickle as a bare tuple of
+their fields.
+
+book = OrderbookEvent('binance', 'ETHUSDT', timestamp, update_id, prev_update_id, bids, asks)
+dispatcher = Dispatcher()
+dispatcher.register('orderbook', on_orderbook)
+dispatcher(book)
+"""
+import sys
+import struct
+
+from decimal import Decimal
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+
+class Interner:
+    """
+    Two-way map between names and small integer ids. Names in `seed` have the
+    same id in every process, names added later are local to the process
+    """
+
+    def __init__(self, seed: Tuple[str, ...] = ()):
+        self.ids: Dict[str, int] = {}
+        self.names: List[str] = []
+        for name in seed:
+            self.intern(name)
+        self.seeded = len(self.names)
+
+    def intern(self, name: str) -> int:
+        id_ = self.ids.get(name)
+        if id_ is None:
+            id_ = len(self.names)
+            name = sys.intern(name)
+            self.ids[name] = id_
+            self.names.append(name)
+        return id_
+
+    def name(self, id_: int) -> str:
+        return self.names[id_]
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+
+EXCHANGES = Interner(('binance', 'okx', 'connex', 'uniswap', 'sushiswap', 'pancakeswap', 'curve', '1inch'))
+SYMBOLS = Interner(('ETHUSDT', 'BTCUSDT', 'ETH/USDT', 'BTC/USDT', 'ETH/USDC', 'BTC/USDC', 'USDC/USDT'))
+
+
+def _intern(name: Optional[str]) -> Optional[str]:
+    return sys.intern(name) if type(name) is str else name
+
+
+class Event:
+    """
+    Base of the typed events: read-only dict view over the slots, plus the
+    class-level `source` / `type` every event has
+    """
+
+    __slots__ = ()
+    source: str = ''
+    type: str = ''
+    _slots: Tuple[str, ...] = ()
+    _fields: Tuple[str, ...] = ()
+    _field_set: frozenset = frozenset()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        slots = ()
+        for klass in reversed(cls.__mro__):
+            slots += klass.__dict__.get('__slots__', ())
+        cls._slots = slots
+        cls._fields = tuple(f for f in ('source', 'type') if f not in slots) + slots
+        cls._field_set = frozenset(cls._fields)
+
+    def __getitem__(self, key: str) -> Any:
+        if key in self._field_set:
+            return getattr(self, key)
+        raise KeyError(key)
+
+    def get(self, key: str, default: Any = None) -> Any:
+        if key in self._field_set:
+            return getattr(self, key)
+        return default
+
+    def __contains__(self, key: str) -> bool:
+        """
+        Like a dict that only has the keys that were set: None fields are absent
+        """
+        return key in self._field_set and getattr(self, key) is not None
+
+    def keys(self) -> Iterator[str]:
+        return (k for k in self._fields if getattr(self, k) is not None)
+
+    def items(self) -> Iterator[Tuple[str, Any]]:
+        return ((k, getattr(self, k)) for k in self.keys())
+
+    def __iter__(self) -> Iterator[str]:
+        return self.keys()
+
+    def to_dict(self) -> Dict[str, Any]:
+        return dict(self.items())
+
+    def __eq__(self, other: Any) -> bool:
+        if isinstance(other, Event):
+            return self.__class__ is other.__class__ and self._values() == other._values()
+        if isinstance(other, dict):
+            return self.to_dict() == other
+        return NotImplemented
+
+    __hash__ = None
+
+    def _values(self) -> Tuple[Any, ...]:
+        return tuple(getattr(self, k) for k in self._slots)
+
+    def __reduce__(self):
+        # every __init__ takes its slots positionally, in slot order
+        return self.__class__, self._values()
+
+    def __repr__(self) -> str:
+        return repr(self.to_dict())
+
+
+class OrderbookEvent(Event):
+    __slots__ = ('exchange', 'symbol', 'timestamp', 'update_id', 'prev_update_id', 'bids', 'asks')
+    source = 'cex'
+    type = 'orderbook'
+
+    def __init__(self,
+                 exchange: str,
+                 symbol: str,
+                 timestamp: Optional[int],
+                 update_id: Optional[int],
+                 prev_update_id: Optional[int],
+                 bids: List[List[Any]],
+                 asks: List[List[Any]]):
+        self.exchange = _intern(exchange)
+        self.symbol = _intern(symbol)
+        self.timestamp = timestamp
+        self.update_id = update_id
+        self.prev_update_id = prev_update_id
+        self.bids = bids
+        self.asks = asks
+
+    @property
+    def exchange_id(self) -> int:
+        return EXCHANGES.intern(self.exchange)
+
+    @property
+    def symbol_id(self) -> int:
+        return SYMBOLS.intern(self.symbol)
+
+    def __reduce__(self):
+        # float levels already pickle compactly, the codec pays off on Decimals;
+        # ids that do not fit int64 (or are not ints at all) also go as they are
+        levels = self.bids or self.asks
+        if (levels and type(levels[0][0]) is float) \
+                or not all(v is None or type(v) is int for v in (self.timestamp, self.update_id, self.prev_update_id)):
+            return OrderbookEvent, self._values()
+        try:
+            return _decode_orderbook, (encode_orderbook(self),)
+        except struct.error:
+            return OrderbookEvent, self._values()
+
+
+class BlockEvent(Event):
+    __slots__ = ('block_number', 'block_hash', 'timestamp', 'base_fee', 'next_base_fee', 'chain_id')
+    source = 'dex'
+    type = 'block'
+
+    def __init__(self,
+                 block_number: int,
+                 block_hash: Optional[str] = None,
+                 timestamp: Optional[int] = None,
+                 base_fee: Optional[float] = None,
+                 next_base_fee: Optional[float] = None,
+                 chain_id: int = 1):
+        self.block_number = block_number
+        self.block_hash = block_hash
+        self.timestamp = timestamp
+        self.base_fee = base_fee
+        self.next_base_fee = next_base_fee
+        self.chain_id = chain_id
+
+
+class PoolUpdateEvent(Event):
+    """
+    V3 pools fill sqrtPriceX96 / tick / liquidity, V2 pools reserve0 / reserve1
+    """
+
+    __slots__ = ('block_number', 'exchange', 'version', 'symbol', 'address', 'fee', 'token_idx', 'decimals',
+                 'tx_hash', 'log_index', 'sqrtPriceX96', 'tick', 'liquidity', 'reserve0', 'reserve1', 'chain_id')
+    source = 'dex'
+    type = 'pool_update'
+
+    def __init__(self,
+                 block_number: int,
+                 exchange: str,
+                 version: int,
+                 symbol: str,
+                 address: str,
+                 fee: int,
+                 token_idx: Any,
+                 decimals: Any,
+                 tx_hash: Optional[str] = None,
+                 log_index: Optional[int] = None,
+                 sqrtPriceX96: Optional[int] = None,
+                 tick: Optional[int] = None,
+                 liquidity: Optional[int] = None,
+                 reserve0: Optional[int] = None,
+                 reserve1: Optional[int] = None,
+                 chain_id: int = 1):
+        self.block_number = block_number
+        self.exchange = _intern(exchange)
+        self.version = version
+        self.symbol = _intern(symbol)
+        self.address = address
+        self.fee = fee
+        self.token_idx = token_idx
+        self.decimals = decimals
+        self.tx_hash = tx_hash
+        self.log_index = log_index
+        self.sqrtPriceX96 = sqrtPriceX96
+        self.tick = tick
+        self.liquidity = liquidity
+        self.reserve0 = reserve0
+        self.reserve1 = reserve1
+        self.chain_id = chain_id
+
+
+class PredictedPoolUpdateEvent(PoolUpdateEvent):
+    """
+    A pool state after pending swaps, `pending_count` of them applied so far
+    """
+
+    __slots__ = ('pending_count',)
+    type = 'predicted_pool_update'
+
+    def __init__(self, *args, pending_count: int = 0, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.pending_count = pending_count
+
+    def __reduce__(self):
+        return _restore, (self.__class__, self._values())
+
+
+class OrderEvent(Event):
+    """
+    1inch limit order fills (type 'order_filled') and cancels ('order_cancel')
+    """
+
+    __slots__ = ('type', 'block_number', 'exchange', 'maker', 'order_hash', 'remaining')
+    source = 'dex'
+
+    def __init__(self,
+                 type: str,
+                 block_number: int,
+                 exchange: str,
+                 maker: str,
+                 order_hash: str,
+                 remaining: int):
+        self.type = type
+        self.block_number = block_number
+        self.exchange = exchange
+        self.maker = maker
+        self.order_hash = order_hash
+        self.remaining = remaining
+
+
+def _restore(cls, values: Tuple[Any, ...]) -> Event:
+    event = cls.__new__(cls)
+    for name, value in zip(cls._slots, values):
+        setattr(event, name, value)
+    return event
+
+
+"""
+Orderbook codec
+
+header: exchange id, symbol id, flags, timestamp, update_id, prev_update_id,
+        level counts, name tail length
+then:   exchange / symbol names for ids outside the seeded tables, then the
+        levels as 'price qty price qty ...' (Decimal) or packed doubles (float)
+"""
+_HEADER = struct.Struct('<HHBqqqHHH')
+_NONE = -2 ** 63
+_LOCAL = 0xFFFF
+_FLOAT_LEVELS = 1
+
+
+def encode_orderbook(event: OrderbookEvent) -> bytes:
+    exchange_id = EXCHANGES.intern(event.exchange)
+    symbol_id = SYMBOLS.intern(event.symbol)
+    names = b''
+    if exchange_id >= EXCHANGES.seeded or symbol_id >= SYMBOLS.seeded:
+        names = f'{event.exchange}\n{event.symbol}'.encode()
+        exchange_id = symbol_id = _LOCAL
+
+    levels = event.bids + event.asks
+    flags = 0
+    if levels and type(levels[0][0]) is float:
+        flags |= _FLOAT_LEVELS
+        body = struct.pack(f'<{2 * len(levels)}d', *[v for level in levels for v in level[:2]])
+    else:
+        body = ' '.join([f'{level[0]} {level[1]}' for level in levels]).encode()
+
+    header = _HEADER.pack(exchange_id, symbol_id, flags,
+                          _NONE if event.timestamp is None else int(event.timestamp),
+                          _NONE if event.update_id is None else int(event.update_id),
+                          _NONE if event.prev_update_id is None else int(event.prev_update_id),
+                          len(event.bids), len(event.asks), len(names))
+    return header + names + body
+
+
+def decode_orderbook(buffer: bytes) -> OrderbookEvent:
+    exchange_id, symbol_id, flags, timestamp, update_id, prev_update_id, n_bids, n_asks, n_names = \
+        _HEADER.unpack_from(buffer)
+    offset = _HEADER.size
+    if exchange_id == _LOCAL:
+        exchange, symbol = buffer[offset:offset + n_names].decode().split('\n')
+        offset += n_names
+    else:
+        exchange, symbol = EXCHANGES.names[exchange_id], SYMBOLS.names[symbol_id]
+
+    if flags & _FLOAT_LEVELS:
+        values = struct.unpack_from(f'<{2 * (n_bids + n_asks)}d', buffer, offset)
+    else:
+        values = list(map(Decimal, buffer[offset:].decode().split())) if n_bids + n_asks else []
+    levels = [[values[i], values[i + 1]] for i in range(0, len(values), 2)]
+
+    event = OrderbookEvent.__new__(OrderbookEvent)
+    event.exchange = exchange
+    event.symbol = symbol
+    event.timestamp = None if timestamp == _NONE else timestamp
+    event.update_id = None if update_id == _NONE else update_id
+    event.prev_update_id = None if prev_update_id == _NONE else prev_update_id
+    event.bids = levels[:n_bids]
+    event.asks = levels[n_bids:]
+    return event
+
+
+_decode_orderbook = decode_orderbook
+
+
+_POOL_FIELDS = ('block_number', 'exchange', 'version', 'symbol', 'address', 'fee', 'token_idx', 'decimals')
+
+
+def from_dict(event: Dict[str, Any]) -> Any:
+    """
+    The typed event for a dict event; dicts of unknown types are returned as they are
+    """
+    etype = event.get('type')
+    if etype == 'orderbook':
+        return OrderbookEvent(event['exchange'], event['symbol'], event.get('timestamp'),
+                              event.get('update_id'), event.get('prev_update_id'),
+                              event['bids'], event['asks'])
+    if etype == 'block':
+        return BlockEvent(event['block_number'], event.get('block_hash'), event.get('timestamp'),
+                          event.get('base_fee'), event.get('next_base_fee'), event.get('chain_id', 1))
+    if etype in ('pool_update', 'predicted_pool_update'):
+        cls = PoolUpdateEvent if etype == 'pool_update' else PredictedPoolUpdateEvent
+        extra = {k: v for k, v in event.items()
+                 if k in cls._slots and k not in _POOL_FIELDS}
+        return cls(*[event[k] for k in _POOL_FIELDS], **extra)
+    if etype in ('order_filled', 'order_cancel'):
+        return OrderEvent(etype, event['block_number'], event['exchange'], event['maker'],
+                          event['order_hash'], event['remaining'])
+    return event
+
+
+def event_type(event: Any) -> Optional[str]:
+    return event.get('type') if event.__class__ is dict else event.type
+
+
+class Dispatcher:
+    """
+    Calls the handler registered for an event's type name. Works on typed
+    events and dicts alike; events with no handler go to `default`
+    """
+
+    def __init__(self, default: Optional[Callable[[Any], Any]] = None):
+        self.handlers: Dict[str, Callable[[Any], Any]] = {}
+        self.default = default
+
+    def register(self, etype: str, handler: Callable[[Any], Any]):
+        self.handlers[etype] = handler
+
+    def __call__(self, event: Any) -> Any:
+        handler = self.handlers.get(event.get('type') if event.__class__ is dict else event.type, self.default)
+        if handler is not None:
+            return handler(event)
+
+
+if __name__ == '__main__':
+    import time
+    import pickle
+    import random
+
+    """
+    Bytes per event, pickle round trip and dispatch cost of the typed events
+    against the dicts they replace
+    """
+    random.seed(0)
+
+    def _book(exchange='binance'):
+        mid = 2000 + random.random()
+        return {
+            'source': 'cex', 'type': 'orderbook', 'exchange': exchange, 'symbol': 'ETHUSDT',
+            'timestamp': 1_700_000_000_000 + random.randrange(10 ** 6),
+            'update_id': random.randrange(10 ** 12), 'prev_update_id': random.randrange(10 ** 12),
+            'bids': [[Decimal(f'{mid - i * 0.01:.2f}'), Decimal(f'{random.random() * 50:.3f}')] for i in range(5)],
+            'asks': [[Decimal(f'{mid + i * 0.01:.2f}'), Decimal(f'{random.random() * 50:.3f}')] for i in range(5)],
+        }
+
+    def _pool():
+        return {
+            'source': 'dex', 'type': 'pool_update', 'block_number': 18_000_000, 'tx_hash': '0x' + '12' * 32,
+            'log_index': 7, 'exchange': 'uniswap', 'version': 3, 'symbol': 'ETH/USDT',
+            'address': '0x11b815efb8f581194ae79006d24e0d814b7697f6', 'fee': 500, 'token_idx': {'ETH': 0, 'USDT': 1},
+            'decimals': [18, 6], 'sqrtPriceX96': 3543191142285914205922034323214 + random.randrange(10 ** 20),
+            'tick': -197000, 'liquidity': 12_000_000_000_000_000_000, 'chain_id': 1,
+        }
+
+    def _block():
+        return {'source': 'dex', 'type': 'block', 'block_number': 18_000_000, 'block_hash': '0x' + 'ab' * 32,
+                'timestamp': 1_700_000_000_000, 'base_fee': 2.1e-08, 'next_base_fee': 2.3e-08,
+                'chain_id': 1}
+
+    samples = {
+        'orderbook (5 levels)': [_book() for _ in range(2000)],
+        'orderbook (float levels)': [{**b, 'bids': [[float(p), float(q)] for p, q in b['bids']],
+                                      'asks': [[float(p), float(q)] for p, q in b['asks']]}
+                                     for b in (_book() for _ in range(2000))],
+        'pool_update': [_pool() for _ in range(2000)],
+        'block': [_block() for _ in range(2000)],
+    }
+
+    print(f'{"event":<26}{"dict B":>8}{"typed B":>9}{"dict us":>9}{"typed us":>10}  (pickle + unpickle)')
+    for name, dicts in samples.items():
+        typed = [from_dict(d) for d in dicts]
+        for d, t in zip(dicts, typed):
+            assert pickle.loads(pickle.dumps(t)) == t and t == d, name
+        sizes, times = [], []
+        for events in (dicts, typed):
+            blobs = [pickle.dumps(e, protocol=pickle.HIGHEST_PROTOCOL) for e in events]
+            sizes.append(sum(map(len, blobs)) / len(blobs))
+            s = time.perf_counter()
+            for _ in range(5):
+                for e in events:
+                    pickle.loads(pickle.dumps(e, protocol=pickle.HIGHEST_PROTOCOL))
+            times.append((time.perf_counter() - s) / (5 * len(events)) * 1e6)
+        print(f'{name:<26}{sizes[0]:>8.0f}{sizes[1]:>9.0f}{times[0]:>9.2f}{times[1]:>10.2f}')
+
+    # dispatch: the handler's source / type if-chain on dicts vs Dispatcher on typed events
+    mixed = [e for events in samples.values() for e in events]
+    random.shuffle(mixed)
+    typed = [from_dict(e) for e in mixed]
+    counts = dict.fromkeys(('orderbook', 'block', 'pool_update'), 0)
+
+    def _count(kind):
+        def _handler(event):
+            counts[kind] += 1
+        return _handler
+
+    on_book, on_block, on_pool = _count('orderbook'), _count('block'), _count('pool_update')
+
+    def _if_chain(data):
+        source = data.get('source')
+        if source == 'cex':
+            on_book(data)
+        elif source == 'dex':
+            etype = data.get('type')
+            if etype == 'block':
+                on_block(data)
+            elif etype == 'pool_update':
+                on_pool(data)
+
+    dispatcher = Dispatcher()
+    dispatcher.register('orderbook', on_book)
+    dispatcher.register('block', on_block)
+    dispatcher.register('pool_update', on_pool)
+
+    handlers = dispatcher.handlers
+
+    def _table(event):
+        handler = handlers.get(event.type)
+        if handler is not None:
+            handler(event)
+
+    for label, fn, events in (('if-chain on dicts', _if_chain, mixed),
+                              ('Dispatcher on dicts', dispatcher, mixed),
+                              ('Dispatcher on typed', dispatcher, typed),
+                              ('type table on typed', _table, typed)):
+        s = time.perf_counter()
+        for _ in range(20):
+            for e in events:
+                fn(e)
+        print(f'{label:<26}{(time.perf_counter() - s) / (20 * len(events)) * 1e9:>8.0f} ns/event')
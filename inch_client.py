@@ -0,0 +1,325 @@
+"""
+Async 1inch API client with a block-keyed quote cache
+
+Every response is cached under (endpoint, chain, tokens, amount bucket, block
+number of that chain) in an LRU and dropped when a newer block of the chain
+arrives, so repeated research queries within a block cost no network call.
+Chains whose blocks are not followed fall back to a max_age in seconds.
+Concurrent identical requests share one in-flight call, and all calls go
+through a token bucket sized to the API plan's rate limit; 429s are retried
+after Retry-After.
+
+client = InchClient(api_key, rate=1.0)
+client.on_block(block_number, chain_id=1)   # or client.put(event) as a stream's event_queue
+quote = await client.get_quote('ethereum', WETH, USDT, 10 ** 18)
+book = await client.get_limit_orderbook('ETH/USDT', tokens, decimals, depth=20)
+"""
+import os
+import time
+import asyncio
+import aiohttp
+
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+from constants import CHAINS
+from utils import backoff_delay
+
+
+CHAIN_ID = {name: chain['chain_id'] for name, chain in CHAINS.items()}
+
+
+def amount_bucket(amount: int, precision: int = 3) -> int:
+    """
+    Rounds an amount to `precision` significant digits, so nearby sizes share
+    one cached quote: 1_234_567 -> 1_230_000
+    """
+    if amount <= 0 or precision is None:
+        return amount
+    scale = 10 ** max(len(str(amount)) - precision, 0)
+    return amount // scale * scale
+
+
+def build_limit_orderbook(bids_orderbook: List[Dict[str, Any]],
+                          asks_orderbook: List[Dict[str, Any]],
+                          tokens: Dict[str, str],
+                          decimals: Dict[str, int]) -> Dict[str, List[Dict[str, Any]]]:
+    """
+    bids / asks of {'price', 'quantity', 'created'} from the two sides'
+    /orderbook/v3.0/{chain}/all responses
+    """
+    _decimals = {tokens[k].lower(): v for k, v in decimals.items()}
+
+    def _levels(orders, bid: bool):
+        levels = []
+        for o in orders:
+            selling_decimals = _decimals[o['data']['makerAsset'].lower()]
+            buying_decimals = _decimals[o['data']['takerAsset'].lower()]
+            selling_amount = float(int(o['data']['makingAmount'])) / 10 ** selling_decimals
+            buying_amount = float(int(o['data']['takingAmount'])) / 10 ** buying_decimals
+            levels.append({
+                'price': selling_amount / buying_amount if bid else buying_amount / selling_amount,
+                'quantity': int(o['remainingMakerAmount']) / 10 ** selling_decimals,
+                'created': o['createDateTime'],
+            })
+        return levels
+
+    return {'bids': _levels(bids_orderbook, True), 'asks': _levels(asks_orderbook, False)}
+
+
+class RateLimiter:
+    """
+    Token bucket: `rate` requests per second on average, up to `burst` at once
+    """
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class InchClient:
+
+    def __init__(self,
+                 api_key: Optional[str] = None,
+                 base_url: str = 'https://api.1inch.dev',
+                 rate: float = 1.0,
+                 burst: int = 1,
+                 cache_size: int = 4096,
+                 amount_precision: Optional[int] = 3,
+                 max_retries: int = 3,
+                 max_age: float = 12.0):
+        """
+        :param rate: requests per second allowed by the API plan (1 rps on the free tier)
+        :param amount_precision: significant digits quote amounts are bucketed to,
+                                 None to quote exact amounts
+        :param max_age: seconds a response stays cached for a chain no block has
+                        been seen of yet (on_block / put never called for it)
+        """
+        self.api_key = api_key or os.getenv('1INCH_API')
+        self.base_url = base_url.rstrip('/')
+        self.limiter = RateLimiter(rate, burst)
+        self.cache_size = cache_size
+        self.amount_precision = amount_precision
+        self.max_retries = max_retries
+        self.max_age = max_age
+        # chain id -> latest block number seen of that chain
+        self.block_numbers: Dict[int, int] = {}
+        # key -> (response, monotonic time it was stored)
+        self.cache: 'OrderedDict[Tuple, Tuple[Any, float]]' = OrderedDict()
+        self._inflight: Dict[Tuple, asyncio.Future] = {}
+        self._session: Optional[aiohttp.ClientSession] = None
+        self.stats = {'hits': 0, 'misses': 0, 'coalesced': 0, 'requests': 0, 'retries': 0, 'invalidated': 0}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    @property
+    def block_number(self) -> Optional[int]:
+        """
+        Latest mainnet block seen
+        """
+        return self.block_numbers.get(1)
+
+    def on_block(self, block_number: int, chain_id: int = 1):
+        """
+        Moves the chain's cache to a new block: everything cached for older
+        blocks of that chain is dropped
+        """
+        last = self.block_numbers.get(chain_id)
+        if last is not None and block_number <= last:
+            return
+        self.block_numbers[chain_id] = block_number
+        # keys are (endpoint, chain_id, ..., block number)
+        stale = [key for key in self.cache if key[1] == chain_id and key[-1] != block_number]
+        for key in stale:
+            del self.cache[key]
+        self.stats['invalidated'] += len(stale)
+
+    def put(self, event: Dict[str, Any]):
+        """
+        event_queue interface, so stream_new_blocks of any chain (chains.Chain
+        tags its blocks) can drive invalidation directly
+        """
+        if event.get('type') == 'block':
+            self.on_block(event['block_number'], event.get('chain_id', 1))
+
+    def _headers(self) -> Dict[str, str]:
+        return {'accept': 'application/json', 'Authorization': f'Bearer {self.api_key}'}
+
+    async def _fetch(self, method: str, path: str, **kwargs) -> Any:
+        if self._session is None:
+            self._session = aiohttp.ClientSession(headers=self._headers())
+
+        for attempt in range(self.max_retries + 1):
+            await self.limiter.acquire()
+            self.stats['requests'] += 1
+            async with self._session.request(method, self.base_url + path,
+                                             timeout=aiohttp.ClientTimeout(total=10), **kwargs) as res:
+                if res.status == 429 and attempt < self.max_retries:
+                    self.stats['retries'] += 1
+                    retry_after = res.headers.get('Retry-After')
+                    await asyncio.sleep(float(retry_after) if retry_after else backoff_delay(attempt, 1.0))
+                    continue
+                res.raise_for_status()
+                return await res.json()
+
+    async def _cached(self, key: Tuple, method: str, path: str, **kwargs) -> Any:
+        """
+        :param key: (endpoint, chain_id, ...), the chain's block number is appended
+        """
+        key = key + (self.block_numbers.get(key[1]),)
+        cached = self.cache.get(key)
+        if cached is not None:
+            # entries of chains without blocks expire by age instead
+            if key[-1] is not None or time.monotonic() - cached[1] < self.max_age:
+                self.cache.move_to_end(key)
+                self.stats['hits'] += 1
+                return cached[0]
+            del self.cache[key]
+            self.stats['invalidated'] += 1
+
+        task = self._inflight.get(key)
+        if task is not None:
+            self.stats['coalesced'] += 1
+        else:
+            self.stats['misses'] += 1
+            # a task of its own, so a caller being cancelled does not cancel the call for the others
+            task = self._inflight[key] = asyncio.ensure_future(self._fetch_into_cache(key, method, path, **kwargs))
+            # retrieved here so a failure every caller gave up on is not reported as unhandled
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())
+        return await asyncio.shield(task)
+
+    async def _fetch_into_cache(self, key: Tuple, method: str, path: str, **kwargs) -> Any:
+        try:
+            result = await self._fetch(method, path, **kwargs)
+        finally:
+            del self._inflight[key]
+        # a block may have arrived while the request was in flight
+        if key[-1] == self.block_numbers.get(key[1]):
+            self.cache[key] = (result, time.monotonic())
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return result
+
+    async def get_quote(self, chain: str, token_in: str, token_out: str, amount_in: int) -> Dict[str, Any]:
+        """
+        /swap quote for amount_in rounded to the client's amount bucket
+        """
+        chain_id = CHAIN_ID[chain]
+        amount = amount_bucket(int(amount_in), self.amount_precision)
+        token_in, token_out = token_in.lower(), token_out.lower()
+        return await self._cached(('quote', chain_id, token_in, token_out, amount),
+                                  'GET', f'/swap/v5.2/{chain_id}/quote',
+                                  params={'src': token_in, 'dst': token_out, 'amount': str(amount)})
+
+    async def get_spot_price(self, tokens: List[str], chain: str = 'ethereum') -> Dict[str, Any]:
+        chain_id = CHAIN_ID[chain]
+        tokens = sorted(token.lower() for token in tokens)
+        return await self._cached(('price', chain_id, tuple(tokens)),
+                                  'POST', f'/price/v1.1/{chain_id}', json={'tokens': tokens})
+
+    async def get_orderbook(self, buy_token: str, sell_token: str, depth: int, chain: str = 'ethereum') -> List[Dict[str, Any]]:
+        chain_id = CHAIN_ID[chain]
+        buy_token, sell_token = buy_token.lower(), sell_token.lower()
+        return await self._cached(('orderbook', chain_id, buy_token, sell_token, depth),
+                                  'GET', f'/orderbook/v3.0/{chain_id}/all',
+                                  params={'limit': depth, 'sortBy': 'takerRate',
+                                          'makerAsset': buy_token, 'takerAsset': sell_token})
+
+    async def get_limit_orderbook(self,
+                                  symbol: str,
+                                  tokens: Dict[str, str],
+                                  decimals: Dict[str, int],
+                                  depth: int = 20,
+                                  chain: str = 'ethereum') -> Dict[str, List[Dict[str, Any]]]:
+        base, quote = symbol.split('/')
+        bids_orderbook, asks_orderbook = await asyncio.gather(
+            self.get_orderbook(tokens[quote], tokens[base], depth, chain),
+            self.get_orderbook(tokens[base], tokens[quote], depth, chain),
+        )
+        return build_limit_orderbook(bids_orderbook, asks_orderbook, tokens, decimals)
+
+
+if __name__ == '__main__':
+    from aiohttp import web
+
+    """
+    Runs against a local stand-in of the quote endpoint: 50 concurrent
+    identical requests, 200 repeats, then a new block; then a first caller
+    timing out while others wait on the same call, an Arbitrum block that
+    leaves mainnet quotes cached, and a chain without blocks expiring by age
+    """
+    served = []
+
+    async def _quote(request):
+        served.append(request.query['amount'])
+        await asyncio.sleep(0.05)
+        return web.json_response({'dstAmount': str(int(request.query['amount']) * 2000 // 10 ** 12)})
+
+    async def _main():
+        app = web.Application()
+        app.router.add_get('/swap/v5.2/1/quote', _quote)
+        app.router.add_get('/swap/v5.2/42161/quote', _quote)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, 'localhost', 8780).start()
+
+        WETH = '0xC02aaA39b223FE8D0A0e5C4F27eAD9083C756Cc2'
+        USDT = '0xdAC17F958D2ee523a2206206994597C13D831ec7'
+
+        async with InchClient('test', base_url='http://localhost:8780', rate=5) as client:
+            client.on_block(18_000_000)
+            s = time.perf_counter()
+            await asyncio.gather(*[client.get_quote('ethereum', WETH, USDT, 10 ** 18) for _ in range(50)])
+            for i in range(200):
+                await client.get_quote('ethereum', WETH, USDT, 10 ** 18 + i)  # same bucket
+            print(f'250 quotes in {time.perf_counter() - s:.3f}s, {len(served)} HTTP call(s)', client.stats)
+
+            client.put({'type': 'block', 'block_number': 18_000_001})
+            await client.get_quote('ethereum', WETH, USDT, 10 ** 18)
+            print(f'after a new block: {len(served)} HTTP calls', client.stats)
+
+            impatient = asyncio.ensure_future(asyncio.wait_for(client.get_quote('ethereum', WETH, USDT, 2 * 10 ** 18), 0.01))
+            await asyncio.sleep(0)
+            patient = asyncio.ensure_future(client.get_quote('ethereum', WETH, USDT, 2 * 10 ** 18))
+            results = await asyncio.gather(impatient, patient, return_exceptions=True)
+            print({'first_caller': type(results[0]).__name__, 'second_caller': results[1]})
+
+            client.max_age = 0.1
+            calls = len(served)
+            await client.get_quote('arbitrum', WETH, USDT, 10 ** 18)
+            await client.get_quote('arbitrum', WETH, USDT, 10 ** 18)
+            await asyncio.sleep(0.15)
+            await client.get_quote('arbitrum', WETH, USDT, 10 ** 18)
+            print(f'no Arbitrum blocks: {len(served) - calls} HTTP calls for 3 quotes with max_age=0.1s around a 0.15s pause')
+
+            client.put({'type': 'block', 'block_number': 200_000_000, 'chain_id': 42161})
+            calls = len(served)
+            await client.get_quote('ethereum', WETH, USDT, 10 ** 18)
+            print(f'after an Arbitrum block: {len(served) - calls} HTTP calls for a cached mainnet quote')
+
+        await runner.cleanup()
+
+    asyncio.run(_main())
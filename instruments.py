@@ -0,0 +1,242 @@
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from constants import FEE
+from pool_registry import PoolRegistry
+
+Q96 = 2 ** 96
+
+# Quote currency priority: in a pair, the asset listed first here is the quote
+QUOTES = ('USD', 'USDT', 'USDC', 'DAI', 'ETH', 'BTC')
+
+# Assets treated as the same currency when matching CEX symbols to pools
+ALIASES = {
+    'USDT': 'USD',
+    'USDC': 'USD',
+    'WETH': 'ETH',
+}
+
+
+class Instrument:
+    """
+    A CEX symbol or a DEX pool, mapped to its canonical (base, quote) pair
+
+    `inverted` is True when the venue quotes quote/base, e.g. the USDC/ETH V3
+    pool prices ETH per USDC, so its price has to be flipped to get ETH/USD
+    """
+
+    __slots__ = ('source', 'venue', 'symbol', 'key', 'pair', 'inverted', 'fee', 'scale', 'bid', 'ask')
+
+    def __init__(self,
+                 source: str,
+                 venue: str,
+                 symbol: str,
+                 key: str,
+                 pair: Tuple[str, str],
+                 inverted: bool,
+                 fee: float,
+                 scale: float = 1.0):
+        self.source = source
+        self.venue = venue
+        self.symbol = symbol
+        self.key = key
+        self.pair = pair
+        self.inverted = inverted
+        self.fee = fee
+        self.scale = scale
+        self.bid: Optional[float] = None
+        self.ask: Optional[float] = None
+
+    def __repr__(self):
+        return f'Instrument({self.key}, {self.pair[0]}/{self.pair[1]}{", inverted" if self.inverted else ""})'
+
+
+def canonical_pair(token0: str, token1: str, aliases: Dict[str, str] = ALIASES) -> Tuple[Tuple[str, str], bool]:
+    """
+    Returns ((base, quote), inverted) where inverted means token0 is the quote
+    """
+    a, b = aliases.get(token0, token0), aliases.get(token1, token1)
+    if a == b:
+        # e.g. USDC/USDT: aliasing would collapse the pair, keep the tokens
+        a, b = token0, token1
+    rank_a = QUOTES.index(a) if a in QUOTES else len(QUOTES)
+    rank_b = QUOTES.index(b) if b in QUOTES else len(QUOTES)
+    if rank_a < rank_b:
+        return (b, a), True
+    return (a, b), False
+
+
+def split_cex_symbol(symbol: str) -> Tuple[str, str]:
+    """
+    ETHUSDT -> (ETH, USDT), ETH-USDT-SWAP -> (ETH, USDT)
+    """
+    parts = symbol.replace('-SWAP', '').split('-')
+    if len(parts) == 2:
+        return parts[0], parts[1]
+    for quote in sorted(QUOTES, key=len, reverse=True):
+        if symbol.endswith(quote) and len(symbol) > len(quote):
+            return symbol[:-len(quote)], quote
+    raise ValueError(f'Cannot split CEX symbol: {symbol}')
+
+
+class InstrumentIndex:
+    """
+    Normalizes every CEX symbol and DEX pool onto a canonical pair and keeps
+    a dirty set, so each event only recomputes the spreads that depend on it:
+
+    index = InstrumentIndex(PoolRegistry.from_pools(POOLS, TOKENS))
+    if index.update(event):          # False when the top of book / price did not change
+        for spread in index.recompute():
+            ...
+
+    Spreads are kept per ordered (sell venue, buy venue) instrument pair as a
+    fee-adjusted return: sell at `sell.bid`, buy at `buy.ask`
+    """
+
+    def __init__(self,
+                 registry: Optional[PoolRegistry] = None,
+                 fees: Dict[str, float] = FEE,
+                 aliases: Dict[str, str] = ALIASES):
+        self.fees = fees
+        self.aliases = aliases
+        self.instruments: Dict[str, Instrument] = {}
+        self.by_pair: Dict[Tuple[str, str], List[Instrument]] = {}
+        self.by_address: Dict[str, Instrument] = {}
+        self.spreads: Dict[Tuple[str, str], float] = {}
+        self.dirty: Set[str] = set()
+
+        if registry is not None:
+            for pool in registry:
+                self.add_pool(pool)
+
+    def _add(self, instrument: Instrument) -> Instrument:
+        self.instruments[instrument.key] = instrument
+        self.by_pair.setdefault(instrument.pair, []).append(instrument)
+        return instrument
+
+    def add_cex(self, exchange: str, symbol: str) -> Instrument:
+        key = f'{exchange}:{symbol}'
+        if key in self.instruments:
+            return self.instruments[key]
+        base, quote = split_cex_symbol(symbol)
+        pair, inverted = canonical_pair(base, quote, self.aliases)
+        return self._add(Instrument('cex', exchange, symbol, key, pair, inverted, self.fees.get(exchange, 0.0)))
+
+    def add_pool(self, pool) -> Instrument:
+        pair, inverted = canonical_pair(pool.token0, pool.token1, self.aliases)
+        instrument = Instrument('dex', pool.exchange, pool.symbol, f'{pool.key}_{pool.fee}',
+                                pair, inverted, pool.fee / 1_000_000, pool.scale)
+        self.by_address[pool.address] = instrument
+        return self._add(instrument)
+
+    def lookup(self, event: Dict[str, Any]) -> Optional[Instrument]:
+        if event.get('source') == 'cex':
+            return self.add_cex(event['exchange'], event['symbol'])
+        if event.get('type') == 'pool_update':
+            return self.by_address.get(event.get('address', '').lower())
+        return None
+
+    def update(self, event: Dict[str, Any]) -> bool:
+        """
+        Stores the event's price on its instrument in canonical orientation and
+        marks it dirty. Returns False (nothing to do) if the event is not a
+        price event, is for an untracked pool, or did not change the price
+        """
+        instrument = self.lookup(event)
+        if instrument is None:
+            return False
+
+        if instrument.source == 'cex':
+            if not event['bids'] or not event['asks']:
+                return False
+            bid, ask = float(event['bids'][0][0]), float(event['asks'][0][0])
+        else:
+            if event.get('sqrtPriceX96'):
+                price = (event['sqrtPriceX96'] / Q96) ** 2 * instrument.scale
+            elif event.get('reserve0'):
+                price = event['reserve1'] / event['reserve0'] * instrument.scale
+            else:
+                return False
+            # a pool has no spread of its own: the fee is applied on both sides
+            bid = price * (1 - instrument.fee)
+            ask = price / (1 - instrument.fee)
+
+        if instrument.inverted:
+            bid, ask = 1 / ask, 1 / bid
+
+        if bid == instrument.bid and ask == instrument.ask:
+            return False
+
+        instrument.bid, instrument.ask = bid, ask
+        self.dirty.add(instrument.key)
+        return True
+
+    def recompute(self) -> List[Dict[str, Any]]:
+        """
+        Recomputes the spreads of every instrument pair that includes a dirty
+        instrument and clears the dirty set. Nothing dirty, nothing computed
+        """
+        if not self.dirty:
+            return []
+
+        updated = []
+        done: Set[Tuple[str, str]] = set()
+        for key in self.dirty:
+            instrument = self.instruments[key]
+            for other in self.by_pair[instrument.pair]:
+                if other is instrument or other.bid is None:
+                    continue
+                for sell, buy in ((instrument, other), (other, instrument)):
+                    pair_key = (sell.key, buy.key)
+                    if pair_key in done:
+                        continue
+                    done.add(pair_key)
+                    spread = self._spread(sell, buy)
+                    self.spreads[pair_key] = spread
+                    updated.append({
+                        'type': 'spread',
+                        'pair': sell.pair,
+                        'sell': sell.key,
+                        'buy': buy.key,
+                        'spread': spread,
+                    })
+        self.dirty.clear()
+        return updated
+
+    def _spread(self, sell: Instrument, buy: Instrument) -> float:
+        """
+        Fee-adjusted return (%) of selling at `sell` and buying at `buy`;
+        CEX fees follow cex_event_handler (taker fee x2), pool fees are
+        already in the DEX bid/ask
+        """
+        spread = (sell.bid / buy.ask - 1) * 100
+        for instrument in (sell, buy):
+            if instrument.source == 'cex':
+                spread -= instrument.fee * 2 * 100
+        return spread
+
+
+if __name__ == '__main__':
+    from decimal import Decimal
+
+    from constants import TOKENS, POOLS
+
+    index = InstrumentIndex(PoolRegistry.from_pools(POOLS, TOKENS))
+    for instrument in index.instruments.values():
+        print(instrument)
+
+    cex = {
+        'source': 'cex', 'type': 'orderbook', 'exchange': 'binance', 'symbol': 'ETHUSDT',
+        'bids': [[Decimal('2000.1'), Decimal('1')]], 'asks': [[Decimal('2000.2'), Decimal('1')]],
+    }
+    print(index.update(cex), index.recompute())
+
+    pool = {
+        'source': 'dex', 'type': 'pool_update', 'address': '0x8ad599c3a0ff1de082011efddc58f1908eb6e6d8',
+        'sqrtPriceX96': int((1 / 2010 * 10 ** 12) ** 0.5 * Q96),
+    }
+    print(index.update(pool))
+    for spread in index.recompute():
+        print(spread)
+
+    # unchanged inputs: no dirty marks, no work
+    print(index.update(cex), index.update(pool), index.recompute())
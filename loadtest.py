@@ -0,0 +1,327 @@
+"""
+Load test of the stream_* functions against the local mock servers
+
+python loadtest.py --feeds binance,okx,connex,node --symbols 2 --rates 100,500,1000,2000 --duration 5
+python loadtest.py --feeds binance --rates 1000 --gap-prob 0.001 --burst-every 1 --burst-size 500
+python loadtest.py --feeds binance,node --rates 200 --disconnect-every 0.5 --disconnect-feeds node --rpc-latency-ms 30
+
+For every rate step each mock of mock_servers.py runs in its own child
+process (so generating the load does not compete with the pipeline under test) at
+`rate` updates per second per symbol, per pool for the node. The unchanged
+stream functions connect to them through reconnecting_websocket_loop and
+publish into one event queue (an EventBus subscription, or an
+aioprocessing.AioQueue with --queue aio), drained by a consumer that records
+per-feed counts and latencies:
+
+- CEX books: arrival time minus the exchange timestamp (1ms resolution)
+- blocks / pool updates: arrival time minus the send time the mock node
+  writes into block and transaction hashes (ns resolution)
+
+A step is sustainable when at least 99% of what was sent was delivered
+(books skipped by the streams' change filters count as delivered) and p99
+latency stays within --max-p99-ms. The report ends with the highest
+sustainable total events/sec. A feed is marked (mock-limited) when its mock
+generated under 95% of the requested updates, i.e. the machine, not the
+pipeline, set the pace of that step.
+
+The third example measures how much the node's reconnects (startup RPC
+reads against a node --rpc-latency-ms away) delay the CEX books: compare
+the binance p99 / max with and without --disconnect-feeds node.
+"""
+import time
+import asyncio
+import argparse
+import multiprocessing as mp
+
+from functools import partial
+from typing import Any, Dict, List, Optional
+
+from events import event_type
+from mock_servers import (MockBinanceExchange, MockConnexExchange, MockEthereumNode, MockOkxExchange,
+                          Pathologies)
+
+
+BASES = ['ETH', 'BTC', 'SOL', 'BNB', 'XRP', 'DOGE', 'ADA', 'AVAX', 'LINK', 'DOT']
+
+PORTS = {
+    'binance': (8771, 8772),
+    'okx': (8773, 8774),
+    'connex': (8775, 8776),
+    'node': (8777, 8778),
+}
+
+
+def _build_mocks(feeds: List[str], n_symbols: int, rpc_latency: float = 0.0) -> Dict[str, Any]:
+    from constants import POOLS
+
+    bases = BASES[:n_symbols]
+    mocks = {}
+    if 'binance' in feeds:
+        mocks['binance'] = MockBinanceExchange(*(('localhost',) + PORTS['binance']),
+                                               symbols=[f'{b}USDT' for b in bases])
+    if 'okx' in feeds:
+        mocks['okx'] = MockOkxExchange(*(('localhost',) + PORTS['okx']),
+                                       symbols=[f'{b}-USDT-SWAP' for b in bases])
+    if 'connex' in feeds:
+        mocks['connex'] = MockConnexExchange(*(('localhost',) + PORTS['connex']),
+                                             symbols=[f'{b}USDT' for b in bases])
+    if 'node' in feeds:
+        node = MockEthereumNode('localhost', PORTS['node'][0], http_port=PORTS['node'][1], rpc_latency=rpc_latency)
+        for pool in POOLS:
+            if pool['version'] == 3:
+                node.add_v3_pool(pool['address'], 3_543_191_142_285_914_205_922_034, 10 ** 19)
+            else:
+                node.add_v2_pool(pool['address'], 20_000 * 10 ** 18, 40_000_000 * 10 ** 6)
+        mocks['node'] = node
+    return mocks
+
+
+def _serve(feed: str, n_symbols: int, rate: float, duration: float, block_time: float,
+           pathologies: Dict[str, Any], rpc_latency: float, ready, go, stop, results):
+    """
+    Child process of one mock: starts it, waits for `go`, publishes for
+    `duration` seconds, reports what was sent and keeps serving until `stop`
+    """
+    async def _main():
+        loop = asyncio.get_event_loop()
+        mock = _build_mocks([feed], n_symbols, rpc_latency)[feed]
+        await mock.start()
+        ready.set()
+        await loop.run_in_executor(None, go.wait)
+
+        if feed == 'node':
+            stats = await mock.run(block_time, rate, duration, Pathologies(**pathologies))
+        else:
+            stats = await mock.run(rate, duration, Pathologies(**pathologies))
+        results.put((feed, {
+            'sent': mock.updates_sent + getattr(mock, 'blocks_sent', 0),
+            'nominal': int(rate * len(mock.symbols) * duration),
+            **stats,
+        }))
+        await loop.run_in_executor(None, stop.wait)
+        await mock.stop()
+
+    asyncio.run(_main())
+
+
+def _percentile(values: List[float], q: float) -> Optional[float]:
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+class LatencyRecorder:
+    """
+    event_queue consumer side: counts events and latencies per feed
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.counts: Dict[str, int] = {}
+        self.latencies: Dict[str, List[float]] = {}
+        self.started = time.monotonic()
+
+    def record(self, event: Any):
+        etype = event_type(event)
+        if etype == 'orderbook':
+            feed = event['exchange']
+            latency = time.time() * 1000 - event['timestamp']
+        elif etype == 'block':
+            feed = 'node'
+            latency = (time.time_ns() - int(event['block_hash'], 16)) / 1e6
+        elif etype == 'pool_update' and event.get('tx_hash'):
+            feed = 'node'
+            latency = (time.time_ns() - int(event['tx_hash'], 16)) / 1e6
+        else:
+            return
+        self.counts[feed] = self.counts.get(feed, 0) + 1
+        self.latencies.setdefault(feed, []).append(latency)
+
+
+def _stream_coroutines(feeds: List[str], n_symbols: int, event_queue) -> List[Any]:
+    from utils import reconnecting_websocket_loop
+
+    symbols = [f'{b}/USDT' for b in BASES[:n_symbols]]
+    fns = {}
+    if 'binance' in feeds or 'okx' in feeds or 'connex' in feeds:
+        from cex_streams import stream_binance_usdm_orderbook, stream_okx_usdm_orderbook, stream_connex_orderbook
+        fns['binance'] = partial(stream_binance_usdm_orderbook, symbols, event_queue,
+                                 ws_urls=[f'ws://localhost:{PORTS["binance"][0]}/ws/'],
+                                 rest_url=f'http://localhost:{PORTS["binance"][1]}')
+        fns['okx'] = partial(stream_okx_usdm_orderbook, symbols, event_queue,
+                             ws_url=f'ws://localhost:{PORTS["okx"][0]}/ws/v5/public',
+                             rest_url=f'http://localhost:{PORTS["okx"][1]}')
+        fns['connex'] = partial(stream_connex_orderbook, symbols, event_queue,
+                                ws_url=f'ws://localhost:{PORTS["connex"][0]}',
+                                rest_url=f'http://localhost:{PORTS["connex"][1]}',
+                                api_key='test-key', api_secret='test-secret')
+    if 'node' in feeds:
+        from constants import TOKENS, POOLS
+        from dex_streams import stream_new_blocks, stream_uniswap_v3_events
+        ws_url, http_url = f'ws://localhost:{PORTS["node"][0]}', f'http://localhost:{PORTS["node"][1]}'
+        fns['node'] = partial(stream_new_blocks, ws_url, event_queue)
+        fns['node_swaps'] = partial(stream_uniswap_v3_events, http_url, ws_url, TOKENS, POOLS, event_queue)
+
+    return [
+        reconnecting_websocket_loop(fn, tag=name, base_backoff=0.05, max_backoff=0.5)
+        for name, fn in fns.items() if name in feeds or (name == 'node_swaps' and 'node' in feeds)
+    ]
+
+
+async def run_step(feeds: List[str],
+                   n_symbols: int,
+                   rate: float,
+                   duration: float,
+                   block_time: float = 1.0,
+                   pathologies: Optional[Dict[str, Any]] = None,
+                   queue: str = 'loop',
+                   disconnect_feeds: Optional[List[str]] = None,
+                   rpc_latency: float = 0.0,
+                   warmup: float = 1.5,
+                   drain: float = 1.0) -> Dict[str, Dict[str, Any]]:
+    """
+    One rate step: per-feed sent / delivered counts and latency percentiles (ms)
+
+    :param disconnect_feeds: feeds whose mocks apply pathologies['disconnect_every'], all when None
+    :param rpc_latency: seconds the mock node takes to answer each HTTP request
+    """
+    from cex_streams import CHANGE_FILTERS
+
+    loop = asyncio.get_event_loop()
+    ctx = mp.get_context('spawn')
+    go, stop, results = ctx.Event(), ctx.Event(), ctx.Queue()
+    processes = []
+    for feed in feeds:
+        ready = ctx.Event()
+        feed_pathologies = dict(pathologies or {})
+        if disconnect_feeds is not None and feed not in disconnect_feeds:
+            feed_pathologies.pop('disconnect_every', None)
+        process = ctx.Process(target=_serve, args=(feed, n_symbols, rate, duration, block_time,
+                                                   feed_pathologies, rpc_latency, ready, go, stop, results))
+        process.start()
+        processes.append(process)
+        if not await loop.run_in_executor(None, ready.wait, 30):
+            for process in processes:
+                process.terminate()
+            raise RuntimeError(f'mock {feed} did not start')
+
+    if queue == 'aio':
+        import aioprocessing
+        event_queue = consumer_queue = aioprocessing.AioQueue()
+    else:
+        from event_bus import EventBus
+        event_queue = EventBus()
+        consumer_queue = event_queue.subscribe('loadtest', policy='block')
+
+    recorder = LatencyRecorder()
+
+    async def _consume():
+        while True:
+            recorder.record(await consumer_queue.coro_get())
+
+    tasks = [asyncio.ensure_future(c) for c in _stream_coroutines(feeds, n_symbols, event_queue)]
+    tasks.append(asyncio.ensure_future(_consume()))
+    await asyncio.sleep(warmup)
+
+    suppressed = {name: f.suppressed for name, f in CHANGE_FILTERS.items()}
+    recorder.reset()
+    go.set()
+    sent = dict([await loop.run_in_executor(None, results.get, True, duration + 60) for _ in feeds])
+    await asyncio.sleep(drain)
+
+    report = {}
+    for name in feeds:
+        received = recorder.counts.get(name, 0)
+        skipped = CHANGE_FILTERS[name].suppressed - suppressed[name] if name in CHANGE_FILTERS else 0
+        latencies = recorder.latencies.get(name, [])
+        report[name] = {
+            **sent[name],
+            'received': received,
+            'skipped': skipped,
+            'delivered': (received + skipped) / sent[name]['sent'] if sent[name]['sent'] else None,
+            'mock_limited': sent[name]['updates'] < 0.95 * sent[name]['nominal'],
+            'sent_per_sec': sent[name]['sent'] / duration,
+            'events_per_sec': received / duration,
+            'p50_ms': _percentile(latencies, 0.5),
+            'p90_ms': _percentile(latencies, 0.9),
+            'p99_ms': _percentile(latencies, 0.99),
+            'max_ms': max(latencies) if latencies else None,
+        }
+
+    pending = set(tasks)
+    while pending:
+        # asyncio.wait_for in Python 3.11 can swallow a cancellation, so repeat until every stream is done
+        for task in pending:
+            task.cancel()
+        _, pending = await asyncio.wait(pending, timeout=1)
+    stop.set()
+    for process in processes:
+        await loop.run_in_executor(None, process.join, 10)
+    return report
+
+
+def _fmt(value: Any, width: int = 9) -> str:
+    if value is None:
+        return f'{"-":>{width}}'
+    if isinstance(value, float):
+        return f'{value:>{width}.2f}' if abs(value) < 100 else f'{value:>{width},.0f}'
+    return f'{value:>{width},}'
+
+
+async def main(args: argparse.Namespace):
+    feeds = args.feeds.split(',')
+    pathologies = {
+        'gap_prob': args.gap_prob,
+        'duplicate_prob': args.duplicate_prob,
+        'disconnect_every': args.disconnect_every,
+        'burst_every': args.burst_every,
+        'burst_size': args.burst_size,
+    }
+    columns = ['sent', 'received', 'skipped', 'delivered', 'sent_per_sec', 'events_per_sec',
+               'p50_ms', 'p90_ms', 'p99_ms', 'max_ms']
+    print(f'{"rate":>7} {"feed":>8} ' + ' '.join(f'{c:>9}' for c in ['sent', 'received', 'skipped', 'delivered', 'sent/s',
+                                                                   'ev/s', 'p50_ms', 'p90_ms', 'p99_ms', 'max_ms']))
+    best = None
+    for rate in [float(r) for r in args.rates.split(',')]:
+        report = await run_step(feeds, args.symbols, rate, args.duration, args.block_time, pathologies, args.queue,
+                                args.disconnect_feeds.split(',') if args.disconnect_feeds else None,
+                                args.rpc_latency_ms / 1000)
+        for name, row in report.items():
+            print(f'{rate:>7,.0f} {name:>8} ' + ' '.join(_fmt(row[c]) for c in columns)
+                  + ('  (mock-limited)' if row['mock_limited'] else ''))
+
+        total = sum(row['events_per_sec'] for row in report.values())
+        sustainable = all(row['delivered'] is not None and row['delivered'] >= 0.99
+                          and row['p99_ms'] is not None and row['p99_ms'] <= args.max_p99_ms
+                          for row in report.values())
+        print(f'{"":>7} {"total":>8} {total:>59,.0f} events/s, {"sustainable" if sustainable else "NOT sustainable"}')
+        if sustainable:
+            best = max(best or 0, total)
+
+    if best is None:
+        print(f'No step was sustainable (delivered >= 99%, p99 <= {args.max_p99_ms}ms)')
+    else:
+        print(f'Max sustainable: {best:,.0f} events/s (delivered >= 99%, p99 <= {args.max_p99_ms}ms)')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--feeds', default='binance,okx,connex,node', help='binance, okx, connex, node')
+    parser.add_argument('--symbols', type=int, default=2, help=f'symbols per CEX feed (up to {len(BASES)})')
+    parser.add_argument('--rates', default='100,500,1000,2000', help='updates/s per symbol (per pool for the node)')
+    parser.add_argument('--duration', type=float, default=5.0, help='seconds per step')
+    parser.add_argument('--block-time', type=float, default=1.0)
+    parser.add_argument('--queue', choices=('loop', 'aio'), default='loop',
+                        help='in-loop EventBus subscription or aioprocessing.AioQueue')
+    parser.add_argument('--max-p99-ms', type=float, default=50.0)
+    parser.add_argument('--gap-prob', type=float, default=0.0)
+    parser.add_argument('--duplicate-prob', type=float, default=0.0)
+    parser.add_argument('--disconnect-every', type=float, default=None)
+    parser.add_argument('--disconnect-feeds', default=None, help='feeds --disconnect-every applies to, default all')
+    parser.add_argument('--rpc-latency-ms', type=float, default=0.0, help='mock node HTTP response time')
+    parser.add_argument('--burst-every', type=float, default=None)
+    parser.add_argument('--burst-size', type=int, default=100)
+    asyncio.run(main(parser.parse_args()))
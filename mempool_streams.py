@@ -0,0 +1,342 @@
+import json
+import time
+import eth_abi
+import asyncio
+import eth_utils
+import websockets
+import aioprocessing
+
+from typing import Any, Dict, List, Optional, Tuple
+
+from constants import TOKENS, ROUTERS
+from events import PredictedPoolUpdateEvent
+from pool_registry import Pool, PoolRegistry
+from profiling import stage
+from simulator import UniswapV2Simulator, UniswapV3Simulator
+
+
+"""
+Exact-input router calls we decode. Each entry: (selector, ABI types, kind)
+"""
+SWAP_METHODS = {
+    '0x38ed1739': (['uint256', 'uint256', 'address[]', 'address', 'uint256'], 'v2_exact_tokens'),  # swapExactTokensForTokens
+    '0x18cbafe5': (['uint256', 'uint256', 'address[]', 'address', 'uint256'], 'v2_exact_tokens'),  # swapExactTokensForETH
+    '0x7ff36ab5': (['uint256', 'address[]', 'address', 'uint256'], 'v2_exact_eth'),                # swapExactETHForTokens
+    '0x414bf389': (['(address,address,uint24,address,uint256,uint256,uint256,uint160)'], 'v3_single'),  # SwapRouter.exactInputSingle
+    '0x04e45aaf': (['(address,address,uint24,address,uint256,uint256,uint160)'], 'v3_single02'),       # SwapRouter02.exactInputSingle
+}
+
+
+def decode_router_swap(tx: Dict[str, Any],
+                       registry: PoolRegistry,
+                       tokens: Dict[str, List[Any]] = TOKENS) -> Optional[Tuple[int, List[Tuple[Pool, bool]]]]:
+    """
+    Decodes a pending router transaction into (amount_in, hops), hops being
+    [(pool, zero_for_one), ...]. Returns None if the call is not an exact-input
+    swap we know, or if any hop goes through a pool we don't track
+    """
+    to = (tx.get('to') or '').lower()
+    if to not in ROUTERS:
+        return None
+
+    exchange, version = ROUTERS[to]
+    data = tx.get('input') or tx.get('data') or '0x'
+    method = SWAP_METHODS.get(data[:10])
+    if method is None:
+        return None
+
+    types, kind = method
+    args = eth_abi.decode(types, eth_utils.decode_hex(data[10:]))
+    symbols = {v[0].lower(): k for k, v in tokens.items()}
+
+    if kind == 'v2_exact_tokens':
+        amount_in, path, fee = args[0], args[2], 3000
+    elif kind == 'v2_exact_eth':
+        amount_in, path, fee = int(tx['value'], base=16), args[1], 3000
+    else:
+        params = args[0]
+        path, fee = [params[0], params[1]], params[2]
+        amount_in = params[5] if kind == 'v3_single' else params[4]
+
+    path = [symbols.get(address.lower()) for address in path]
+    if None in path:
+        return None
+
+    hops = []
+    for token_in, token_out in zip(path[:-1], path[1:]):
+        pair = (token_in, token_out) if token_in <= token_out else (token_out, token_in)
+        pool = next((p for p in registry.by_pair_fee.get((pair, fee), [])
+                     if p.exchange == exchange and p.version == version), None)
+        if pool is None:
+            return None
+        hops.append((pool, pool.token0 == token_in))
+
+    return amount_in, hops
+
+
+class PendingSwapPredictor:
+    """
+    Keeps the last mined state of every tracked pool plus a predicted copy
+    with the pending swaps seen since applied on top
+
+    Feed it the mined pool_update events (on_pool_update) and decoded pending
+    swaps (apply). Pending transactions are only notified once, so each pool
+    keeps its pending swaps in arrival order: a mined update drops the swap of
+    the transaction that produced it and rebuilds the predicted copy by
+    re-applying the remaining ones on top of the new state. Swaps still
+    pending after `pending_ttl` blocks are dropped as replaced or evicted.
+    Later hops of a multi-hop swap are re-applied with the amount they had when
+    first predicted
+    """
+
+    def __init__(self, registry: PoolRegistry, pending_ttl: int = 25, mined_window: int = 10_000):
+        """
+        :param pending_ttl: blocks a pending swap is kept for before it is dropped
+        :param mined_window: recently mined tx hashes remembered, so a pending
+                             notification arriving after its block is not applied
+        """
+        self.registry = registry
+        self.pending_ttl = pending_ttl
+        self.mined_window = mined_window
+        self.v2 = UniswapV2Simulator()
+        self.v3 = UniswapV3Simulator()
+        self.states: Dict[str, Dict[str, Any]] = {}
+        self.predicted: Dict[str, Dict[str, Any]] = {}
+        # address -> {tx_hash: (zero_for_one, amount_in, block seen)}, in arrival order
+        self.pending: Dict[str, Dict[str, Tuple[bool, int, int]]] = {}
+        self.mined: Dict[str, None] = {}
+        self.block_number = 0
+
+    def on_pool_update(self, event: Dict[str, Any]):
+        address = event['address']
+        state = {k: event[k] for k in ('sqrtPriceX96', 'tick', 'liquidity', 'reserve0', 'reserve1') if k in event}
+        self.states[address] = state
+        self.block_number = max(self.block_number, event.get('block_number') or 0)
+
+        tx_hash = event.get('tx_hash')
+        if tx_hash is not None:
+            self.mined[tx_hash] = None
+            if len(self.mined) > self.mined_window:
+                del self.mined[next(iter(self.mined))]
+
+        predicted = dict(state)
+        pending = self.pending.setdefault(address, {})
+        pool = self.registry.by_address.get(address.lower())
+        for pending_hash, (zero_for_one, amount_in, seen) in list(pending.items()):
+            if pending_hash in self.mined or self.block_number - seen > self.pending_ttl:
+                del pending[pending_hash]
+            elif pool is not None and self._ready(pool, predicted):
+                self._swap(pool, predicted, zero_for_one, amount_in)
+        self.predicted[address] = predicted
+
+    @staticmethod
+    def _ready(pool: Pool, state: Dict[str, Any]) -> bool:
+        if pool.version == 3:
+            return bool(state.get('liquidity'))
+        return bool(state.get('reserve0'))
+
+    def _swap(self, pool: Pool, state: Dict[str, Any], zero_for_one: bool, amount_in: int) -> int:
+        """
+        Applies one exact-input swap to `state` in place and returns amount_out
+        """
+        if pool.version == 3:
+            amount_out, sqrt_price = self.v3.get_amount_out(amount_in,
+                                                            state['sqrtPriceX96'],
+                                                            state['liquidity'],
+                                                            pool.fee,
+                                                            zero_for_one)
+            state['sqrtPriceX96'] = sqrt_price
+            state['tick'] = self.v3.sqrt_price_to_tick(sqrt_price)
+            return amount_out
+
+        reserve_in, reserve_out = ('reserve0', 'reserve1') if zero_for_one else ('reserve1', 'reserve0')
+        amount_out = self.v2.get_amount_out(amount_in, state[reserve_in], state[reserve_out], pool.fee)
+        state[reserve_in] += amount_in
+        state[reserve_out] -= amount_out
+        return amount_out
+
+    def apply(self, tx_hash: str, amount_in: int, hops: List[Tuple[Pool, bool]]) -> List[PredictedPoolUpdateEvent]:
+        """
+        Simulates the swap hop by hop on the predicted states and returns one
+        predicted_pool_update event per pool it moved
+        """
+        events = []
+        amount = amount_in
+        if tx_hash in self.mined:
+            return events
+        for pool, zero_for_one in hops:
+            state = self.predicted.get(pool.address)
+            if not state or not self._ready(pool, state):
+                break
+            pending = self.pending.setdefault(pool.address, {})
+            if tx_hash in pending:
+                break
+            pending[tx_hash] = (zero_for_one, amount, self.block_number)
+
+            amount = self._swap(pool, state, zero_for_one, amount)
+            events.append(PredictedPoolUpdateEvent(
+                self.block_number + 1,
+                pool.exchange,
+                pool.version,
+                pool.symbol,
+                pool.address,
+                pool.fee,
+                pool.token_idx,
+                pool.decimals,
+                tx_hash=tx_hash,
+                pending_count=len(pending),
+                **state,
+            ))
+        return events
+
+
+async def stream_pending_swaps(ws_rpc_url: str,
+                               registry: PoolRegistry,
+                               predictor: PendingSwapPredictor,
+                               event_queue: aioprocessing.AioQueue,
+                               debug: bool = False):
+    """
+    Subscribes to pending transactions, decodes router swaps through tracked
+    pools and publishes predicted_pool_update events
+
+    Nodes that only stream tx hashes are handled by fetching each transaction
+    with eth_getTransactionByHash over the same connection
+    """
+    async with websockets.connect(ws_rpc_url, max_size=None) as ws:
+        if debug:
+            print(f"Connecting to WS for pending transactions: {ws_rpc_url}")
+        subscription = {
+            'jsonrpc': '2.0',
+            'id': 1,
+            'method': 'eth_subscribe',
+            'params': ['newPendingTransactions', True]
+        }
+
+        await ws.send(json.dumps(subscription))
+        ack = await ws.recv()
+        if debug:
+            print(f"Subscribed pending transactions ack: {ack}")
+
+        request_id = 1
+        decode_stage, predict_stage = stage('pending_swaps.decode'), stage('pending_swaps.predict')
+
+        while True:
+            msg = await asyncio.wait_for(ws.recv(), timeout=60 * 10)
+            start = time.perf_counter_ns()
+            data = json.loads(msg)
+
+            if 'params' in data:
+                tx = data['params']['result']
+                if isinstance(tx, str):
+                    request_id += 1
+                    await ws.send(json.dumps({
+                        'jsonrpc': '2.0',
+                        'id': request_id,
+                        'method': 'eth_getTransactionByHash',
+                        'params': [tx],
+                    }))
+                    continue
+            else:
+                tx = data.get('result')
+
+            if not tx or (tx.get('to') or '').lower() not in ROUTERS:
+                continue
+
+            try:
+                swap = decode_router_swap(tx, registry)
+            except Exception as e:
+                if debug:
+                    print(f"Failed to decode {tx.get('hash')}: {e}")
+                continue
+
+            if swap is None:
+                continue
+            decode_stage.since(start)
+
+            amount_in, hops = swap
+            start = time.perf_counter_ns()
+            events = predictor.apply(tx['hash'], amount_in, hops)
+            predict_stage.since(start)
+            for event in events:
+                if not debug:
+                    event_queue.put(event)
+                else:
+                    print(event)
+
+
+if __name__ == '__main__':
+    import math
+
+    from constants import POOLS
+    from dex_streams import stream_uniswap_v2_events
+    from mock_servers import MockEthereumNode
+
+    """
+    Runs the stream against a local node stand-in with two pending swaps: a
+    SwapRouter02.exactInputSingle selling 10 ETH into the 0.05% ETH/USDT V3
+    pool and a SushiSwap swapExactTokensForTokens selling 5 ETH into the
+    ETH/USDT V2 pair, whose reserves come from stream_uniswap_v2_events. Then
+    another transaction is mined on the V2 pair (the pending swap is
+    re-applied on the new reserves) and finally the pending swap itself
+    """
+    registry = PoolRegistry.from_pools(POOLS, TOKENS)
+    predictor = PendingSwapPredictor(registry)
+
+    pool = registry.get('0x4e68Ccd3E89f51C3074ca5072bbAC773960dFa36')
+    sqrt_price = int(math.sqrt(2000 * 10 ** 6 / 10 ** 18) * 2 ** 96)
+    predictor.on_pool_update({'address': pool.address, 'block_number': 18_000_000,
+                              'sqrtPriceX96': sqrt_price, 'tick': 0, 'liquidity': 2 * 10 ** 16})
+
+    calldata = '0x04e45aaf' + eth_abi.encode(
+        ['(address,address,uint24,address,uint256,uint256,uint160)'],
+        [(TOKENS['ETH'][0], TOKENS['USDT'][0], 500, '0x' + '11' * 20, 10 * 10 ** 18, 0, 0)]
+    ).hex()
+    tx = {
+        'hash': '0x' + 'ab' * 32,
+        'to': '0x68b3465833fb72A70ecDF485E0e4C7bD8665Fc45',
+        'value': '0x0',
+        'input': calldata,
+    }
+
+    pair = registry.get('0x06da0fd433C1A5d7a4faa01111c044910A184553')
+    v2_tx = {
+        'hash': '0x' + 'cd' * 32,
+        'to': '0xd9e1cE17f2641f24aE83637ab66a2cca9C378B9F',
+        'value': '0x0',
+        'input': '0x38ed1739' + eth_abi.encode(
+            ['uint256', 'uint256', 'address[]', 'address', 'uint256'],
+            [5 * 10 ** 18, 0, [TOKENS['ETH'][0], TOKENS['USDT'][0]], '0x' + '11' * 20, 2 ** 32]
+        ).hex(),
+    }
+
+    class _MinedStates:
+        def put(self, event):
+            predictor.on_pool_update(event)
+            print({'type': 'mined', 'tx_hash': event.get('tx_hash'), 'reserve0': event['reserve0'],
+                   'predicted_reserve0': predictor.predicted[event['address']]['reserve0'],
+                   'pending': list(predictor.pending.get(event['address'], {}))})
+
+    async def _main():
+        node = MockEthereumNode(port=8547, http_port=8548)
+        node.add_v2_pool(pair.address, 1_000 * 10 ** 18, 2_000_000 * 10 ** 6)
+        node.block_number = 18_000_000
+        await node.start()
+        streams = [
+            asyncio.ensure_future(stream_uniswap_v2_events(node.http_url, node.url, TOKENS, registry, _MinedStates())),
+            asyncio.ensure_future(stream_pending_swaps(node.url, registry, predictor, None, True)),
+        ]
+        await asyncio.sleep(0.3)
+        await node.publish_pending_tx(tx)
+        await node.publish_pending_tx(v2_tx)
+        await asyncio.sleep(0.2)
+        node.publish_update(pair.address)           # another transaction on the pair
+        await asyncio.sleep(0.2)
+        log = node.publish_update(pair.address, silent=True)
+        log['transactionHash'] = v2_tx['hash']      # the pending swap gets mined
+        node.resend(pair.address, log)
+        await asyncio.sleep(0.2)
+        for stream in streams:
+            stream.cancel()
+        await node.stop()
+
+    asyncio.run(_main())
@@ -0,0 +1,969 @@
+import hmac
+import json
+import math
+import time
+import random
+import asyncio
+import hashlib
+import websockets
+
+from urllib.parse import urlsplit, parse_qs
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from constants import MULTICALL3
+
+
+SWAP_V3_TOPIC = '0xc42079f94a6350d7e6235f29174924f928cc2ac818eb64fed8004e115fbcca67'
+SYNC_V2_TOPIC = '0x1c411e9a96e071241c2f21f7726b17ae89e3cab4c78be50e062b03a9fffbbad1'
+
+
+def _word(value: int) -> str:
+    return f'{value % 2 ** 256:064x}'
+
+
+class MockEthereumNode:
+    """
+    Local stand-in for an Ethereum node's WS JSON-RPC endpoint
+
+    Supports eth_subscribe for newHeads, logs (address/topic filtered) and
+    newPendingTransactions (hashes, or full objects with the `true` flag),
+    plus eth_getTransactionByHash and eth_blockNumber. Tests push data with
+    publish_block / publish_log / publish_pending_tx.
+
+    With http_port set, the same methods plus eth_call for slot0(),
+    liquidity() and getReserves() of the pools added with add_v3_pool /
+    add_v2_pool, balances(i) of add_curve_pool pools, Multicall3
+    aggregate3() over any of those and eth_getBlockByNumber are served over
+    HTTP, and as single or batched calls over the WebSocket too: all
+    stream_uniswap_v3_events needs at startup and what state_cache.StateCache
+    and rpc_client.RPCClient call (counted in rpc_requests). Every call
+    response is delayed by `rpc_latency` seconds, like a remote node's.
+    run() then produces blocks and Uniswap V3 Swap / V2 Sync logs of those
+    pools; the hashes it generates carry the send time (ns since the epoch)
+    so a load test can time each event.
+
+    node = MockEthereumNode(port=8546, http_port=8545)
+    node.add_v3_pool(address, sqrt_price_x96, liquidity)
+    await node.start()
+    asyncio.ensure_future(node.run(block_time=1, swap_rate=50))
+    await stream_new_blocks('ws://localhost:8546', event_queue)
+    """
+
+    def __init__(self, host: str = 'localhost', port: int = 8546, http_port: Optional[int] = None, seed: int = 0,
+                 chain_id: int = 1, rpc_latency: float = 0.0):
+        self.host = host
+        self.port = port
+        self.http_port = http_port
+        self.chain_id = chain_id
+        self.rpc_latency = rpc_latency
+        self.server = None
+        self.http_server = None
+        self.block_number = 0
+        self.transactions: Dict[str, Dict[str, Any]] = {}
+        self.pools: Dict[str, Dict[str, Any]] = {}
+        self.rng = random.Random(seed)
+        self.blocks_sent = 0
+        self.updates_sent = 0
+        self.rpc_requests = 0
+        self._log_index = 0
+        self._subscriptions: Dict[str, Dict[str, Any]] = {}
+        self._next_id = 0
+
+    @property
+    def url(self) -> str:
+        return f'ws://{self.host}:{self.port}'
+
+    @property
+    def http_url(self) -> str:
+        return f'http://{self.host}:{self.http_port}'
+
+    @property
+    def symbols(self) -> List[str]:
+        # what _drive iterates over: one swap per Uniswap pool per tick
+        return [address for address, pool in self.pools.items() if pool['version'] in (2, 3)]
+
+    async def start(self):
+        self.server = await websockets.serve(self._handler, self.host, self.port, max_size=None)
+        if self.http_port is not None:
+            self.http_server = await asyncio.start_server(
+                lambda r, w: _serve_json_http(r, w, self._respond, self.rpc_latency), self.host, self.http_port)
+        return self
+
+    async def stop(self):
+        for server in (self.server, self.http_server):
+            if server is not None:
+                server.close()
+                await server.wait_closed()
+
+    def add_v3_pool(self, address: str, sqrt_price_x96: int, liquidity: int):
+        price = (sqrt_price_x96 / 2 ** 96) ** 2
+        self.pools[address.lower()] = {
+            'version': 3,
+            'sqrtPriceX96': sqrt_price_x96,
+            'liquidity': liquidity,
+            'tick': math.floor(math.log(price, 1.0001)),
+        }
+
+    def add_v2_pool(self, address: str, reserve0: int, reserve1: int):
+        self.pools[address.lower()] = {'version': 2, 'reserve0': reserve0, 'reserve1': reserve1}
+
+    def add_curve_pool(self, address: str, balances: List[int]):
+        self.pools[address.lower()] = {'version': 'curve', 'balances': list(balances)}
+
+    def _respond(self, method: str, path: str, body: bytes):
+        request = json.loads(body or b'{}')
+        requests = request if isinstance(request, list) else [request]
+        self.rpc_requests += len(requests)
+        responses = [{'jsonrpc': '2.0', 'id': r.get('id'), 'result': self._dispatch(None, r['method'], r.get('params', []))}
+                     for r in requests]
+        return '200 OK', responses if isinstance(request, list) else responses[0]
+
+    def _call(self, call: Dict[str, Any]) -> str:
+        to = (call.get('to') or '').lower()
+        data = call.get('data') or call.get('input') or ''
+        selector = data[:10]
+        if to == MULTICALL3[0].lower() and selector == '0x82ad56cb':          # aggregate3((address,bool,bytes)[])
+            import eth_abi
+
+            calls, = eth_abi.decode(['(address,bool,bytes)[]'], bytes.fromhex(data[10:]))
+            results = []
+            for target, _, calldata in calls:
+                result = self._call({'to': target, 'data': '0x' + calldata.hex()})
+                results.append((result != '0x', bytes.fromhex(result[2:])))
+            return '0x' + eth_abi.encode(['(bool,bytes)[]'], [results]).hex()
+
+        pool = self.pools.get(to)
+        if pool is None:
+            return '0x'
+        if selector == '0x4903b0d1' and pool['version'] == 'curve':  # balances(uint256)
+            i = int(data[10:], 16)
+            return '0x' + _word(pool['balances'][i]) if i < len(pool['balances']) else '0x'
+        if selector == '0x3850c7bd' and pool['version'] == 3:     # slot0()
+            return '0x' + ''.join(_word(v) for v in (pool['sqrtPriceX96'], pool['tick'], 0, 1, 1, 0, 1))
+        if selector == '0x1a686502' and pool['version'] == 3:     # liquidity()
+            return '0x' + _word(pool['liquidity'])
+        if selector == '0x0902f1ac' and pool['version'] == 2:     # getReserves()
+            return '0x' + ''.join(_word(v) for v in (pool['reserve0'], pool['reserve1'], int(time.time())))
+        return '0x'
+
+    async def _handler(self, ws, path: Optional[str] = None):
+        try:
+            async for msg in ws:
+                request = json.loads(msg)
+                if isinstance(request, dict) and request['method'] in ('eth_subscribe', 'eth_unsubscribe'):
+                    result = self._dispatch(ws, request['method'], request.get('params', []))
+                    await ws.send(json.dumps({'jsonrpc': '2.0', 'id': request.get('id'), 'result': result}))
+                else:
+                    # calls are answered after rpc_latency without holding up the next message (pipelining)
+                    asyncio.ensure_future(self._answer(ws, request))
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            for sub_id in [k for k, v in self._subscriptions.items() if v['ws'] is ws]:
+                del self._subscriptions[sub_id]
+
+    async def _answer(self, ws, request: Any):
+        requests = request if isinstance(request, list) else [request]
+        self.rpc_requests += len(requests)
+        responses = [{'jsonrpc': '2.0', 'id': r.get('id'), 'result': self._dispatch(ws, r['method'], r.get('params', []))}
+                     for r in requests]
+        if self.rpc_latency:
+            await asyncio.sleep(self.rpc_latency)
+        try:
+            await ws.send(json.dumps(responses if isinstance(request, list) else responses[0]))
+        except websockets.ConnectionClosed:
+            pass
+
+    def _dispatch(self, ws, method: str, params: List[Any]):
+        if method == 'eth_subscribe':
+            self._next_id += 1
+            sub_id = hex(self._next_id)
+            self._subscriptions[sub_id] = {
+                'ws': ws,
+                'kind': params[0],
+                'filter': params[1] if len(params) > 1 else None,
+            }
+            return sub_id
+        if method == 'eth_unsubscribe':
+            return self._subscriptions.pop(params[0], None) is not None
+        if method == 'eth_blockNumber':
+            return hex(self.block_number)
+        if method == 'eth_chainId':
+            return hex(self.chain_id)
+        if method == 'net_version':
+            return str(self.chain_id)
+        if method == 'eth_call':
+            return self._call(params[0])
+        if method == 'eth_getBlockByNumber':
+            number = self.block_number if params[0] == 'latest' else int(params[0], 16)
+            return make_block_header(number, 1_700_000_000 + number * 12)
+        if method == 'eth_getTransactionByHash':
+            return self.transactions.get(params[0])
+        return None
+
+    async def _notify(self, kind: str, result: Any, matches=lambda f: True):
+        self._notify_nowait(kind, result, matches)
+
+    def _notify_nowait(self, kind: str, result: Any, matches=lambda f: True) -> int:
+        sent = 0
+        for sub_id, sub in list(self._subscriptions.items()):
+            if sub['kind'] != kind or not matches(sub['filter']):
+                continue
+            payload = result
+            if kind == 'newPendingTransactions' and sub['filter'] is not True:
+                payload = result['hash']
+            msg = {
+                'jsonrpc': '2.0',
+                'method': 'eth_subscription',
+                'params': {'subscription': sub_id, 'result': payload},
+            }
+            # queued on the connection without waiting, closed ones are skipped
+            websockets.broadcast([sub['ws']], json.dumps(msg))
+            sent += 1
+        return sent
+
+    async def publish_block(self, header: Dict[str, Any]):
+        self.block_number = int(header['number'], base=16)
+        await self._notify('newHeads', header)
+
+    async def publish_log(self, log: Dict[str, Any]):
+        self._publish_log(log)
+
+    def _publish_log(self, log: Dict[str, Any]) -> int:
+        def _matches(log_filter):
+            if not log_filter:
+                return True
+            addresses = log_filter.get('address')
+            if addresses:
+                addresses = [addresses] if isinstance(addresses, str) else addresses
+                if log['address'].lower() not in [a.lower() for a in addresses]:
+                    return False
+            topics = log_filter.get('topics') or []
+            for i, topic in enumerate(topics):
+                if topic is None:
+                    continue
+                allowed = topic if isinstance(topic, list) else [topic]
+                if i >= len(log['topics']) or log['topics'][i] not in allowed:
+                    return False
+            return True
+
+        return self._notify_nowait('logs', log, _matches)
+
+    async def publish_pending_tx(self, tx: Dict[str, Any]):
+        self.transactions[tx['hash']] = tx
+        await self._notify('newPendingTransactions', tx)
+
+    def publish_update(self, address: str, silent: bool = False) -> Dict[str, Any]:
+        """
+        One swap on a pool: the price moves by a small random step and the
+        pool's Swap (V3) or Sync (V2) log is published
+        """
+        pool = self.pools[address]
+        step = math.exp(self.rng.gauss(0, 5e-4))
+        if pool['version'] == 3:
+            pool['sqrtPriceX96'] = int(pool['sqrtPriceX96'] * math.sqrt(step))
+            pool['tick'] = math.floor(math.log((pool['sqrtPriceX96'] / 2 ** 96) ** 2, 1.0001))
+            amount0 = self.rng.randint(1, 10 ** 18) * (1 if step < 1 else -1)
+            amount1 = -amount0 * 2000 // 10 ** 12
+            topics = [SWAP_V3_TOPIC, '0x' + _word(0xE592427A0AEce92De3Edee1F18E0157C05861564), '0x' + _word(1)]
+            data = '0x' + ''.join(_word(v) for v in (amount0, amount1, pool['sqrtPriceX96'], pool['liquidity'], pool['tick']))
+        else:
+            pool['reserve1'] = int(pool['reserve1'] * math.sqrt(step))
+            pool['reserve0'] = int(pool['reserve0'] / math.sqrt(step))
+            topics = [SYNC_V2_TOPIC]
+            data = '0x' + _word(pool['reserve0']) + _word(pool['reserve1'])
+
+        self._log_index += 1
+        log = {
+            'address': address,
+            'topics': topics,
+            'data': data,
+            'blockNumber': hex(self.block_number),
+            'blockHash': '0x' + _word(self.block_number),
+            'transactionHash': '0x' + _word(time.time_ns()),
+            'transactionIndex': hex(self._log_index),
+            'logIndex': hex(self._log_index),
+            'removed': False,
+        }
+        if not silent:
+            self.resend(address, log)
+        return log
+
+    def resend(self, address: str, log: Dict[str, Any]):
+        if self._publish_log(log):
+            self.updates_sent += 1
+
+    def new_block(self, silent: bool = False) -> Dict[str, Any]:
+        self.block_number += 1
+        self._log_index = 0
+        header = make_block_header(self.block_number, int(time.time()))
+        header['hash'] = '0x' + _word(time.time_ns())
+        if not silent and self._notify_nowait('newHeads', header):
+            self.blocks_sent += 1
+        return header
+
+    async def run(self, block_time: float = 12.0, swap_rate: float = 1.0, duration: Optional[float] = None,
+                  pathologies: Optional['Pathologies'] = None) -> Dict[str, int]:
+        """
+        A block every `block_time` seconds and `swap_rate` swaps per second
+        per pool; a gap skips a block number or a log
+        """
+        gap_prob = pathologies.gap_prob if pathologies is not None else 0.0
+
+        async def _blocks():
+            started = time.monotonic()
+            while duration is None or time.monotonic() - started < duration:
+                self.new_block(silent=self.rng.random() < gap_prob)
+                await asyncio.sleep(block_time)
+
+        _, stats = await asyncio.gather(_blocks(), _drive(self, swap_rate, duration, pathologies))
+        return stats
+
+    async def drop_connections(self):
+        for ws in {sub['ws'] for sub in self._subscriptions.values()}:
+            await ws.close()
+
+
+class MockConnexExchange:
+    """
+    Local stand-in for the Connex WS and REST APIs, for testing
+    stream_connex_orderbook offline
+
+    WS: {'op': 'auth', ...} signed like the REST calls, then
+    {'op': 'subscribe', 'channel': 'orderbook', 'symbols': [...]}, then deltas
+    {'channel': 'orderbook', 'symbol', 'timestamp', 'seq', 'prev_seq', 'bids', 'asks'}
+    REST: signed GET /api/v1/depth?symbol=ETHUSDT&limit=100
+
+    publish_update(silent=True) advances a book without sending the delta, to
+    force a sequence gap; drop_connections() closes every client socket
+
+    exchange = await MockConnexExchange().start()
+    asyncio.ensure_future(exchange.run(rate=1000))
+    await stream_connex_orderbook(['ETH/USDT'], event_queue, ws_url=exchange.ws_url,
+                                  rest_url=exchange.rest_url, api_key='test-key', api_secret='test-secret')
+    """
+
+    def __init__(self,
+                 host: str = 'localhost',
+                 ws_port: int = 8765,
+                 rest_port: int = 8766,
+                 api_key: str = 'test-key',
+                 api_secret: str = 'test-secret',
+                 symbols: List[str] = ('ETHUSDT',),
+                 mid_price: float = 2000.0,
+                 levels: int = 20,
+                 seed: int = 0):
+        self.host = host
+        self.ws_port = ws_port
+        self.rest_port = rest_port
+        self.api_key = api_key
+        self.api_secret = api_secret
+        self.symbols = list(symbols)
+        self.rng = random.Random(seed)
+        self.ws_server = None
+        self.rest_server = None
+        self.subscribers: Dict[str, Set[Any]] = {symbol: set() for symbol in symbols}
+        self.updates_sent = 0
+        self.snapshots_served = 0
+        self.connections = 0
+        self.auth_failures = 0
+
+        # prices in ticks of 0.01
+        mid = int(mid_price * 100)
+        self.books: Dict[str, Dict[str, Any]] = {}
+        for symbol in symbols:
+            self.books[symbol] = {
+                'mid': mid,
+                'seq': 1,
+                'bids': {mid - i: self._random_qty() for i in range(1, levels + 1)},
+                'asks': {mid + i: self._random_qty() for i in range(1, levels + 1)},
+            }
+
+    @property
+    def ws_url(self) -> str:
+        return f'ws://{self.host}:{self.ws_port}'
+
+    @property
+    def rest_url(self) -> str:
+        return f'http://{self.host}:{self.rest_port}'
+
+    async def start(self):
+        self.ws_server = await websockets.serve(self._ws_handler, self.host, self.ws_port)
+        self.rest_server = await asyncio.start_server(self._rest_handler, self.host, self.rest_port)
+        return self
+
+    async def stop(self):
+        for server in (self.ws_server, self.rest_server):
+            if server is not None:
+                server.close()
+                await server.wait_closed()
+
+    def _random_qty(self) -> str:
+        return f'{self.rng.uniform(0.1, 50):.3f}'
+
+    def _verify(self, key: str, timestamp: str, signature: str, method: str, path: str) -> bool:
+        expected = hmac.new(self.api_secret.encode(),
+                            f'{timestamp}{method}{path}'.encode(),
+                            hashlib.sha256).hexdigest()
+        ok = key == self.api_key and hmac.compare_digest(expected, signature or '')
+        if not ok:
+            self.auth_failures += 1
+        return ok
+
+    async def _ws_handler(self, ws, path: Optional[str] = None):
+        self.connections += 1
+        try:
+            request = json.loads(await ws.recv())
+            args = request.get('args') or {}
+            if request.get('op') != 'auth' or \
+                    not self._verify(args.get('key'), args.get('timestamp'), args.get('signature'), 'GET', '/ws/auth'):
+                await ws.send(json.dumps({'event': 'auth', 'success': False}))
+                return
+            await ws.send(json.dumps({'event': 'auth', 'success': True}))
+
+            async for msg in ws:
+                request = json.loads(msg)
+                if request.get('op') == 'subscribe':
+                    unknown = [s for s in request.get('symbols', []) if s not in self.books]
+                    if unknown:
+                        await ws.send(json.dumps({'event': 'error', 'success': False, 'msg': f'unknown symbols {unknown}'}))
+                        continue
+                    for symbol in request['symbols']:
+                        self.subscribers[symbol].add(ws)
+                    await ws.send(json.dumps({'event': 'subscribe', 'success': True}))
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            for subscribers in self.subscribers.values():
+                subscribers.discard(ws)
+
+    async def _rest_handler(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            # keep-alive: serve requests until the client closes the pooled connection
+            while True:
+                request = await reader.readline()
+                if not request:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode().partition(':')
+                    headers[name.strip().lower()] = value.strip()
+
+                method, path = request.decode().split(' ')[:2]
+                url = urlsplit(path)
+                query = parse_qs(url.query)
+                symbol = (query.get('symbol') or [''])[0]
+
+                if not self._verify(headers.get('x-connex-apikey'), headers.get('x-connex-timestamp'),
+                                    headers.get('x-connex-signature'), method, path):
+                    status, body = '401 Unauthorized', {'error': 'invalid signature'}
+                elif url.path != '/api/v1/depth' or symbol not in self.books:
+                    status, body = '404 Not Found', {'error': 'not found'}
+                else:
+                    status, body = '200 OK', self.snapshot(symbol, int((query.get('limit') or [100])[0]))
+                    self.snapshots_served += 1
+
+                payload = json.dumps(body).encode()
+                writer.write(
+                    f'HTTP/1.1 {status}\r\n'
+                    f'Content-Type: application/json\r\n'
+                    f'Content-Length: {len(payload)}\r\n\r\n'.encode() + payload
+                )
+                await writer.drain()
+        except (ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    def snapshot(self, symbol: str, limit: int = 100) -> Dict[str, Any]:
+        book = self.books[symbol]
+        return {
+            'symbol': symbol,
+            'timestamp': int(time.time() * 1000),
+            'seq': book['seq'],
+            'bids': [[f'{p / 100:.2f}', q] for p, q in sorted(book['bids'].items(), reverse=True)[:limit]],
+            'asks': [[f'{p / 100:.2f}', q] for p, q in sorted(book['asks'].items())[:limit]],
+        }
+
+    def publish_update(self, symbol: str, silent: bool = False) -> Dict[str, Any]:
+        """
+        Random walk of the mid by one tick plus 1-3 level changes near the
+        top. Levels crossed by the new mid are removed
+        """
+        book = self.books[symbol]
+        book['mid'] += self.rng.choice((-1, 0, 0, 1))
+        mid = book['mid']
+        changes = {'bids': [], 'asks': []}
+
+        for p in [p for p in book['bids'] if p >= mid]:
+            del book['bids'][p]
+            changes['bids'].append([f'{p / 100:.2f}', '0'])
+        for p in [p for p in book['asks'] if p <= mid]:
+            del book['asks'][p]
+            changes['asks'].append([f'{p / 100:.2f}', '0'])
+
+        for _ in range(self.rng.randint(1, 3)):
+            side = self.rng.choice(('bids', 'asks'))
+            offset = self.rng.randint(1, 10)
+            price = mid - offset if side == 'bids' else mid + offset
+            qty = '0' if self.rng.random() < 0.2 and price in book[side] else self._random_qty()
+            if qty == '0':
+                del book[side][price]
+            else:
+                book[side][price] = qty
+            changes[side].append([f'{price / 100:.2f}', qty])
+
+        book['seq'] += 1
+        update = {
+            'channel': 'orderbook',
+            'symbol': symbol,
+            'timestamp': int(time.time() * 1000),
+            'seq': book['seq'],
+            'prev_seq': book['seq'] - 1,
+            **changes,
+        }
+        if not silent:
+            self.resend(symbol, update)
+        return update
+
+    def resend(self, symbol: str, update: Dict[str, Any]):
+        if self.subscribers[symbol]:
+            websockets.broadcast(self.subscribers[symbol], json.dumps(update))
+            self.updates_sent += 1
+
+    async def run(self, rate: float = 100.0, duration: Optional[float] = None,
+                  pathologies: Optional['Pathologies'] = None) -> Dict[str, int]:
+        """
+        Publishes `rate` updates per second per symbol, in batches every 10ms
+        """
+        return await _drive(self, rate, duration, pathologies)
+
+    async def drop_connections(self):
+        clients = set().union(*self.subscribers.values())
+        for ws in clients:
+            await ws.close()
+
+
+class Pathologies:
+    """
+    Misbehaviour injected by the mock feeds' run():
+
+    gap_prob:          share of updates generated but never sent (sequence gaps)
+    duplicate_prob:    share of updates sent twice
+    disconnect_every:  seconds between closing every client connection
+    burst_every:       seconds between bursts of `burst_size` extra updates per
+                       symbol (or swaps, for the node), sent back to back
+    """
+
+    __slots__ = ('gap_prob', 'duplicate_prob', 'disconnect_every', 'burst_every', 'burst_size')
+
+    def __init__(self,
+                 gap_prob: float = 0.0,
+                 duplicate_prob: float = 0.0,
+                 disconnect_every: Optional[float] = None,
+                 burst_every: Optional[float] = None,
+                 burst_size: int = 100):
+        self.gap_prob = gap_prob
+        self.duplicate_prob = duplicate_prob
+        self.disconnect_every = disconnect_every
+        self.burst_every = burst_every
+        self.burst_size = burst_size
+
+
+async def _drive(feed, rate: float, duration: Optional[float], pathologies: Optional[Pathologies]) -> Dict[str, int]:
+    """
+    Calls feed.publish_update(symbol, silent) `rate` times per second per
+    symbol, in batches every 10ms, applying the pathologies. Returns how many
+    updates were generated and how many of them each pathology affected
+    """
+    pathologies = pathologies or Pathologies()
+    rng = feed.rng
+    started = time.monotonic()
+    next_disconnect = started + pathologies.disconnect_every if pathologies.disconnect_every else None
+    next_burst = started + pathologies.burst_every if pathologies.burst_every else None
+    interval = 0.01
+    due = 0.0
+    last = started
+    stats = {'updates': 0, 'gaps': 0, 'duplicates': 0, 'bursts': 0, 'disconnects': 0}
+
+    def _publish(symbol):
+        silent = pathologies.gap_prob and rng.random() < pathologies.gap_prob
+        update = feed.publish_update(symbol, silent=silent)
+        stats['updates'] += 1
+        if silent:
+            stats['gaps'] += 1
+        elif pathologies.duplicate_prob and rng.random() < pathologies.duplicate_prob:
+            feed.resend(symbol, update)
+            stats['duplicates'] += 1
+
+    while duration is None or time.monotonic() - started < duration:
+        now = time.monotonic()
+        # catch up on elapsed time, not the nominal interval, so a slow
+        # iteration does not lower the rate
+        due += rate * (now - last)
+        last = now
+        for _ in range(int(due)):
+            for symbol in feed.symbols:
+                _publish(symbol)
+        due -= int(due)
+        if next_burst is not None and now >= next_burst:
+            for _ in range(pathologies.burst_size):
+                for symbol in feed.symbols:
+                    _publish(symbol)
+            next_burst += pathologies.burst_every
+            stats['bursts'] += 1
+        if next_disconnect is not None and now >= next_disconnect:
+            await feed.drop_connections()
+            next_disconnect += pathologies.disconnect_every
+            stats['disconnects'] += 1
+        await asyncio.sleep(interval)
+    return stats
+
+
+async def _serve_json_http(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, respond,
+                           latency: float = 0.0):
+    """
+    Minimal keep-alive HTTP/1.1 server loop: respond(method, path, body bytes)
+    returns (status line, JSON-serializable body), sent after `latency` seconds
+    """
+    try:
+        while True:
+            request = await reader.readline()
+            if not request:
+                break
+            length = 0
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, _, value = line.decode().partition(':')
+                if name.strip().lower() == 'content-length':
+                    length = int(value)
+            body = await reader.readexactly(length) if length else b''
+            method, path = request.decode().split(' ')[:2]
+            status, result = respond(method, path, body)
+            payload = json.dumps(result).encode()
+            if latency:
+                await asyncio.sleep(latency)
+            writer.write(
+                f'HTTP/1.1 {status}\r\n'
+                f'Content-Type: application/json\r\n'
+                f'Content-Length: {len(payload)}\r\n\r\n'.encode() + payload
+            )
+            await writer.drain()
+    except (ConnectionError, ValueError, asyncio.IncompleteReadError):
+        pass
+    except asyncio.CancelledError:
+        # server shutting down with the client's keep-alive connection open
+        pass
+    finally:
+        writer.close()
+
+
+class SyntheticDepth:
+    """
+    Top-of-book generator for the partial depth feeds: the mid walks by one
+    tick and one level's quantity changes on every step, so consecutive
+    snapshots always differ
+    """
+
+    def __init__(self, rng: random.Random, mid_price: float, levels: int, tick: float = 0.01):
+        self.rng = rng
+        self.tick = tick
+        self.levels = levels
+        self.mid = int(mid_price / tick)
+        self.bid_qty = [self._qty() for _ in range(levels)]
+        self.ask_qty = [self._qty() for _ in range(levels)]
+
+    def _qty(self) -> str:
+        return f'{self.rng.uniform(0.1, 50):.3f}'
+
+    def step(self):
+        self.mid += self.rng.choice((-1, 0, 0, 1))
+        side = self.bid_qty if self.rng.random() < 0.5 else self.ask_qty
+        side[self.rng.randrange(self.levels)] = self._qty()
+
+    def top(self) -> Tuple[List[List[str]], List[List[str]]]:
+        decimals = max(0, -int(math.floor(math.log10(self.tick))))
+        bids = [[f'{(self.mid - i) * self.tick:.{decimals}f}', q] for i, q in enumerate(self.bid_qty, start=1)]
+        asks = [[f'{(self.mid + i) * self.tick:.{decimals}f}', q] for i, q in enumerate(self.ask_qty, start=1)]
+        return bids, asks
+
+
+class MockBinanceExchange:
+    """
+    Local stand-in for the Binance USDM futures partial depth stream
+    (<symbol>@depth5@100ms style: full top-N books with u / pu update ids)
+    and the REST /fapi/v1/depth endpoint stream_binance_usdm_orderbook falls
+    back to
+
+    exchange = await MockBinanceExchange(symbols=('ETHUSDT', 'BTCUSDT')).start()
+    asyncio.ensure_future(exchange.run(rate=1000, pathologies=Pathologies(gap_prob=0.001)))
+    await stream_binance_usdm_orderbook(['ETH/USDT', 'BTC/USDT'], event_queue,
+                                        ws_urls=[exchange.ws_url], rest_url=exchange.rest_url)
+    """
+
+    def __init__(self,
+                 host: str = 'localhost',
+                 ws_port: int = 8771,
+                 rest_port: int = 8772,
+                 symbols: List[str] = ('ETHUSDT',),
+                 mid_price: float = 2000.0,
+                 levels: int = 5,
+                 seed: int = 0):
+        self.host = host
+        self.ws_port = ws_port
+        self.rest_port = rest_port
+        self.symbols = list(symbols)
+        self.rng = random.Random(seed)
+        self.ws_server = None
+        self.rest_server = None
+        self.books = {symbol: SyntheticDepth(self.rng, mid_price * (i + 1), levels) for i, symbol in enumerate(self.symbols)}
+        self.update_ids = {symbol: 1_000_000 for symbol in self.symbols}
+        self.subscribers: Dict[str, Set[Any]] = {symbol: set() for symbol in self.symbols}
+        self.updates_sent = 0
+        self.connections = 0
+
+    @property
+    def ws_url(self) -> str:
+        return f'ws://{self.host}:{self.ws_port}/ws/'
+
+    @property
+    def rest_url(self) -> str:
+        return f'http://{self.host}:{self.rest_port}'
+
+    async def start(self):
+        self.ws_server = await websockets.serve(self._ws_handler, self.host, self.ws_port)
+        self.rest_server = await asyncio.start_server(
+            lambda r, w: _serve_json_http(r, w, self._respond), self.host, self.rest_port)
+        return self
+
+    async def stop(self):
+        for server in (self.ws_server, self.rest_server):
+            if server is not None:
+                server.close()
+                await server.wait_closed()
+
+    async def _ws_handler(self, ws, path: Optional[str] = None):
+        self.connections += 1
+        try:
+            async for msg in ws:
+                request = json.loads(msg)
+                if request.get('method') == 'SUBSCRIBE':
+                    for stream in request.get('params', []):
+                        symbol = stream.split('@')[0].upper()
+                        if symbol in self.subscribers:
+                            self.subscribers[symbol].add(ws)
+                    await ws.send(json.dumps({'result': None, 'id': request.get('id')}))
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            for subscribers in self.subscribers.values():
+                subscribers.discard(ws)
+
+    def _respond(self, method: str, path: str, body: bytes):
+        url = urlsplit(path)
+        symbol = (parse_qs(url.query).get('symbol') or [''])[0]
+        if url.path != '/fapi/v1/depth' or symbol not in self.books:
+            return '404 Not Found', {'code': -1121, 'msg': 'Invalid symbol.'}
+        bids, asks = self.books[symbol].top()
+        now = int(time.time() * 1000)
+        return '200 OK', {'lastUpdateId': self.update_ids[symbol], 'E': now, 'T': now, 'bids': bids, 'asks': asks}
+
+    def publish_update(self, symbol: str, silent: bool = False) -> Dict[str, Any]:
+        book = self.books[symbol]
+        book.step()
+        bids, asks = book.top()
+        prev = self.update_ids[symbol]
+        self.update_ids[symbol] = prev + self.rng.randint(1, 5)
+        now = int(time.time() * 1000)
+        update = {
+            'e': 'depthUpdate', 'E': now, 'T': now, 's': symbol,
+            'U': prev + 1, 'u': self.update_ids[symbol], 'pu': prev,
+            'b': bids, 'a': asks,
+        }
+        if not silent:
+            self.resend(symbol, update)
+        return update
+
+    def resend(self, symbol: str, update: Dict[str, Any]):
+        if self.subscribers[symbol]:
+            websockets.broadcast(self.subscribers[symbol], json.dumps(update))
+            self.updates_sent += 1
+
+    async def run(self, rate: float = 10.0, duration: Optional[float] = None,
+                  pathologies: Optional[Pathologies] = None) -> Dict[str, int]:
+        return await _drive(self, rate, duration, pathologies)
+
+    async def drop_connections(self):
+        for ws in set().union(*self.subscribers.values()):
+            await ws.close()
+
+
+class MockOkxExchange:
+    """
+    Local stand-in for the OKX public books5 channel and the
+    /api/v5/public/instruments endpoint stream_okx_usdm_orderbook reads
+    contract multipliers from (served as 1, so sizes come through unscaled)
+
+    exchange = await MockOkxExchange(symbols=('ETH-USDT-SWAP',)).start()
+    asyncio.ensure_future(exchange.run(rate=100))
+    await stream_okx_usdm_orderbook(['ETH/USDT'], event_queue, ws_url=exchange.ws_url, rest_url=exchange.rest_url)
+    """
+
+    def __init__(self,
+                 host: str = 'localhost',
+                 ws_port: int = 8773,
+                 rest_port: int = 8774,
+                 symbols: List[str] = ('ETH-USDT-SWAP',),
+                 mid_price: float = 2000.0,
+                 levels: int = 5,
+                 seed: int = 0):
+        self.host = host
+        self.ws_port = ws_port
+        self.rest_port = rest_port
+        self.symbols = list(symbols)
+        self.rng = random.Random(seed)
+        self.ws_server = None
+        self.rest_server = None
+        self.books = {symbol: SyntheticDepth(self.rng, mid_price * (i + 1), levels) for i, symbol in enumerate(self.symbols)}
+        self.seq_ids = {symbol: 1_000_000 for symbol in self.symbols}
+        self.subscribers: Dict[str, Set[Any]] = {symbol: set() for symbol in self.symbols}
+        self.updates_sent = 0
+        self.connections = 0
+
+    @property
+    def ws_url(self) -> str:
+        return f'ws://{self.host}:{self.ws_port}/ws/v5/public'
+
+    @property
+    def rest_url(self) -> str:
+        return f'http://{self.host}:{self.rest_port}'
+
+    async def start(self):
+        self.ws_server = await websockets.serve(self._ws_handler, self.host, self.ws_port)
+        self.rest_server = await asyncio.start_server(
+            lambda r, w: _serve_json_http(r, w, self._respond), self.host, self.rest_port)
+        return self
+
+    async def stop(self):
+        for server in (self.ws_server, self.rest_server):
+            if server is not None:
+                server.close()
+                await server.wait_closed()
+
+    async def _ws_handler(self, ws, path: Optional[str] = None):
+        self.connections += 1
+        try:
+            async for msg in ws:
+                request = json.loads(msg)
+                if request.get('op') == 'subscribe':
+                    # one ack per channel argument, like OKX
+                    for arg in request.get('args', []):
+                        if arg.get('instId') in self.subscribers:
+                            self.subscribers[arg['instId']].add(ws)
+                            await ws.send(json.dumps({'event': 'subscribe', 'arg': arg}))
+                        else:
+                            await ws.send(json.dumps({'event': 'error', 'code': '60018',
+                                                      'msg': f'Wrong URL or channel:{arg}'}))
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            for subscribers in self.subscribers.values():
+                subscribers.discard(ws)
+
+    def _respond(self, method: str, path: str, body: bytes):
+        if urlsplit(path).path != '/api/v5/public/instruments':
+            return '404 Not Found', {'code': '404', 'msg': 'not found'}
+        # the stream keys multipliers by instId.replace('USD', 'USDT')
+        data = [{'instId': symbol.replace('USDT', 'USD'), 'ctMult': '1', 'ctVal': '1'} for symbol in self.symbols]
+        return '200 OK', {'code': '0', 'msg': '', 'data': data}
+
+    def publish_update(self, symbol: str, silent: bool = False) -> Dict[str, Any]:
+        book = self.books[symbol]
+        book.step()
+        bids, asks = book.top()
+        prev = self.seq_ids[symbol]
+        self.seq_ids[symbol] = prev + self.rng.randint(1, 5)
+        update = {
+            'arg': {'channel': 'books5', 'instId': symbol},
+            'data': [{
+                'asks': [[p, q, '0', '1'] for p, q in asks],
+                'bids': [[p, q, '0', '1'] for p, q in bids],
+                'instId': symbol,
+                'ts': str(int(time.time() * 1000)),
+                'seqId': self.seq_ids[symbol],
+                'prevSeqId': prev,
+            }],
+        }
+        if not silent:
+            self.resend(symbol, update)
+        return update
+
+    def resend(self, symbol: str, update: Dict[str, Any]):
+        if self.subscribers[symbol]:
+            websockets.broadcast(self.subscribers[symbol], json.dumps(update))
+            self.updates_sent += 1
+
+    async def run(self, rate: float = 10.0, duration: Optional[float] = None,
+                  pathologies: Optional[Pathologies] = None) -> Dict[str, int]:
+        return await _drive(self, rate, duration, pathologies)
+
+    async def drop_connections(self):
+        for ws in set().union(*self.subscribers.values()):
+            await ws.close()
+
+
+def make_block_header(number: int,
+                      timestamp: int,
+                      base_fee: int = 20 * 10 ** 9,
+                      gas_used: int = 15_000_000,
+                      gas_limit: int = 30_000_000) -> Dict[str, Any]:
+    return {
+        'number': hex(number),
+        'hash': '0x' + number.to_bytes(32, 'big').hex(),
+        'timestamp': hex(timestamp),
+        'baseFeePerGas': hex(base_fee),
+        'gasUsed': hex(gas_used),
+        'gasLimit': hex(gas_limit),
+    }
+
+
+if __name__ == '__main__':
+    import sys
+
+    """
+    python mock_servers.py           # Ethereum node publishing a block every 12s
+    python mock_servers.py connex    # Connex WS/REST at 1000 updates/s
+    python mock_servers.py binance   # Binance USDⓈ-M depth WS/REST at 1000 updates/s per symbol
+    python mock_servers.py okx       # OKX books5 WS/REST at 1000 updates/s per symbol
+    """
+    async def _main():
+        node = await MockEthereumNode().start()
+        print(f'Mock Ethereum node listening on {node.url}')
+        number = 18_000_000
+        while True:
+            await node.publish_block(make_block_header(number, 1_700_000_000 + number * 12))
+            number += 1
+            await asyncio.sleep(12)
+
+    async def _connex_main():
+        exchange = await MockConnexExchange().start()
+        print(f'Mock Connex listening on {exchange.ws_url} (WS) and {exchange.rest_url} (REST), '
+              f'key={exchange.api_key} secret={exchange.api_secret}')
+        await exchange.run(rate=1000)
+
+    async def _cex_main(exchange):
+        await exchange.start()
+        print(f'Mock {exchange.__class__.__name__} listening on {exchange.ws_url} (WS) and {exchange.rest_url} (REST)')
+        await exchange.run(rate=1000)
+
+    mains = {
+        'connex': _connex_main,
+        'binance': lambda: _cex_main(MockBinanceExchange()),
+        'okx': lambda: _cex_main(MockOkxExchange()),
+    }
+    asyncio.run(mains.get(sys.argv[1] if sys.argv[1:] else None, _main)())
@@ -0,0 +1,319 @@
+import json
+import time
+import asyncio
+
+from typing import Any, Dict, Optional
+from urllib.parse import parse_qs, urlsplit
+
+import profiling
+
+
+class FeedStats:
+
+    __slots__ = ('messages', 'last_update', 'last_seq', 'gaps', 'reconnects',
+                 'rate', '_rate_count', '_rate_time')
+
+    def __init__(self):
+        self.messages = 0
+        self.last_update: Optional[float] = None
+        self.last_seq: Dict[Any, Any] = {}
+        self.gaps = 0
+        self.reconnects = 0
+        self.rate = 0.0
+        self._rate_count = 0
+        self._rate_time = time.monotonic()
+
+
+class FeedMonitor:
+    """
+    Per-feed health counters: message counts and rates, time since the last
+    update, sequence gaps, reconnects, plus the event queue depth and stale
+    orderbook drops reported by the handler
+
+    monitor = FeedMonitor(event_queue, stale_after=5)
+    binance_stream = reconnecting_websocket_loop(
+        partial(stream_binance_usdm_orderbook, symbols, monitor.queue('binance')),
+        tag='binance_stream',
+        on_reconnect=monitor.reconnect_hook('binance'),
+    )
+    await monitor.serve(port=9100)   # GET /metrics, Prometheus text format
+
+    The same server exposes the stage timers of profiling.py as JSON on
+    GET /stages and starts the sampling profiler on GET /profile?seconds=30
+    """
+
+    def __init__(self, event_queue=None, stale_after: float = 10.0):
+        self.event_queue = event_queue
+        self.stale_after = stale_after
+        self.feeds: Dict[str, FeedStats] = {}
+        self.stale_drops: Dict[str, int] = {}
+        self.change_filters: Dict[str, Any] = {}
+        self.bus = None
+        self.scheduler = None
+
+    def feed(self, name: str) -> FeedStats:
+        if name not in self.feeds:
+            self.feeds[name] = FeedStats()
+        return self.feeds[name]
+
+    def observe(self, name: str, event: Dict[str, Any]):
+        stats = self.feed(name)
+        stats.messages += 1
+        stats.last_update = time.monotonic()
+
+        # Binance 'pu' / OKX 'prevSeqId' must match the previous update id
+        # of the same symbol, blocks must be consecutive
+        symbol = event.get('symbol')
+        last_seq = stats.last_seq.get(symbol)
+        if event.get('type') == 'block':
+            seq = event.get('block_number')
+            if last_seq is not None and seq is not None and seq > last_seq + 1:
+                stats.gaps += 1
+        else:
+            seq, prev = event.get('update_id'), event.get('prev_update_id')
+            if prev is not None and last_seq is not None and prev != last_seq:
+                stats.gaps += 1
+        if seq is not None:
+            stats.last_seq[symbol] = seq
+
+    def on_reconnect(self, name: str):
+        self.feed(name).reconnects += 1
+
+    def reconnect_hook(self, name: str):
+        return lambda: self.on_reconnect(name)
+
+    def watch_filter(self, name: str, change_filter):
+        """
+        Reports a stream's utils.BookChangeFilter counters with the feed
+        """
+        self.change_filters[name] = change_filter
+
+    def watch_bus(self, bus):
+        """
+        Reports the per-subscriber queue depth, drops and lag of an event_bus.EventBus
+        """
+        self.bus = bus
+
+    def watch_scheduler(self, scheduler):
+        """
+        Reports the per-chain throughput, blocks, depth and delay of a chains.ChainScheduler
+        """
+        self.scheduler = scheduler
+
+    def on_stale_drop(self, exchange: str):
+        self.stale_drops[exchange] = self.stale_drops.get(exchange, 0) + 1
+
+    def queue(self, name: str, event_queue=None) -> 'MonitoredQueue':
+        return MonitoredQueue(self, name, event_queue or self.event_queue)
+
+    def queue_depth(self) -> Optional[int]:
+        if self.event_queue is None:
+            return None
+        try:
+            return self.event_queue.qsize()
+        except NotImplementedError:
+            # multiprocessing queues on macOS
+            return None
+
+    def is_stale(self, name: str) -> bool:
+        stats = self.feed(name)
+        return stats.last_update is None or time.monotonic() - stats.last_update > self.stale_after
+
+    def snapshot(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        feeds = {}
+        for name, stats in self.feeds.items():
+            elapsed = now - stats._rate_time
+            if elapsed >= 1.0:
+                stats.rate = (stats.messages - stats._rate_count) / elapsed
+                stats._rate_count, stats._rate_time = stats.messages, now
+            change_filter = self.change_filters.get(name)
+            feeds[name] = {
+                'messages': stats.messages,
+                'suppressed': change_filter.suppressed if change_filter is not None else None,
+                'heartbeats': change_filter.heartbeats if change_filter is not None else None,
+                'rate': stats.rate,
+                'seconds_since_update': now - stats.last_update if stats.last_update else None,
+                'gaps': stats.gaps,
+                'reconnects': stats.reconnects,
+                'stale': self.is_stale(name),
+            }
+        return {
+            'feeds': feeds,
+            'queue_depth': self.queue_depth(),
+            'stale_drops': dict(self.stale_drops),
+            'subscribers': {s['name']: s for s in self.bus.stats()} if self.bus is not None else {},
+            'chains': {s['name']: s for s in self.scheduler.stats()} if self.scheduler is not None else {},
+            'stages': profiling.stats(),
+        }
+
+    def render(self) -> str:
+        snapshot = self.snapshot()
+        metrics = [
+            ('feed_messages_total', 'counter', 'Events published by the feed', 'messages'),
+            ('feed_suppressed_total', 'counter', 'Unchanged books skipped at the source', 'suppressed'),
+            ('feed_heartbeats_total', 'counter', 'Unchanged books forwarded as heartbeats', 'heartbeats'),
+            ('feed_message_rate', 'gauge', 'Events per second since the last scrape', 'rate'),
+            ('feed_seconds_since_update', 'gauge', 'Seconds since the last event', 'seconds_since_update'),
+            ('feed_sequence_gaps_total', 'counter', 'Detected sequence gaps', 'gaps'),
+            ('feed_reconnects_total', 'counter', 'Reconnects of the feed', 'reconnects'),
+            ('feed_stale', 'gauge', f'1 if no event for more than {self.stale_after}s', 'stale'),
+        ]
+        lines = []
+        for metric, kind, help_text, field in metrics:
+            lines.append(f'# HELP {metric} {help_text}')
+            lines.append(f'# TYPE {metric} {kind}')
+            for name, values in snapshot['feeds'].items():
+                value = values[field]
+                if value is None:
+                    continue
+                lines.append(f'{metric}{{feed="{name}"}} {float(value)}')
+
+        if snapshot['queue_depth'] is not None:
+            lines.append('# HELP event_queue_depth Events waiting in the handler queue')
+            lines.append('# TYPE event_queue_depth gauge')
+            lines.append(f'event_queue_depth {snapshot["queue_depth"]}')
+
+        lines.append('# HELP orderbook_stale_drops_total Venue books dropped from the MultiOrderbook as stale')
+        lines.append('# TYPE orderbook_stale_drops_total counter')
+        for exchange, count in snapshot['stale_drops'].items():
+            lines.append(f'orderbook_stale_drops_total{{exchange="{exchange}"}} {count}')
+
+        subscriber_metrics = [
+            ('bus_queue_depth', 'gauge', 'Events waiting in the subscriber queue', 'depth'),
+            ('bus_delivered_total', 'counter', 'Events taken by the subscriber', 'delivered'),
+            ('bus_dropped_total', 'counter', 'Events dropped for a full subscriber queue', 'dropped'),
+            ('bus_conflated_total', 'counter', 'Events merged into a queued event with the same key', 'conflated'),
+            ('bus_overflows_total', 'counter', 'Events queued past maxsize (block put, new conflate keys)', 'overflows'),
+            ('bus_lag_seconds', 'gauge', 'Age of the oldest queued event', 'lag'),
+            ('bus_max_delay_seconds', 'gauge', 'Longest enqueue-to-delivery delay', 'max_delay'),
+            ('bus_max_hold_seconds', 'gauge', 'Longest the subscriber held the event loop on one event', 'max_hold'),
+        ]
+        if snapshot['subscribers']:
+            for metric, kind, help_text, field in subscriber_metrics:
+                lines.append(f'# HELP {metric} {help_text}')
+                lines.append(f'# TYPE {metric} {kind}')
+                for name, values in snapshot['subscribers'].items():
+                    lines.append(f'{metric}{{subscriber="{name}",policy="{values["policy"]}"}} {float(values[field])}')
+
+        chain_metrics = [
+            ('chain_events_total', 'counter', 'Events published on the chain', 'received'),
+            ('chain_event_rate', 'gauge', 'Events per second published on the chain', 'rate'),
+            ('chain_delivery_rate', 'gauge', 'Events per second taken by the handler', 'delivery_rate'),
+            ('chain_blocks_total', 'counter', 'Blocks seen on the chain', 'blocks'),
+            ('chain_seconds_since_block', 'gauge', 'Seconds since the last block', 'seconds_since_block'),
+            ('chain_queue_depth', 'gauge', 'Events of the chain waiting for the handler', 'depth'),
+            ('chain_dropped_total', 'counter', 'Events dropped for a full chain queue', 'dropped'),
+            ('chain_conflated_total', 'counter', 'Events merged into a queued event of the same pool', 'conflated'),
+            ('chain_lag_seconds', 'gauge', 'Age of the oldest queued event of the chain', 'lag'),
+            ('chain_max_delay_seconds', 'gauge', 'Longest enqueue-to-handler delay', 'max_delay'),
+        ]
+        if snapshot['chains']:
+            for metric, kind, help_text, field in chain_metrics:
+                lines.append(f'# HELP {metric} {help_text}')
+                lines.append(f'# TYPE {metric} {kind}')
+                for name, values in snapshot['chains'].items():
+                    if values[field] is not None:
+                        lines.append(f'{metric}{{chain="{name}"}} {float(values[field])}')
+
+        stage_metrics = [
+            ('stage_calls_total', 'counter', 'Timed executions of the stage', 'count', 1),
+            ('stage_seconds_total', 'counter', 'Time spent in the stage', 'total_ms', 1e-3),
+            ('stage_p99_seconds', 'gauge', 'p99 duration of the stage (upper bound)', 'p99_us', 1e-6),
+            ('stage_max_seconds', 'gauge', 'Longest duration of the stage', 'max_us', 1e-6),
+        ]
+        if snapshot['stages']:
+            for metric, kind, help_text, field, scale in stage_metrics:
+                lines.append(f'# HELP {metric} {help_text}')
+                lines.append(f'# TYPE {metric} {kind}')
+                for name, values in snapshot['stages'].items():
+                    if values[field] is not None:
+                        lines.append(f'{metric}{{stage="{name}"}} {float(values[field]) * scale}')
+
+        return '\n'.join(lines) + '\n'
+
+    def _profile(self, query: Dict[str, Any]) -> Dict[str, Any]:
+        profiler = profiling.PROFILER
+        if query.get('stop'):
+            return {'stopped': profiler.stop()}
+        if profiler.running:
+            return {'running': True, 'path': profiler.path}
+        seconds = float(query.get('seconds', ['30'])[0])
+        return {'running': True, 'path': profiler.start(seconds), 'seconds': seconds, 'last': profiler.last_report}
+
+    async def _handle_http(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request = await reader.readline()
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass
+            url = urlsplit(request.split(b' ')[1].decode() if request.count(b' ') >= 2 else '/')
+            content_type = 'application/json'
+            if url.path.startswith('/metrics'):
+                status, body = '200 OK', self.render()
+                content_type = 'text/plain; version=0.0.4'
+            elif url.path.startswith('/stages'):
+                status, body = '200 OK', json.dumps(profiling.stats())
+            elif url.path.startswith('/profile'):
+                try:
+                    status, body = '200 OK', json.dumps(self._profile(parse_qs(url.query)))
+                except (ValueError, RuntimeError, AttributeError) as e:
+                    # bad seconds, already running, or no interval timers on this platform
+                    status, body = '400 Bad Request', json.dumps({'error': str(e)})
+            else:
+                status, body = '404 Not Found', 'not found\n'
+                content_type = 'text/plain'
+            payload = body.encode()
+            writer.write(
+                f'HTTP/1.1 {status}\r\n'
+                f'Content-Type: {content_type}\r\n'
+                f'Content-Length: {len(payload)}\r\n'
+                f'Connection: close\r\n\r\n'.encode() + payload
+            )
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def serve(self, host: str = '127.0.0.1', port: int = 9100):
+        server = await asyncio.start_server(self._handle_http, host, port)
+        async with server:
+            await server.serve_forever()
+
+
+class MonitoredQueue:
+    """
+    Drop-in event_queue for a stream: records the event on the monitor and
+    forwards it to the real queue
+    """
+
+    def __init__(self, monitor: FeedMonitor, name: str, event_queue=None):
+        self.monitor = monitor
+        self.name = name
+        self.event_queue = event_queue
+
+    def put(self, event: Dict[str, Any]):
+        self.monitor.observe(self.name, event)
+        if self.event_queue is not None:
+            self.event_queue.put(event)
+
+
+if __name__ == '__main__':
+    import urllib.request
+
+    async def _main():
+        monitor = FeedMonitor(stale_after=0.5)
+        queue = monitor.queue('binance')
+        server = asyncio.ensure_future(monitor.serve(port=9100))
+        await asyncio.sleep(0.1)
+
+        for i in range(100):
+            # every 10th update skips one id
+            queue.put({'type': 'orderbook', 'symbol': 'ETHUSDT', 'update_id': i * 2, 'prev_update_id': i * 2 - 2 if i % 10 else i * 2 - 3})
+            await asyncio.sleep(0.01)
+        monitor.on_reconnect('binance')
+
+        loop = asyncio.get_event_loop()
+        body = await loop.run_in_executor(None, lambda: urllib.request.urlopen('http://127.0.0.1:9100/metrics').read())
+        print(body.decode())
+        server.cancel()
+
+    asyncio.run(_main())
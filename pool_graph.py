@@ -0,0 +1,243 @@
+import math
+
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from pool_registry import Pool, PoolRegistry
+
+Q96 = 2 ** 96
+
+
+class Edge:
+    """
+    One swap direction through one pool, weighted by -log(rate after fees)
+    so that a cycle with negative total weight is a profitable loop
+    """
+
+    __slots__ = ('pool', 'token_in', 'token_out', 'zero_for_one', 'rate', 'weight')
+
+    def __init__(self, pool: Pool, zero_for_one: bool):
+        self.pool = pool
+        self.zero_for_one = zero_for_one
+        self.token_in = pool.token0 if zero_for_one else pool.token1
+        self.token_out = pool.token1 if zero_for_one else pool.token0
+        self.rate = 0.0
+        self.weight = math.inf
+
+    def __repr__(self):
+        return f'{self.token_in}->{self.token_out}@{self.pool.exchange}_{self.pool.version}_{self.pool.fee}'
+
+
+class Cycle:
+
+    __slots__ = ('edges', 'weight')
+
+    def __init__(self, edges: Tuple[Edge, ...]):
+        self.edges = edges
+        self.weight = math.inf
+
+    @property
+    def path(self) -> List[str]:
+        return [e.token_in for e in self.edges] + [self.edges[0].token_in]
+
+    @property
+    def profit(self) -> float:
+        """
+        Return of one unit of the start token sent around the loop, fees included,
+        spot prices only (no price impact, no gas)
+        """
+        return math.exp(-self.weight) - 1
+
+    def evaluate(self) -> float:
+        self.weight = sum(e.weight for e in self.edges)
+        return self.weight
+
+    def __repr__(self):
+        return f'Cycle({", ".join(map(repr, self.edges))}, profit={self.profit:.6%})'
+
+
+class PoolGraph:
+    """
+    Token graph over every tracked pool, with all simple cycles up to
+    `max_hops` enumerated once at build time and indexed by the pools they use
+
+    update() re-prices a single pool and re-evaluates only the cycles that go
+    through it, so the cost of a pool_update depends on how many cycles touch
+    that pool, not on the size of the graph.
+
+    graph = PoolGraph(PoolRegistry.from_pools(POOLS, TOKENS))
+    for cycle in graph.update_from_event(pool_update):
+        print(cycle)
+    """
+
+    def __init__(self, registry: PoolRegistry, max_hops: int = 3, min_profit: float = 0.0):
+        self.registry = registry
+        self.max_hops = max_hops
+        self.min_profit = min_profit
+
+        self.edges: Dict[str, Tuple[Edge, Edge]] = {}
+        self.adjacency: Dict[str, List[Edge]] = {}
+        for pool in registry:
+            pair = (Edge(pool, True), Edge(pool, False))
+            self.edges[pool.address] = pair
+            for edge in pair:
+                self.adjacency.setdefault(edge.token_in, []).append(edge)
+
+        self.cycles: List[Cycle] = []
+        self.cycles_by_pool: Dict[str, List[Cycle]] = {address: [] for address in self.edges}
+        self._enumerate_cycles()
+
+    def _enumerate_cycles(self):
+        """
+        DFS from every token over tokens that sort after it, so each loop is
+        found once (starting from its smallest token). Loops may revisit no
+        token and no pool, but may use two pools of the same pair
+        """
+        tokens = sorted(self.adjacency)
+
+        def _dfs(start: str, token: str, path: List[Edge], seen_tokens: Set[str], seen_pools: Set[str]):
+            for edge in self.adjacency.get(token, []):
+                address = edge.pool.address
+                if address in seen_pools:
+                    continue
+                if edge.token_out == start and len(path) >= 1:
+                    self._add_cycle(tuple(path + [edge]))
+                elif edge.token_out > start and edge.token_out not in seen_tokens and len(path) + 1 < self.max_hops:
+                    seen_tokens.add(edge.token_out)
+                    seen_pools.add(address)
+                    path.append(edge)
+                    _dfs(start, edge.token_out, path, seen_tokens, seen_pools)
+                    path.pop()
+                    seen_pools.discard(address)
+                    seen_tokens.discard(edge.token_out)
+
+        for start in tokens:
+            _dfs(start, start, [], {start}, set())
+
+    def _add_cycle(self, edges: Tuple[Edge, ...]):
+        cycle = Cycle(edges)
+        self.cycles.append(cycle)
+        for address in {e.pool.address for e in edges}:
+            self.cycles_by_pool[address].append(cycle)
+
+    def set_rates(self, address: str, price: float):
+        """
+        :param price: spot price of token0 in token1 (human units), before fees
+        """
+        pool = self.registry.get(address)
+        forward, backward = self.edges[pool.address]
+        fee_multiplier = 1 - pool.fee / 1_000_000
+
+        if price > 0:
+            forward.rate = price * fee_multiplier
+            backward.rate = fee_multiplier / price
+            forward.weight = -math.log(forward.rate)
+            backward.weight = -math.log(backward.rate)
+        else:
+            forward.rate = backward.rate = 0.0
+            forward.weight = backward.weight = math.inf
+
+    def update(self,
+               address: str,
+               sqrt_price_x96: Optional[int] = None,
+               reserve0: Optional[int] = None,
+               reserve1: Optional[int] = None) -> List[Cycle]:
+        """
+        Re-prices one pool from V3 (sqrtPriceX96) or V2 (reserves) state and
+        returns the profitable cycles among the ones that go through it
+        """
+        pool = self.registry.get(address)
+        if pool is None:
+            return []
+
+        if sqrt_price_x96 is not None:
+            price = (sqrt_price_x96 / Q96) ** 2 * pool.scale
+        elif reserve0:
+            price = reserve1 / reserve0 * pool.scale
+        else:
+            price = 0.0
+        self.set_rates(pool.address, price)
+
+        profitable = []
+        for cycle in self.cycles_by_pool[pool.address]:
+            cycle.evaluate()
+            if cycle.profit > self.min_profit:
+                profitable.append(cycle)
+        return profitable
+
+    def update_from_event(self, event: Dict[str, Any]) -> List[Cycle]:
+        """
+        Takes a 'pool_update' event as published by dex_streams
+        """
+        return self.update(event['address'],
+                           sqrt_price_x96=event.get('sqrtPriceX96'),
+                           reserve0=event.get('reserve0'),
+                           reserve1=event.get('reserve1'))
+
+    def find_negative_cycle(self) -> Optional[List[Edge]]:
+        """
+        Full Bellman-Ford pass over the current rates, for loops longer than
+        max_hops. O(V * E), use it for periodic checks, not on every update
+        """
+        tokens = list(self.adjacency)
+        distance = {t: 0.0 for t in tokens}
+        predecessor: Dict[str, Edge] = {}
+        edges = [e for pair in self.edges.values() for e in pair if e.weight < math.inf]
+
+        updated = None
+        for _ in range(len(tokens)):
+            updated = None
+            for edge in edges:
+                if distance[edge.token_in] + edge.weight < distance[edge.token_out] - 1e-12:
+                    distance[edge.token_out] = distance[edge.token_in] + edge.weight
+                    predecessor[edge.token_out] = edge
+                    updated = edge.token_out
+            if updated is None:
+                return None
+
+        # walk back far enough to be sure we are inside the loop
+        token = updated
+        for _ in range(len(tokens)):
+            token = predecessor[token].token_in
+
+        cycle = []
+        current = token
+        while True:
+            edge = predecessor[current]
+            cycle.append(edge)
+            current = edge.token_in
+            if current == token:
+                break
+        return cycle[::-1]
+
+
+if __name__ == '__main__':
+    import time
+
+    from constants import TOKENS, POOLS
+
+    registry = PoolRegistry.from_pools(POOLS, TOKENS)
+    graph = PoolGraph(registry, max_hops=3)
+    print(f'{len(registry)} pools, {len(graph.cycles)} cycles')
+
+    def sqrt_price_x96(price: float, pool: Pool) -> int:
+        return int(math.sqrt(price / pool.scale) * Q96)
+
+    prices = {'ETH': 2000.0, 'USDT': 1.0, 'USDC': 1.0}
+    for pool in registry:
+        price = prices[pool.token0] / prices[pool.token1]
+        if pool.version == 3:
+            graph.update(pool.address, sqrt_price_x96=sqrt_price_x96(price, pool))
+        else:
+            graph.update(pool.address, reserve0=10 ** pool.decimals0, reserve1=int(price * 10 ** pool.decimals1))
+
+    # USDC/ETH pool trades 1% rich
+    pool = registry.get('0x8ad599c3A0ff1De082011EFDDc58f1908eb6e6D8')
+    for cycle in graph.update(pool.address, sqrt_price_x96=sqrt_price_x96(1 / 2000 * 1.01, pool)):
+        print(cycle)
+    print(graph.find_negative_cycle())
+
+    n = 100_000
+    s = time.perf_counter()
+    for i in range(n):
+        graph.update(pool.address, sqrt_price_x96=sqrt_price_x96(1 / 2000 * (1 + (i % 10) / 1000), pool))
+    print(f'{(time.perf_counter() - s) / n * 1e6:.2f} us/update')
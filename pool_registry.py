@@ -0,0 +1,210 @@
+import os
+import json
+
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from constants import TOKENS, POOLS, FACTORIES
+
+PAIR_CREATED = '0x0d3648bd0f6ba80134a33ba9275ac585d9d315f0ad8355cddefde31afa28d0e9'  # PairCreated(address,address,address,uint256)
+POOL_CREATED = '0x783cca1c0412dd0d695e784568c96da2e9c22ff989357a2e8b1d9b2b4e6b7118'  # PoolCreated(address,address,uint24,int24,address)
+
+
+class Pool:
+    """
+    Immutable pool descriptor with everything the streams need per event
+    computed once: event symbol, pool_data key, token order, decimals and
+    the price scaling factor 10 ** (decimals0 - decimals1)
+    """
+
+    __slots__ = (
+        'exchange', 'version', 'name', 'address', 'fee',
+        'token0', 'token1', 'decimals0', 'decimals1',
+        'symbol', 'key', 'pair', 'token_idx', 'decimals', 'scale',
+    )
+
+    def __init__(self,
+                 exchange: str,
+                 version: int,
+                 name: str,
+                 address: str,
+                 fee: int,
+                 token0: str,
+                 token1: str,
+                 decimals0: int,
+                 decimals1: int):
+        self.exchange = exchange
+        self.version = version
+        self.name = name
+        self.address = address.lower()
+        self.fee = fee
+        self.token0 = token0
+        self.token1 = token1
+        self.decimals0 = decimals0
+        self.decimals1 = decimals1
+
+        self.symbol = f'{token0}{token1}'
+        self.key = f'{exchange}_{version}_{self.symbol}'
+        self.pair = pair_key(token0, token1)
+        self.token_idx = {token0: 0, token1: 1}
+        self.decimals = {token0: decimals0, token1: decimals1}
+        self.scale = 10 ** (decimals0 - decimals1)
+
+    def __getitem__(self, item: str):
+        # lets code written against constants.POOLS dicts keep working
+        return getattr(self, item)
+
+    def __repr__(self):
+        return f'Pool({self.key}, {self.address}, fee={self.fee})'
+
+    def to_row(self) -> List[Any]:
+        return [self.exchange, self.version, self.name, self.address, self.fee,
+                self.token0, self.token1, self.decimals0, self.decimals1]
+
+
+def pair_key(token_a: str, token_b: str) -> Tuple[str, str]:
+    """
+    Order-independent key: ETH/USDT and USDT/ETH pools land in the same bucket
+    """
+    return (token_a, token_b) if token_a <= token_b else (token_b, token_a)
+
+
+class PoolRegistry:
+    """
+    Pools indexed by address, by token pair and by (pair, fee tier)
+
+    registry = PoolRegistry.from_pools(POOLS, TOKENS)
+    registry.by_address['0x11b815efb8f581194ae79006d24e0d814b7697f6']
+    registry.by_pair[('ETH', 'USDT')]
+    registry.by_pair_fee[(('ETH', 'USDT'), 500)]
+    """
+
+    def __init__(self, pools: Iterable[Pool] = ()):
+        self.pools: List[Pool] = []
+        self.by_address: Dict[str, Pool] = {}
+        self.by_pair: Dict[Tuple[str, str], List[Pool]] = {}
+        self.by_pair_fee: Dict[Tuple[Tuple[str, str], int], List[Pool]] = {}
+        for pool in pools:
+            self.add(pool)
+
+    @classmethod
+    def from_pools(cls,
+                   pools: List[Dict[str, Any]] = POOLS,
+                   tokens: Dict[str, List[Any]] = TOKENS) -> 'PoolRegistry':
+        return cls(
+            Pool(p['exchange'], p['version'], p['name'], p['address'], p['fee'],
+                 p['token0'], p['token1'], tokens[p['token0']][1], tokens[p['token1']][1])
+            for p in pools
+        )
+
+    def add(self, pool: Pool):
+        if pool.address in self.by_address:
+            return
+        self.pools.append(pool)
+        self.by_address[pool.address] = pool
+        self.by_pair.setdefault(pool.pair, []).append(pool)
+        self.by_pair_fee.setdefault((pool.pair, pool.fee), []).append(pool)
+
+    def get(self, address: str) -> Optional[Pool]:
+        return self.by_address.get(address.lower())
+
+    def filter(self, version: Optional[int] = None, exchange: Optional[str] = None) -> 'PoolRegistry':
+        return PoolRegistry(
+            p for p in self.pools
+            if (version is None or p.version == version) and (exchange is None or p.exchange == exchange)
+        )
+
+    def addresses(self) -> List[str]:
+        return list(self.by_address)
+
+    def __iter__(self):
+        return iter(self.pools)
+
+    def __len__(self):
+        return len(self.pools)
+
+    def __contains__(self, address: str):
+        return address.lower() in self.by_address
+
+    def load_from_factories(self,
+                            w3,
+                            tokens: Dict[str, List[Any]] = TOKENS,
+                            factories: List[List[Any]] = FACTORIES,
+                            to_block: Optional[int] = None,
+                            chunk_size: int = 50_000,
+                            cache_path: Optional[str] = None,
+                            debug: bool = False):
+        """
+        Adds every pool created by `factories` whose tokens are both in `tokens`,
+        by scanning PairCreated / PoolCreated logs with eth_getLogs
+
+        With cache_path set, the found pools and the last scanned block per
+        factory are kept in a JSON file, so later calls only scan new blocks
+        """
+        cache = {'scanned': {}, 'pools': []}
+        if cache_path and os.path.exists(cache_path):
+            with open(cache_path) as f:
+                cache = json.load(f)
+
+        for row in cache['pools']:
+            self.add(Pool(*row))
+
+        symbols = {v[0].lower(): k for k, v in tokens.items()}
+        to_block = to_block or w3.eth.get_block_number()
+
+        for exchange, version, factory, deployed_block in factories:
+            topic = PAIR_CREATED if version == 2 else POOL_CREATED
+            start = cache['scanned'].get(factory.lower(), deployed_block - 1) + 1
+
+            for from_block in range(start, to_block + 1, chunk_size):
+                end = min(from_block + chunk_size - 1, to_block)
+                logs = w3.eth.get_logs({
+                    'address': factory,
+                    'topics': [topic],
+                    'fromBlock': from_block,
+                    'toBlock': end,
+                })
+                for log in logs:
+                    token0 = symbols.get('0x' + log['topics'][1].hex()[-40:].lower())
+                    token1 = symbols.get('0x' + log['topics'][2].hex()[-40:].lower())
+                    if token0 is None or token1 is None:
+                        continue
+                    data = bytes(log['data'])
+                    if version == 2:
+                        address = '0x' + data[12:32].hex()
+                        fee = 3000
+                    else:
+                        address = '0x' + data[44:64].hex()
+                        fee = int.from_bytes(bytes(log['topics'][3])[-3:], 'big')
+                    pool = Pool(exchange, version, f'{token0}/{token1}', address, fee,
+                                token0, token1, tokens[token0][1], tokens[token1][1])
+                    self.add(pool)
+                    cache['pools'].append(pool.to_row())
+
+                cache['scanned'][factory.lower()] = end
+                if debug:
+                    print(f'{exchange} v{version} factory: scanned up to {end}, {len(self)} pools')
+
+            if cache_path:
+                with open(cache_path, 'w') as f:
+                    json.dump(cache, f)
+
+        return self
+
+
+if __name__ == '__main__':
+    registry = PoolRegistry.from_pools(POOLS, TOKENS)
+
+    print(registry.by_pair[('ETH', 'USDT')])
+    print(registry.by_pair_fee[(('ETH', 'USDT'), 500)])
+    print(registry.get('0x8ad599c3A0ff1De082011EFDDc58f1908eb6e6D8').key)
+
+    from web3 import Web3
+    from dotenv import load_dotenv
+
+    load_dotenv(override=True)
+
+    HTTP_RPC_URL = os.getenv('HTTP_RPC_URL')
+    if HTTP_RPC_URL:
+        w3 = Web3(Web3.HTTPProvider(HTTP_RPC_URL))
+        registry.load_from_factories(w3, cache_path='pools_cache.json', debug=True)
+        print(f'{len(registry)} pools')
@@ -0,0 +1,311 @@
+"""
+Always-on stage timers and an on-demand sampling profiler
+
+Every hot stage (frame decode in each stream, queue put / get, the handler's
+aggregation, pool update and spread steps) adds its duration to a named
+Stage: a call count, total, max and a log2 histogram for percentiles, about
+0.2µs per observation. They are read at any time without a restart:
+
+decode = stage('binance.decode')
+start = time.perf_counter_ns()
+...
+decode.since(start)
+
+stats()                      # {'binance.decode': {'count', 'avg_us', 'p50_us', 'p99_us', 'max_us', ...}, ...}
+GET /stages, GET /metrics    # FeedMonitor.serve()
+
+The sampling profiler interrupts the event loop thread with an interval
+timer every few ms, counts the interrupted stacks and writes them as
+collapsed stacks (one
+'file:function;...;file:function count' line per stack, the input format of
+flamegraph.pl and speedscope). It runs for N seconds when started with
+
+kill -USR1 <pid>                        # install_signal_handler(), run.py installs it
+GET /profile?seconds=10                 # FeedMonitor.serve()
+PROFILER.start(seconds=10)
+"""
+import os
+import time
+import signal
+
+from collections import Counter
+from typing import Any, Dict, List, Optional, Tuple
+
+
+class Stage:
+    """
+    Duration counters of one stage, in ns. Bucket i counts durations below
+    2**i ns, so percentiles are upper bounds within a factor of 2
+    """
+
+    __slots__ = ('name', 'count', 'total_ns', 'max_ns', 'buckets')
+
+    def __init__(self, name: str):
+        self.name = name
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.total_ns = 0
+        self.max_ns = 0
+        self.buckets = [0] * 48
+
+    def observe(self, ns: int):
+        self.count += 1
+        self.total_ns += ns
+        if ns > self.max_ns:
+            self.max_ns = ns
+        self.buckets[min(ns.bit_length(), 47)] += 1
+
+    def since(self, start_ns: int):
+        """
+        Observes the time elapsed since a time.perf_counter_ns() reading
+        """
+        self.observe(time.perf_counter_ns() - start_ns)
+
+    def percentile(self, q: float) -> Optional[float]:
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= rank:
+                return float(min(1 << i, self.max_ns))
+        return float(self.max_ns)
+
+    def stats(self) -> Dict[str, Any]:
+        count = self.count
+        return {
+            'count': count,
+            'total_ms': self.total_ns / 1e6,
+            'avg_us': self.total_ns / count / 1e3 if count else None,
+            'p50_us': self.percentile(0.5) / 1e3 if count else None,
+            'p99_us': self.percentile(0.99) / 1e3 if count else None,
+            'max_us': self.max_ns / 1e3 if count else None,
+        }
+
+
+class Stages:
+
+    def __init__(self):
+        self.stages: Dict[str, Stage] = {}
+        self.started = time.monotonic()
+
+    def stage(self, name: str) -> Stage:
+        """
+        The stage called `name`, created on first use; keep the returned
+        object rather than looking it up per observation
+        """
+        if name not in self.stages:
+            self.stages[name] = Stage(name)
+        return self.stages[name]
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        return {name: s.stats() for name, s in sorted(self.stages.items())}
+
+    def reset(self):
+        for s in self.stages.values():
+            s.reset()
+        self.started = time.monotonic()
+
+
+STAGES = Stages()
+
+
+def stage(name: str) -> Stage:
+    return STAGES.stage(name)
+
+
+def stats() -> Dict[str, Dict[str, Any]]:
+    return STAGES.stats()
+
+
+class TimedQueue:
+    """
+    event_queue wrapper timing put() as 'queue.put' and coro_get() as
+    'queue.get' when an event was already waiting, or 'queue.wait' when the
+    handler had to wait for one (its idle time). Everything else is passed
+    through to the wrapped queue
+    """
+
+    def __init__(self, event_queue, prefix: str = 'queue'):
+        self.event_queue = event_queue
+        self.put_stage = stage(f'{prefix}.put')
+        self.get_stage = stage(f'{prefix}.get')
+        self.wait_stage = stage(f'{prefix}.wait')
+
+    def put(self, item: Any):
+        start = time.perf_counter_ns()
+        self.event_queue.put(item)
+        self.put_stage.since(start)
+
+    async def coro_get(self) -> Any:
+        try:
+            ready = self.event_queue.qsize() > 0
+        except NotImplementedError:
+            ready = False
+        start = time.perf_counter_ns()
+        item = await self.event_queue.coro_get()
+        (self.get_stage if ready else self.wait_stage).since(start)
+        return item
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.event_queue, name)
+
+
+class SamplingProfiler:
+    """
+    Statistical profiler of the main thread, where the event loop runs: an
+    interval timer interrupts it every `interval` seconds and the signal
+    handler counts the interrupted Python stack. 'wall' mode (SIGALRM) also
+    samples time spent blocked, e.g. in a synchronous HTTP call or idle in
+    select; 'cpu' mode (SIGPROF) only samples while the process uses CPU.
+    Unix only; start() and stop() must be called from the main thread
+    """
+
+    TIMERS = {
+        'wall': ('ITIMER_REAL', 'SIGALRM'),
+        'cpu': ('ITIMER_PROF', 'SIGPROF'),
+    }
+
+    def __init__(self, interval: float = 0.005, mode: str = 'wall', out_dir: str = '.'):
+        if mode not in self.TIMERS:
+            raise ValueError(f'Unknown mode {mode}, expected one of {list(self.TIMERS)}')
+        self.interval = interval
+        self.mode = mode
+        self.out_dir = out_dir
+        self.samples: Counter = Counter()
+        self.path: Optional[str] = None
+        self.last_report: Optional[Dict[str, Any]] = None
+        self._deadline: Optional[float] = None
+        self._started = 0.0
+        self._previous_handler = None
+
+    @property
+    def running(self) -> bool:
+        return self._deadline is not None
+
+    def start(self, seconds: float = 30.0, path: Optional[str] = None) -> str:
+        """
+        Samples for `seconds`, then writes the collapsed stacks to `path`
+        (profile-<time>.folded in out_dir by default) and prints a summary
+        """
+        if self.running:
+            raise RuntimeError(f'Profiler already running, writing to {self.path}')
+        timer, sig = (getattr(signal, name) for name in self.TIMERS[self.mode])
+        self.path = path or os.path.join(self.out_dir, f'profile-{time.strftime("%Y%m%d-%H%M%S")}.folded')
+        self.samples = Counter()
+        self._started = time.monotonic()
+        self._deadline = self._started + seconds
+        self._previous_handler = signal.signal(sig, self._on_sample)
+        signal.setitimer(timer, self.interval, self.interval)
+        return self.path
+
+    def stop(self) -> Optional[Dict[str, Any]]:
+        """
+        Ends the profile (also before its time is up) and writes it
+        """
+        if not self.running:
+            return None
+        timer, sig = (getattr(signal, name) for name in self.TIMERS[self.mode])
+        signal.setitimer(timer, 0)
+        signal.signal(sig, self._previous_handler)
+        self._deadline = None
+        self.last_report = self.dump(self.path, time.monotonic() - self._started)
+        print({'type': 'profile', **self.last_report})
+        return self.last_report
+
+    def toggle(self, seconds: float = 30.0):
+        if self.running:
+            self.stop()
+        else:
+            self.start(seconds)
+
+    def _on_sample(self, signum, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f'{os.path.basename(code.co_filename)}:{code.co_name}')
+            frame = frame.f_back
+        if stack:
+            self.samples[';'.join(reversed(stack))] += 1
+        if time.monotonic() >= self._deadline:
+            self.stop()
+
+    def dump(self, path: str, elapsed: Optional[float] = None, top: int = 10) -> Dict[str, Any]:
+        with open(path, 'w') as f:
+            for stack, count in self.samples.most_common():
+                f.write(f'{stack} {count}\n')
+        return {'path': path, 'seconds': elapsed, 'samples': sum(self.samples.values()),
+                'top': self.top(top)}
+
+    def top(self, n: int = 10) -> List[Tuple[str, float]]:
+        """
+        Functions with the highest share of samples on top of the stack (self time)
+        """
+        total = sum(self.samples.values())
+        leaves: Counter = Counter()
+        for stack, count in self.samples.items():
+            leaves[stack.rsplit(';', 1)[-1]] += count
+        return [(function, count / total) for function, count in leaves.most_common(n)] if total else []
+
+
+PROFILER = SamplingProfiler()
+
+
+def install_signal_handler(sig: int = getattr(signal, 'SIGUSR1', None),
+                           seconds: float = 30.0,
+                           stats_sig: Optional[int] = getattr(signal, 'SIGUSR2', None)):
+    """
+    `sig` starts PROFILER for `seconds` (or stops a running profile early),
+    `stats_sig` prints the stage stats. Must be called from the main thread;
+    a no-op where the signals do not exist (Windows)
+    """
+    if sig is not None:
+        signal.signal(sig, lambda *_: PROFILER.toggle(seconds))
+    if stats_sig is not None:
+        signal.signal(stats_sig, lambda *_: print({'type': 'stages', 'stages': stats()}))
+
+
+if __name__ == '__main__':
+    import json
+    import asyncio
+
+    """
+    Times a toy handler's stages for 2s while profiling it, then prints both
+    """
+
+    def _parse(n: int):
+        return json.loads(json.dumps({'b': [[str(i), '1'] for i in range(n)]}))
+
+    async def _main():
+        from run import LoopQueue
+
+        queue = TimedQueue(LoopQueue())
+        decode, aggregate = stage('demo.decode'), stage('demo.aggregate')
+
+        async def _stream():
+            while True:
+                start = time.perf_counter_ns()
+                event = _parse(20)
+                decode.since(start)
+                queue.put(event)
+                await asyncio.sleep(0.0005)
+
+        async def _handler():
+            while True:
+                event = await queue.coro_get()
+                start = time.perf_counter_ns()
+                sorted(event['b'] * 50, key=lambda level: float(level[0]))
+                aggregate.since(start)
+
+        tasks = [asyncio.ensure_future(_stream()), asyncio.ensure_future(_handler())]
+        PROFILER.start(seconds=2, path='/tmp/profile-demo.folded')
+        await asyncio.sleep(2.2)
+        for task in tasks:
+            task.cancel()
+        for name, values in stats().items():
+            print(name, {k: round(v, 2) if isinstance(v, float) else v for k, v in values.items()})
+
+    asyncio.run(_main())
@@ -0,0 +1,371 @@
+"""
+Async JSON-RPC client for the coroutine code paths
+
+Every call is awaited on the event loop, nothing blocks it. Calls made in the
+same loop iteration are coalesced into one JSON-RPC batch (up to max_batch),
+and batches are sent concurrently: over a pool of keep-alive HTTP
+connections for http(s):// URLs, or pipelined over one WebSocket for ws(s)://
+URLs, responses matched back by id.
+
+client = RPCClient(HTTP_RPC_URL)
+block_number = await client.block_number()
+slot0, liquidity = await asyncio.gather(client.eth_call(pool, SLOT0, block_number),
+                                        client.eth_call(pool, LIQUIDITY, block_number))   # one HTTP request
+await client.close()
+
+shared_client(HTTP_RPC_URL) returns one client per URL and event loop, so
+the streams reuse the same warm connections across reconnects.
+"""
+import json
+import time
+import asyncio
+import weakref
+
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+
+class RPCError(Exception):
+    """
+    A JSON-RPC error response. Reverted eth_calls have code 3 (or 'revert'
+    in the message, depending on the node)
+    """
+
+    def __init__(self, error: Dict[str, Any], method: Optional[str] = None):
+        self.code = error.get('code')
+        self.message = error.get('message', '')
+        self.data = error.get('data')
+        super().__init__(f'{method}: {self.code} {self.message}' if method else f'{self.code} {self.message}')
+
+    @property
+    def reverted(self) -> bool:
+        return self.code == 3 or 'revert' in str(self.message).lower()
+
+
+class RPCClient:
+
+    def __init__(self,
+                 url: str,
+                 max_batch: int = 100,
+                 max_connections: int = 8,
+                 timeout: float = 10.0,
+                 headers: Optional[Dict[str, str]] = None):
+        """
+        :param url: http(s):// endpoint, or ws(s):// to pipeline over one WebSocket
+        :param max_batch: calls per JSON-RPC batch; a full batch is sent right away
+        :param max_connections: keep-alive HTTP connections batches are spread over
+        """
+        self.url = url
+        self.max_batch = max_batch
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.headers = headers or {}
+        self.websocket = url.startswith(('ws://', 'wss://'))
+        self.closed = False
+        self.stats = {'calls': 0, 'requests': 0, 'max_batch': 0, 'errors': 0, 'in_flight': 0, 'max_in_flight': 0}
+        self.constants: Dict[str, Any] = {}
+
+        self._next_id = 0
+        self._pending: List[Tuple[Dict[str, Any], asyncio.Future]] = []
+        self._flush_handle: Optional[asyncio.Handle] = None
+        self._sends: set = set()
+        self._session = None
+        self._ws = None
+        self._ws_lock: Optional[asyncio.Lock] = None
+        self._ws_reader: Optional[asyncio.Task] = None
+        self._waiting: Dict[int, asyncio.Future] = {}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def close(self):
+        self.closed = True
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        self._flush()
+        if self._sends:
+            await asyncio.gather(*self._sends, return_exceptions=True)
+        if self._ws_reader is not None:
+            self._ws_reader.cancel()
+        if self._ws is not None:
+            await self._ws.close()
+            self._ws = None
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def submit(self, method: str, params: Sequence[Any] = ()) -> asyncio.Future:
+        """
+        Queues a call for the next batch; the future resolves to the raw
+        response object ({'result': ...} or {'error': ...})
+        """
+        if self.closed:
+            raise RuntimeError(f'RPCClient for {self.url} is closed')
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._next_id += 1
+        self._pending.append(({'jsonrpc': '2.0', 'id': self._next_id, 'method': method, 'params': list(params)},
+                              future))
+        if len(self._pending) >= self.max_batch:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_soon(self._flush)
+        return future
+
+    async def call(self, method: str, params: Sequence[Any] = ()) -> Any:
+        response = await self.submit(method, params)
+        if 'error' in response:
+            raise RPCError(response['error'], method)
+        return response.get('result')
+
+    async def batch(self, calls: Sequence[Tuple[str, Sequence[Any]]], raw: bool = False) -> List[Any]:
+        """
+        Results of (method, params) calls in order, sent as few batches as
+        max_batch allows. With raw=True the response objects are returned and
+        errors are not raised
+        """
+        futures = [self.submit(method, params) for method, params in calls]
+        responses = await asyncio.gather(*futures)
+        if raw:
+            return list(responses)
+        results = []
+        for (method, _), response in zip(calls, responses):
+            if 'error' in response:
+                raise RPCError(response['error'], method)
+            results.append(response.get('result'))
+        return results
+
+    def _flush(self):
+        self._flush_handle = None
+        while self._pending:
+            batch, self._pending = self._pending[:self.max_batch], self._pending[self.max_batch:]
+            task = asyncio.ensure_future(self._send(batch))
+            self._sends.add(task)
+            task.add_done_callback(self._sends.discard)
+
+    async def _send(self, batch: List[Tuple[Dict[str, Any], asyncio.Future]]):
+        stats = self.stats
+        stats['calls'] += len(batch)
+        stats['requests'] += 1
+        stats['max_batch'] = max(stats['max_batch'], len(batch))
+        stats['in_flight'] += 1
+        stats['max_in_flight'] = max(stats['max_in_flight'], stats['in_flight'])
+        futures = {payload['id']: future for payload, future in batch}
+        # single calls go as plain objects, some providers bill batches differently
+        body = batch[0][0] if len(batch) == 1 else [payload for payload, _ in batch]
+        try:
+            if self.websocket:
+                await self._send_ws(body, futures)
+            else:
+                responses = await self._post(body)
+                for response in responses if isinstance(responses, list) else [responses]:
+                    future = futures.get(response.get('id'))
+                    if future is not None and not future.done():
+                        future.set_result(response)
+                missing = [future for future in futures.values() if not future.done()]
+                if missing:
+                    raise RuntimeError(f'{len(missing)} calls without a response from {self.url}')
+        except Exception as e:
+            stats['errors'] += 1
+            for future in futures.values():
+                if not future.done():
+                    future.set_exception(e)
+        finally:
+            stats['in_flight'] -= 1
+
+    async def _post(self, body: Any) -> Any:
+        import aiohttp
+
+        if self._session is None:
+            connector = aiohttp.TCPConnector(limit=self.max_connections, ttl_dns_cache=300)
+            self._session = aiohttp.ClientSession(connector=connector, headers=self.headers)
+        async with self._session.post(self.url, json=body, timeout=aiohttp.ClientTimeout(total=self.timeout)) as res:
+            res.raise_for_status()
+            return await res.json(content_type=None)
+
+    async def _connect_ws(self):
+        import websockets
+
+        if self._ws_lock is None:
+            self._ws_lock = asyncio.Lock()
+        async with self._ws_lock:
+            if self._ws is None:
+                self._ws = await websockets.connect(self.url, max_size=None)
+                self._ws_reader = asyncio.ensure_future(self._read_ws(self._ws))
+        return self._ws
+
+    async def _read_ws(self, ws):
+        try:
+            async for msg in ws:
+                data = json.loads(msg)
+                for response in data if isinstance(data, list) else [data]:
+                    future = self._waiting.pop(response.get('id'), None)
+                    if future is not None and not future.done():
+                        future.set_result(response)
+        except Exception as e:
+            error = e
+        else:
+            error = ConnectionError(f'{self.url} closed the connection')
+        finally:
+            if self._ws is ws:
+                self._ws = None
+        # calls waiting on the dropped connection fail, the next one reconnects
+        for request_id, future in list(self._waiting.items()):
+            if not future.done():
+                future.set_exception(error)
+            del self._waiting[request_id]
+
+    async def _send_ws(self, body: Any, futures: Dict[int, asyncio.Future]):
+        ws = await self._connect_ws()
+        self._waiting.update(futures)
+        await ws.send(json.dumps(body))
+        # asyncio.wait leaves the callers' futures alone on timeout, wait_for would cancel them
+        _, pending = await asyncio.wait(futures.values(), timeout=self.timeout)
+        if pending:
+            for request_id in futures:
+                self._waiting.pop(request_id, None)
+            error = asyncio.TimeoutError(f'{len(pending)} calls to {self.url} timed out after {self.timeout}s')
+            for future in pending:
+                future.set_exception(error)
+            raise error
+
+    async def constant(self, method: str) -> Any:
+        """
+        Result of a parameterless method that never changes for the endpoint
+        (eth_chainId, net_version), fetched once
+        """
+        if method not in self.constants:
+            self.constants[method] = await self.call(method)
+        return self.constants[method]
+
+    async def chain_id(self) -> int:
+        return int(await self.constant('eth_chainId'), 16)
+
+    async def block_number(self) -> int:
+        return int(await self.call('eth_blockNumber'), 16)
+
+    async def eth_call(self, to: str, data: str, block: Any = 'latest') -> bytes:
+        """
+        Return data of a call at `block` (a number or a tag); raises RPCError
+        when it reverts
+        """
+        block = hex(block) if isinstance(block, int) else block
+        result = await self.call('eth_call', [{'to': to, 'data': data}, block])
+        return bytes.fromhex(result[2:])
+
+    async def get_block(self, block: Any = 'latest', full_transactions: bool = False) -> Optional[Dict[str, Any]]:
+        block = hex(block) if isinstance(block, int) else block
+        return await self.call('eth_getBlockByNumber', [block, full_transactions])
+
+
+_SHARED: 'weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[str, RPCClient]]' = weakref.WeakKeyDictionary()
+
+
+def shared_client(url: str) -> RPCClient:
+    """
+    The RPCClient of `url` for the running event loop, created on first use
+    """
+    clients = _SHARED.setdefault(asyncio.get_running_loop(), {})
+    client = clients.get(url)
+    if client is None or client.closed:
+        client = clients[url] = RPCClient(url)
+    return client
+
+
+async def close_shared_clients():
+    for client in list(_SHARED.pop(asyncio.get_running_loop(), {}).values()):
+        await client.close()
+
+
+if __name__ == '__main__':
+    import threading
+
+    from web3 import Web3
+
+    from constants import POOLS, TOKENS
+    from mock_servers import MockEthereumNode
+    from pool_registry import PoolRegistry
+    from state_cache import SLOT0, LIQUIDITY
+
+    """
+    The startup reads of stream_uniswap_v3_events (block number, then slot0
+    and liquidity of every V3 pool) against a node 30ms away, made with a
+    synchronous Web3 and with RPCClient over HTTP and WebSocket, while a
+    ticker measures how late the event loop runs a 1ms timer. Then a call to a
+    WebSocket node that never answers must fail with a timeout, not a
+    cancellation
+    """
+    node = MockEthereumNode(port=8793, http_port=8794, rpc_latency=0.03)
+    registry = PoolRegistry.from_pools(POOLS, TOKENS).filter(version=3)
+    for pool in registry:
+        node.add_v3_pool(pool.address, 2 ** 96 * 10 ** 3, 10 ** 20)
+    node.block_number = 18_000_000
+
+    # own thread and loop, so the synchronous Web3 calls below have a node to talk to
+    node_loop = asyncio.new_event_loop()
+    node_loop.run_until_complete(node.start())
+    threading.Thread(target=node_loop.run_forever, daemon=True).start()
+
+    def _sync_reads():
+        w3 = Web3(Web3.HTTPProvider(node.http_url))
+        block_number = w3.eth.get_block_number()
+        return [w3.eth.call({'to': Web3.to_checksum_address(pool.address), 'data': selector}, block_number)
+                for pool in registry for selector in (SLOT0, LIQUIDITY)]
+
+    async def _async_reads(client: RPCClient):
+        block_number = await client.block_number()
+        return await asyncio.gather(*[client.eth_call(pool.address, selector, block_number)
+                                      for pool in registry for selector in (SLOT0, LIQUIDITY)])
+
+    async def _measure(name: str, reads):
+        lateness = []
+
+        async def _ticker():
+            while True:
+                due = time.perf_counter() + 0.001
+                await asyncio.sleep(0.001)
+                lateness.append((time.perf_counter() - due) * 1000)
+
+        ticker = asyncio.ensure_future(_ticker())
+        await asyncio.sleep(0.05)
+        before = node.rpc_requests
+        start = time.perf_counter()
+        for _ in range(5):
+            await reads()
+            await asyncio.sleep(0)
+        elapsed = (time.perf_counter() - start) / 5 * 1000
+        await asyncio.sleep(0.002)
+        ticker.cancel()
+        print({'reads': name, 'ms_per_startup': round(elapsed, 1), 'node_calls': (node.rpc_requests - before) / 5,
+               'loop_stall_max_ms': round(max(lateness), 1)})
+
+    async def _main():
+        async def _sync():
+            _sync_reads()
+
+        await _measure('sync Web3', _sync)
+        async with RPCClient(node.http_url) as client:
+            await _measure('RPCClient http', lambda: _async_reads(client))
+            print(client.stats)
+        async with RPCClient(node.url) as client:
+            await _measure('RPCClient ws', lambda: _async_reads(client))
+            print(client.stats)
+
+        import websockets
+
+        async def _silent(ws, path=None):
+            async for _ in ws:
+                pass
+
+        async with websockets.serve(_silent, 'localhost', 8795):
+            async with RPCClient('ws://localhost:8795', timeout=0.2) as client:
+                try:
+                    await client.block_number()
+                    raise AssertionError('silent node answered')
+                except asyncio.TimeoutError as e:
+                    print({'silent ws node': repr(e), 'errors': client.stats['errors']})
+
+    asyncio.run(_main())
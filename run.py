@@ -0,0 +1,288 @@
+"""
+Headless runner: starts the feeds and handler selected in a JSON config
+without Jupyter or nest_asyncio
+
+python run.py --config config.example.json [--uvloop] [--duration 60]
+
+Stream modules (and their web3 / eth_abi / numpy dependencies) are imported
+only when a selected feed or handler option needs them. The time from process
+start to the first event processed by the handler is reported on stdout.
+
+Stage timers (profiling.py) run always: kill -USR2 <pid> prints them, and
+kill -USR1 <pid> profiles the process for `profile_seconds` (30 by default)
+into a collapsed-stack file in the working directory.
+
+With a "chains" section the new_blocks and uniswap_v3 feeds run once per
+listed chain and the handler reads a chains.ChainScheduler, one lane per
+chain: {"chains": {"ethereum": {}, "arbitrum": {"policy": "conflate"}}}.
+Lane options are weight, policy and maxsize, plus http_rpc_url / ws_rpc_url
+to override the <CHAIN>_HTTP_RPC_URL / <CHAIN>_WS_RPC_URL environment variables.
+"""
+import time
+
+PROCESS_START = time.perf_counter()
+
+import os
+import sys
+import json
+import asyncio
+import argparse
+import importlib
+
+from functools import partial
+from typing import Any, Dict, List, Optional
+
+
+def _report_cold_start(first_get: float, item: Any):
+    print({
+        'type': 'cold_start',
+        'first_event_ms': round((first_get - PROCESS_START) * 1000, 1),
+        'event': item.get('type') if hasattr(item, 'get') else type(item).__name__,
+    })
+
+
+class LoopQueue(asyncio.Queue):
+    """
+    In-loop replacement for aioprocessing.AioQueue when streams and handler
+    share one event loop: same put / coro_get interface, no pickling, no
+    feeder thread. Records when the first event is taken by the handler
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.first_get: Optional[float] = None
+
+    def put(self, item: Any):
+        self.put_nowait(item)
+
+    async def coro_get(self) -> Any:
+        item = await self.get()
+        if self.first_get is None:
+            self.first_get = time.perf_counter()
+            _report_cold_start(self.first_get, item)
+        return item
+
+
+class ColdStartQueue:
+    """
+    Records when the first event is taken from any other event_queue, as
+    LoopQueue does; everything else is passed through to the wrapped queue
+    """
+
+    def __init__(self, event_queue):
+        self.event_queue = event_queue
+        self.first_get: Optional[float] = None
+
+    async def coro_get(self) -> Any:
+        item = await self.event_queue.coro_get()
+        if self.first_get is None:
+            self.first_get = time.perf_counter()
+            _report_cold_start(self.first_get, item)
+        return item
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.event_queue, name)
+
+
+def _registry(context: Dict[str, Any]):
+    if 'registry' not in context:
+        from constants import TOKENS, POOLS
+        from pool_registry import PoolRegistry
+        context['registry'] = PoolRegistry.from_pools(POOLS, TOKENS)
+    return context['registry']
+
+
+def _predictor(context: Dict[str, Any]):
+    if 'predictor' not in context:
+        from mempool_streams import PendingSwapPredictor
+        context['predictor'] = PendingSwapPredictor(_registry(context))
+    return context['predictor']
+
+
+"""
+feed name -> (module, function, builder of the positional args before event_queue)
+"""
+FEEDS: Dict[str, Any] = {
+    'binance': ('cex_streams', 'stream_binance_usdm_orderbook',
+                lambda config, context: [config['symbols']]),
+    'okx': ('cex_streams', 'stream_okx_usdm_orderbook',
+            lambda config, context: [config['symbols']]),
+    'connex': ('cex_streams', 'stream_connex_orderbook',
+               lambda config, context: [config['symbols']]),
+    'new_blocks': ('dex_streams', 'stream_new_blocks',
+                   lambda config, context: [config['ws_rpc_url']]),
+    'uniswap_v3': ('dex_streams', 'stream_uniswap_v3_events',
+                   lambda config, context: [config['http_rpc_url'], config['ws_rpc_url'],
+                                            importlib.import_module('constants').TOKENS, _registry(context)]),
+    'uniswap_v2': ('dex_streams', 'stream_uniswap_v2_events',
+                   lambda config, context: [config['http_rpc_url'], config['ws_rpc_url'],
+                                            importlib.import_module('constants').TOKENS, _registry(context)]),
+    'pending_swaps': ('mempool_streams', 'stream_pending_swaps',
+                      lambda config, context: [config['ws_rpc_url'], _registry(context), _predictor(context)]),
+}
+
+# feeds that run once per chain when the config has a "chains" section
+CHAIN_FEEDS = ('new_blocks', 'uniswap_v3', 'uniswap_v2')
+
+
+def load_config(path: Optional[str]) -> Dict[str, Any]:
+    config = {
+        'symbols': ['ETH/USDT'],
+        'feeds': ['binance', 'okx'],
+        'handler': {},
+        'metrics_port': None,
+        'profile_seconds': 30,
+    }
+    if path:
+        with open(path) as f:
+            config.update(json.load(f))
+
+    if config.get('chains') or any(feed in config['feeds'] for feed in ('connex', 'new_blocks', 'uniswap_v3', 'uniswap_v2', 'pending_swaps')):
+        from dotenv import load_dotenv
+        load_dotenv(override=True)
+        config.setdefault('http_rpc_url', os.getenv('HTTP_RPC_URL'))
+        config.setdefault('ws_rpc_url', os.getenv('WS_RPC_URL'))
+    return config
+
+
+def build_queue(config: Dict[str, Any], context: Dict[str, Any]):
+    """
+    A LoopQueue, or with a "chains" section a ChainScheduler with one lane
+    per chain (context['chains'] then holds the chains.Chain objects)
+    """
+    if not config.get('chains'):
+        return LoopQueue()
+
+    from chains import ChainScheduler, load_chains
+
+    options = {name: dict(lane or {}) for name, lane in config['chains'].items()}
+    urls = {name: {key: lane.pop(key) for key in ('http_rpc_url', 'ws_rpc_url') if lane.get(key)}
+            for name, lane in options.items()}
+    if 'ethereum' in urls:
+        for key in ('http_rpc_url', 'ws_rpc_url'):
+            urls['ethereum'].setdefault(key, config.get(key))
+    context['chains'] = load_chains(list(options), urls)
+
+    scheduler = ChainScheduler()
+    for chain in context['chains']:
+        scheduler.lane(chain.name, chain.chain_id, **options[chain.name])
+    context['scheduler'] = scheduler
+    return ColdStartQueue(scheduler)
+
+
+def build_handler(config: Dict[str, Any], event_queue: LoopQueue, context: Dict[str, Any]):
+    from aggregator import event_handler
+
+    options = config.get('handler', {})
+    kwargs: Dict[str, Any] = {}
+
+    if options.get('record_dir'):
+        from tick_store import TickRecorder
+        kwargs['recorder'] = TickRecorder(options['record_dir'])
+    if options.get('pool_graph'):
+        from pool_graph import PoolGraph
+        kwargs['pool_graph'] = PoolGraph(_registry(context))
+    if options.get('instruments'):
+        from instruments import InstrumentIndex
+        kwargs['instruments'] = InstrumentIndex(_registry(context))
+    if 'predictor' in context:
+        kwargs['predictor'] = context['predictor']
+    if options.get('stale_after'):
+        kwargs['stale_after'] = options['stale_after']
+    if 'monitor' in context:
+        kwargs['monitor'] = context['monitor']
+    if options.get('depth_sizes'):
+        kwargs['depth_sizes'] = options['depth_sizes']
+    if options.get('journal_dir'):
+        from journal import OpportunityJournal
+        kwargs['journal'] = context['journal'] = OpportunityJournal(options['journal_dir'],
+                                                                    min_spread=options.get('journal_min_spread', 0.0))
+
+    return event_handler(event_queue, **kwargs)
+
+
+def build_feeds(config: Dict[str, Any], event_queue: LoopQueue, context: Dict[str, Any]) -> List[Any]:
+    from utils import reconnecting_websocket_loop
+
+    monitor = context.get('monitor')
+    coroutines = []
+    for name in config['feeds']:
+        if name not in FEEDS:
+            raise ValueError(f'Unknown feed: {name}, choose from {list(FEEDS)}')
+        if name in CHAIN_FEEDS and 'chains' in context:
+            for chain in context['chains']:
+                coroutines.extend(chain.streams(event_queue, feeds=[name], monitor=monitor))
+            continue
+        module_name, fn_name, build_args = FEEDS[name]
+        module = importlib.import_module(module_name)
+        stream_fn = getattr(module, fn_name)
+        queue = monitor.queue(name) if monitor is not None else event_queue
+        if monitor is not None and name in getattr(module, 'CHANGE_FILTERS', {}):
+            monitor.watch_filter(name, module.CHANGE_FILTERS[name])
+        coroutines.append(reconnecting_websocket_loop(
+            partial(stream_fn, *build_args(config, context), queue, False),
+            tag=f'{name}_stream',
+            on_reconnect=monitor.reconnect_hook(name) if monitor is not None else None,
+        ))
+    return coroutines
+
+
+async def main(config: Dict[str, Any], duration: Optional[float] = None):
+    from profiling import TimedQueue, install_signal_handler
+
+    context: Dict[str, Any] = {}
+    event_queue = TimedQueue(build_queue(config, context))
+    install_signal_handler(seconds=config['profile_seconds'])
+
+    if config.get('metrics_port'):
+        from monitor import FeedMonitor
+        context['monitor'] = FeedMonitor(event_queue, stale_after=config['handler'].get('stale_after') or 10)
+        if 'scheduler' in context:
+            context['monitor'].watch_scheduler(context['scheduler'])
+
+    # feeds first: they may create shared state (registry, predictor) the handler uses
+    coroutines = build_feeds(config, event_queue, context)
+    coroutines.append(build_handler(config, event_queue, context))
+    if 'monitor' in context:
+        coroutines.append(context['monitor'].serve(port=config['metrics_port']))
+
+    print({'type': 'started', 'feeds': config['feeds'], 'chains': list(config.get('chains') or {}),
+           'startup_ms': round((time.perf_counter() - PROCESS_START) * 1000, 1)})
+
+    tasks = [asyncio.ensure_future(c) for c in coroutines]
+    try:
+        await asyncio.wait(tasks, timeout=duration)
+    finally:
+        for task in tasks:
+            task.cancel()
+        from rpc_client import close_shared_clients
+        await close_shared_clients()
+        if 'journal' in context:
+            # writes what is still buffered
+            context['journal'].close()
+
+
+def run(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description='Run CEX/DEX feeds and the event handler headless')
+    parser.add_argument('--config', help='JSON config file, see config.example.json')
+    parser.add_argument('--uvloop', action='store_true', help='use uvloop as the event loop if installed')
+    parser.add_argument('--duration', type=float, help='stop after this many seconds')
+    args = parser.parse_args(argv)
+
+    config = load_config(args.config)
+
+    if args.uvloop:
+        try:
+            import uvloop
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        except ImportError:
+            print('uvloop is not installed, using the default event loop', file=sys.stderr)
+
+    try:
+        asyncio.run(main(config, args.duration))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    run()
@@ -1,3 +1,6 @@
+import math
+
+
 class UniswapV2Simulator:
 
     def __init__(self):
@@ -121,8 +124,13 @@ class UniswapV2Simulator:
             """
             optimized_in = right
         else:
+            prev_mid = None
             while left <= right:
                 mid = ((left + right) / 2) // step_size / (1 / step_size)
+                if mid == prev_mid or mid <= 0:
+                    # converged on the step_size grid without hitting the tolerance band
+                    break
+                prev_mid = mid
                 amount_out = self.get_amount_out(mid * (10 ** decimal_in),
                                                  reserve_in,
                                                  reserve_out,
@@ -141,5 +149,711 @@ class UniswapV2Simulator:
         return optimized_in
 
 
+class UniswapV3Simulator:
+    """
+    Exact-input swaps inside the active tick of a Uniswap V3 pool, using the
+    same integer formulas as SqrtPriceMath. Swaps that would cross into the
+    next initialized tick are not modelled: liquidity is assumed constant,
+    which holds for the small/medium swaps we care about between two blocks
+    """
+
+    Q96 = 2 ** 96
+
+    def __init__(self):
+        pass
+
+    def sqrt_price_to_price(self,
+                            sqrt_price_x96: int,
+                            decimals0: int,
+                            decimals1: int,
+                            token0_in: bool):
+        price = (sqrt_price_x96 / self.Q96) ** 2 * 10 ** (decimals0 - decimals1)
+        return price if token0_in else 1 / price
+
+    def sqrt_price_to_tick(self, sqrt_price_x96: int) -> int:
+        return math.floor(math.log((sqrt_price_x96 / self.Q96) ** 2, 1.0001))
+
+    def get_next_sqrt_price(self,
+                            sqrt_price_x96: int,
+                            liquidity: int,
+                            amount_in: int,
+                            zero_for_one: bool) -> int:
+        """
+        SqrtPriceMath.getNextSqrtPriceFromInput, amount_in already net of fees
+        """
+        if amount_in == 0 or liquidity == 0:
+            return sqrt_price_x96
+        if zero_for_one:
+            numerator = liquidity << 96
+            product = amount_in * sqrt_price_x96
+            denominator = numerator + product
+            return -(-numerator * sqrt_price_x96 // denominator)  # round up
+        return sqrt_price_x96 + (amount_in << 96) // liquidity
+
+    def get_amount_out(self,
+                       amount_in: int,
+                       sqrt_price_x96: int,
+                       liquidity: int,
+                       fee: int,
+                       zero_for_one: bool):
+        """
+        Returns (amount_out, next_sqrt_price_x96), fee in the pool format (500 = 0.05%)
+        """
+        amount_in_less_fee = amount_in * (1_000_000 - fee) // 1_000_000
+        next_sqrt_price = self.get_next_sqrt_price(sqrt_price_x96, liquidity, amount_in_less_fee, zero_for_one)
+        if zero_for_one:
+            amount_out = liquidity * (sqrt_price_x96 - next_sqrt_price) // self.Q96
+        else:
+            amount_out = ((liquidity << 96) * (next_sqrt_price - sqrt_price_x96)
+                          // next_sqrt_price // sqrt_price_x96)
+        return amount_out, next_sqrt_price
+
+
+class CurveStableSwapSimulator:
+    """
+    Local get_dy / exchange for Curve StableSwap pools (3pool and the plain
+    pools derived from it), with the same integer Newton iterations as the
+    Vyper contracts, so quotes need no eth_call
+
+    State is kept in contract units: balances in each coin's own decimals,
+    amp as stored by the pool (A * a_precision; a_precision is 1 for 3pool and
+    the older pools, 100 for the newer ones), fee / admin_fee over 1e10.
+    Mined logs keep it current (update_from_log); RemoveLiquidityOne does not
+    say which coin left the pool, so it marks the state stale until
+    set_balances is called with fresh balances(i) reads. 3pool-era pools log
+    RemoveLiquidityOne(address,uint256,uint256), factory plain pools add the
+    coin supply as a fourth argument; both topics are handled.
+
+    CryptoSwap (v2) pools use a different invariant: CurveCryptoSwapSimulator.
+
+    pool = CurveStableSwapSimulator(balances=[dai, usdc, usdt], decimals=[18, 6, 6],
+                                    amp=2000, fee=1_000_000, admin_fee=5_000_000_000)
+    pool.get_dy(0, 1, 1000 * 10 ** 18)
+    """
+
+    FEE_DENOMINATOR = 10 ** 10
+    PRECISION = 10 ** 18
+
+    # TokenExchange is the same for every N, the liquidity events carry uint256[N] arrays
+    TOKEN_EXCHANGE = '0x8b3e96f2b889fa771c53c981b40daf005f63f637f1869f707052d15a3dd97140'
+    REMOVE_LIQUIDITY_ONE_TOPICS = {
+        '0x9e96dd3b997a2a257eec4df9bb6eaf626e206df5f543bd963682d143300be310',  # (address,uint256,uint256)
+        '0x5ad056f2e28a8cec232015406b843668c1e36cda598127ec3b8c59b8c72773a0',  # (address,uint256,uint256,uint256)
+    }
+    RAMP_A = '0xa2b71ec6df949300b59aab36b55e189697b750119dd349fcfa8c0f779e83c254'
+    STOP_RAMP_A = '0x46e22fb3709ad289f62ce63d469248536dbc78d82b84a3d7e74ad606dc201938'
+    NEW_FEE = '0xbe12859b636aed607d5230b2cc2711f68d70e51060e6cca1f575ef5d2fcc95d1'
+    LIQUIDITY_TOPICS = {
+        2: {
+            '0x26f55a85081d24974e85c6c00045d0f0453991e95873f52bff0d21af4079a768': 'add_liquidity',
+            '0x7c363854ccf79623411f8995b362bce5eddff18c927edc6f5dbbb5e05819a82c': 'remove_liquidity',
+            '0x2b5508378d7e19e0d5fa338419034731416c4f5b219a10379956f764317fd47e': 'remove_liquidity_imbalance',
+        },
+        3: {
+            '0x423f6495a08fc652425cf4ed0d1f9e37e571d9b9529b1c1c23cce780b2e7df0d': 'add_liquidity',
+            '0xa49d4cf02656aebf8c771f5a8585638a2a15ee6c97cf7205d4208ed7c1df252d': 'remove_liquidity',
+            '0x173599dbf9c6ca6f7c3b590df07ae98a45d74ff54065505141e7de6c46a624c2': 'remove_liquidity_imbalance',
+        },
+    }
+
+    def __init__(self,
+                 balances: list,
+                 decimals: list,
+                 amp: int,
+                 fee: int,
+                 admin_fee: int = 0,
+                 a_precision: int = 1):
+        self.n = len(balances)
+        self.balances = [int(b) for b in balances]
+        self.rates = [10 ** (36 - d) for d in decimals]  # RATES: 10 ** 18 * PRECISION_MUL
+        self.a_precision = a_precision
+        self.fee = fee
+        self.admin_fee = admin_fee
+        self.initial_A = self.future_A = amp
+        self.initial_A_time = self.future_A_time = 0
+        self.timestamp = 0
+        self.stale = False
+
+    def A(self, timestamp: int = None) -> int:
+        """
+        Amplification in pool units, linearly ramped between RampA's endpoints
+        """
+        t = self.timestamp if timestamp is None else timestamp
+        t1, A1 = self.future_A_time, self.future_A
+        if t < t1:
+            A0, t0 = self.initial_A, self.initial_A_time
+            if A1 > A0:
+                return A0 + (A1 - A0) * (t - t0) // (t1 - t0)
+            return A0 - (A0 - A1) * (t - t0) // (t1 - t0)
+        return A1
+
+    def xp(self, balances: list = None) -> list:
+        return [rate * balance // self.PRECISION for rate, balance in zip(self.rates, balances or self.balances)]
+
+    def get_D(self, xp: list, amp: int) -> int:
+        n = self.n
+        S = sum(xp)
+        if S == 0:
+            return 0
+        D = S
+        Ann = amp * n
+        a_precision = self.a_precision
+        for _ in range(255):
+            D_P = D
+            for x in xp:
+                D_P = D_P * D // (x * n)
+            D_prev = D
+            D = ((Ann * S // a_precision + D_P * n) * D
+                 // ((Ann - a_precision) * D // a_precision + (n + 1) * D_P))
+            if abs(D - D_prev) <= 1:
+                return D
+        raise ValueError('get_D did not converge')
+
+    def get_y(self, i: int, j: int, x: int, xp: list, amp: int = None) -> int:
+        n = self.n
+        amp = self.A() if amp is None else amp
+        D = self.get_D(xp, amp)
+        Ann = amp * n
+        c = D
+        S_ = 0
+        for k in range(n):
+            if k == i:
+                _x = x
+            elif k != j:
+                _x = xp[k]
+            else:
+                continue
+            S_ += _x
+            c = c * D // (_x * n)
+        c = c * D * self.a_precision // (Ann * n)
+        b = S_ + D * self.a_precision // Ann
+        y = D
+        for _ in range(255):
+            y_prev = y
+            y = (y * y + c) // (2 * y + b - D)
+            if abs(y - y_prev) <= 1:
+                return y
+        raise ValueError('get_y did not converge')
+
+    def get_dy(self, i: int, j: int, dx: int) -> int:
+        """
+        The pool's get_dy: amount of coin j out for dx of coin i in, net of fee
+        """
+        xp = self.xp()
+        x = xp[i] + dx * self.rates[i] // self.PRECISION
+        y = self.get_y(i, j, x, xp)
+        dy = (xp[j] - y - 1) * self.PRECISION // self.rates[j]
+        return dy - self.fee * dy // self.FEE_DENOMINATOR
+
+    def exchange(self, i: int, j: int, dx: int) -> int:
+        """
+        The pool's exchange: applies the swap to the balances (the admin
+        share of the fee leaves the pool) and returns dy
+        """
+        xp = self.xp()
+        x = xp[i] + dx * self.rates[i] // self.PRECISION
+        y = self.get_y(i, j, x, xp)
+        dy = xp[j] - y - 1
+        dy_fee = dy * self.fee // self.FEE_DENOMINATOR
+        dy = (dy - dy_fee) * self.PRECISION // self.rates[j]
+        dy_admin_fee = dy_fee * self.admin_fee // self.FEE_DENOMINATOR * self.PRECISION // self.rates[j]
+        self.balances[i] += dx
+        self.balances[j] -= dy + dy_admin_fee
+        return dy
+
+    def get_dy_many(self, i: int, j: int, dxs):
+        """
+        Vectorized get_dy over many sizes in float64: the same invariant solved
+        with Newton steps on numpy arrays. Within about one unit of the output
+        coin of get_dy (float cancellation on xp[j] - y), for sizing rather
+        than exact amounts
+        """
+        import numpy as np
+
+        n = self.n
+        amp = self.A()
+        Ann = float(amp * n)
+        a_precision = float(self.a_precision)
+        D = float(self.get_D(self.xp(), amp))
+        xp = [float(v) for v in self.xp()]
+
+        x = xp[i] + np.asarray(dxs, dtype=np.float64) * self.rates[i] / self.PRECISION
+        c = np.full(x.shape, D)
+        S_ = np.zeros(x.shape)
+        for k in range(n):
+            if k == j:
+                continue
+            _x = x if k == i else xp[k]
+            S_ = S_ + _x
+            c = c * D / (_x * n)
+        c = c * D * a_precision / (Ann * n)
+        b = S_ + D * a_precision / Ann
+        y = np.full(x.shape, D)
+        for _ in range(255):
+            y_prev = y
+            y = (y * y + c) / (2 * y + b - D)
+            if np.all(np.abs(y - y_prev) <= np.maximum(1.0, y * 1e-15)):
+                break
+        dy = (xp[j] - y - 1) * self.PRECISION / self.rates[j]
+        return dy * (1 - self.fee / self.FEE_DENOMINATOR)
+
+    def set_balances(self, balances: list):
+        self.balances = [int(b) for b in balances]
+        self.stale = False
+
+    def on_token_exchange(self, i: int, dx: int, j: int, dy: int) -> bool:
+        """
+        Replays a mined TokenExchange. Returns False (and marks the state
+        stale) when the local result differs from the logged dy
+        """
+        ok = self.exchange(i, j, dx) == dy
+        if not ok:
+            self.stale = True
+        return ok
+
+    def on_liquidity(self, kind: str, amounts: list, fees: list):
+        """
+        AddLiquidity / RemoveLiquidity / RemoveLiquidityImbalance: fees stay
+        in the pool except for the admin share
+        """
+        for k in range(self.n):
+            admin = fees[k] * self.admin_fee // self.FEE_DENOMINATOR
+            if kind == 'add_liquidity':
+                self.balances[k] += amounts[k] - admin
+            else:
+                self.balances[k] -= amounts[k] + admin
+
+    def update_from_log(self, log: dict) -> bool:
+        """
+        Applies a mined pool log ({'topics', 'data', ...}, plus an optional
+        block 'timestamp' for A ramps). Returns True if the log is a pool event
+        """
+        from abi_decoder import decode_words
+
+        topic = log['topics'][0]
+        words = decode_words(log['data'])
+        if 'timestamp' in log:
+            self.timestamp = log['timestamp']
+
+        if topic == self.TOKEN_EXCHANGE:
+            sold_id, tokens_sold, bought_id, tokens_bought = words[:4]
+            self.on_token_exchange(sold_id, tokens_sold, bought_id, tokens_bought)
+        elif topic in self.LIQUIDITY_TOPICS.get(self.n, {}):
+            n = self.n
+            self.on_liquidity(self.LIQUIDITY_TOPICS[n][topic], words[:n], words[n:2 * n])
+        elif topic in self.REMOVE_LIQUIDITY_ONE_TOPICS:
+            self.stale = True
+        elif topic == self.RAMP_A:
+            self.initial_A, self.future_A, self.initial_A_time, self.future_A_time = words[:4]
+        elif topic == self.STOP_RAMP_A:
+            self.initial_A = self.future_A = words[0]
+            self.initial_A_time = self.future_A_time = words[1]
+        elif topic == self.NEW_FEE:
+            self.fee, self.admin_fee = words[:2]
+        else:
+            return False
+        return True
+
+
+class CurveCryptoSwapSimulator:
+    """
+    Local get_dy for 2-coin Curve CryptoSwap (v2) pools, transcribed from the
+    Vyper newton_D / newton_y / _fee of the two-coin crypto pools
+
+    State is kept in contract units: balances in each coin's own decimals,
+    A as stored by the pool (A * N**N * A_MULTIPLIER), gamma and price_scale
+    (price of coin 1 in coin 0) over 1e18, mid_fee / out_fee over 1e10. The
+    pool re-pegs price_scale and D inside tweak_price after every trade, which
+    mined logs do not carry, so the state is refreshed from the pool's
+    balances / price_scale / D reads (set_state) rather than replayed.
+
+    pool = CurveCryptoSwapSimulator(balances=[weth, crv], decimals=[18, 18], A=400_000,
+                                    gamma=145_000_000_000_000, price_scale=3 * 10 ** 14,
+                                    mid_fee=26_000_000, out_fee=45_000_000, fee_gamma=230_000_000_000_000)
+    pool.get_dy(0, 1, 10 ** 18)
+    """
+
+    N_COINS = 2
+    A_MULTIPLIER = 10000
+    PRECISION = 10 ** 18
+    FEE_DENOMINATOR = 10 ** 10
+
+    def __init__(self,
+                 balances: list,
+                 decimals: list,
+                 A: int,
+                 gamma: int,
+                 price_scale: int,
+                 mid_fee: int,
+                 out_fee: int,
+                 fee_gamma: int,
+                 D: int = None):
+        """
+        :param D: the pool's stored D(); recomputed from the balances when None
+        """
+        self.precisions = [10 ** (18 - d) for d in decimals]
+        self.A = A
+        self.gamma = gamma
+        self.mid_fee = mid_fee
+        self.out_fee = out_fee
+        self.fee_gamma = fee_gamma
+        self.set_state(balances, price_scale, D)
+
+    def set_state(self, balances: list, price_scale: int, D: int = None):
+        self.balances = [int(b) for b in balances]
+        self.price_scale = price_scale
+        self.D = self.newton_D(self.A, self.gamma, self.xp()) if D is None else D
+
+    def xp(self, balances: list = None) -> list:
+        balances = balances or self.balances
+        return [balances[0] * self.precisions[0],
+                balances[1] * self.precisions[1] * self.price_scale // self.PRECISION]
+
+    @staticmethod
+    def geometric_mean(x: list) -> int:
+        D = x[0]
+        for _ in range(255):
+            D_prev = D
+            D = (D + x[0] * x[1] // D) // 2
+            diff = abs(D - D_prev)
+            if diff <= 1 or diff * 10 ** 18 < D:
+                return D
+        raise ValueError('geometric_mean did not converge')
+
+    def newton_D(self, ANN: int, gamma: int, x_unsorted: list) -> int:
+        x = sorted(x_unsorted, reverse=True)
+        D = 2 * self.geometric_mean(x)
+        S = x[0] + x[1]
+        for _ in range(255):
+            D_prev = D
+            K0 = (10 ** 18 * 4) * x[0] // D * x[1] // D
+            _g1k0 = gamma + 10 ** 18
+            _g1k0 = _g1k0 - K0 + 1 if _g1k0 > K0 else K0 - _g1k0 + 1
+            mul1 = 10 ** 18 * D // gamma * _g1k0 // gamma * _g1k0 * self.A_MULTIPLIER // ANN
+            mul2 = (2 * 10 ** 18) * 2 * K0 // _g1k0
+            neg_fprime = (S + S * mul2 // 10 ** 18) + mul1 * 2 // K0 - mul2 * D // 10 ** 18
+            D_plus = D * (neg_fprime + S) // neg_fprime
+            D_minus = D * D // neg_fprime
+            if 10 ** 18 > K0:
+                D_minus += D * (mul1 // neg_fprime) // 10 ** 18 * (10 ** 18 - K0) // K0
+            else:
+                D_minus -= D * (mul1 // neg_fprime) // 10 ** 18 * (K0 - 10 ** 18) // K0
+            D = D_plus - D_minus if D_plus > D_minus else (D_minus - D_plus) // 2
+            if abs(D - D_prev) * 10 ** 14 < max(10 ** 16, D):
+                return D
+        raise ValueError('newton_D did not converge')
+
+    def newton_y(self, ANN: int, gamma: int, x: list, D: int, i: int) -> int:
+        x_j = x[1 - i]
+        y = D ** 2 // (x_j * 4)
+        K0_i = (10 ** 18 * 2) * x_j // D
+        convergence_limit = max(x_j // 10 ** 14, D // 10 ** 14, 100)
+        for _ in range(255):
+            y_prev = y
+            K0 = K0_i * y * 2 // D
+            S = x_j + y
+            _g1k0 = gamma + 10 ** 18
+            _g1k0 = _g1k0 - K0 + 1 if _g1k0 > K0 else K0 - _g1k0 + 1
+            mul1 = 10 ** 18 * D // gamma * _g1k0 // gamma * _g1k0 * self.A_MULTIPLIER // ANN
+            mul2 = 10 ** 18 + (2 * 10 ** 18) * K0 // _g1k0
+            yfprime = 10 ** 18 * y + S * mul2 + mul1
+            _dyfprime = D * mul2
+            if yfprime < _dyfprime:
+                y = y_prev // 2
+                continue
+            yfprime -= _dyfprime
+            fprime = yfprime // y
+            y_minus = mul1 // fprime
+            y_plus = (yfprime + 10 ** 18 * D) // fprime + y_minus * 10 ** 18 // K0
+            y_minus += 10 ** 18 * S // fprime
+            y = y_prev // 2 if y_plus < y_minus else y_plus - y_minus
+            if abs(y - y_prev) < max(convergence_limit, y // 10 ** 14):
+                return y
+        raise ValueError('newton_y did not converge')
+
+    def fee(self, xp: list) -> int:
+        """
+        Dynamic fee over 1e10: mid_fee at balance, out_fee far from it
+        """
+        f = xp[0] + xp[1]
+        f = self.fee_gamma * 10 ** 18 // (self.fee_gamma + 10 ** 18 - (10 ** 18 * 4) * xp[0] // f * xp[1] // f)
+        return (self.mid_fee * f + self.out_fee * (10 ** 18 - f)) // 10 ** 18
+
+    def get_dy(self, i: int, j: int, dx: int) -> int:
+        """
+        The pool's get_dy: amount of coin j out for dx of coin i in, net of fee
+        """
+        price_scale = self.price_scale * self.precisions[1]
+        xp = list(self.balances)
+        xp[i] += dx
+        xp = [xp[0] * self.precisions[0], xp[1] * price_scale // self.PRECISION]
+        y = self.newton_y(self.A, self.gamma, xp, self.D, j)
+        dy = xp[j] - y - 1
+        xp[j] = y
+        if j > 0:
+            dy = dy * self.PRECISION // price_scale
+        else:
+            dy //= self.precisions[0]
+        return dy - self.fee(xp) * dy // self.FEE_DENOMINATOR
+
+
+"""
+Selectors of the pool reads the capture_*_fixture functions make
+"""
+CURVE_BALANCES = '0x4903b0d1'        # balances(uint256)
+CURVE_A = '0xf446c1d0'               # A()
+CURVE_A_PRECISE = '0x76a2f0f0'       # A_precise()
+CURVE_FEE = '0xddca3f43'             # fee()
+CURVE_COINS = '0xc6610657'           # coins(uint256)
+CURVE_GET_DY = '0x5e0d443f'          # get_dy(int128,int128,uint256)
+CRYPTO_GAMMA = '0xb1373929'          # gamma()
+CRYPTO_PRICE_SCALE = '0xb9e8c9fd'    # price_scale()
+CRYPTO_D = '0x0f529ba2'              # D()
+CRYPTO_MID_FEE = '0x92526c0c'        # mid_fee()
+CRYPTO_OUT_FEE = '0xee8de675'        # out_fee()
+CRYPTO_FEE_GAMMA = '0x72d4f0e2'      # fee_gamma()
+CRYPTO_RAMP_END = '0xf9ed9597'       # future_A_gamma_time()
+CRYPTO_GET_DY = '0x556d6e9f'         # get_dy(uint256,uint256,uint256)
+ERC20_DECIMALS = '0x313ce567'        # decimals()
+NATIVE_ETH = '0xEeeeeEeeeEeEeeEeEeEeeEEEeeeeEeeeeeeeEEeE'
+
+"""
+On-chain get_dy results with the pool state they were quoted from, one dict
+per quote as returned by capture_get_dy_fixture (StableSwap, 3pool and
+factory plain pools):
+
+{'pool': address, 'block': number, 'balances': [...], 'decimals': [...],
+ 'amp': A_precise, 'a_precision': 1 | 100, 'fee': fee, 'i': i, 'j': j, 'dx': dx, 'dy': dy}
+
+and by capture_crypto_get_dy_fixture (2-coin CryptoSwap):
+
+{'pool': address, 'block': number, 'balances': [...], 'decimals': [...], 'A': A, 'gamma': gamma,
+ 'price_scale': price_scale, 'D': D or None while A / gamma ramp, 'mid_fee': mid_fee, 'out_fee': out_fee,
+ 'fee_gamma': fee_gamma, 'i': i, 'j': j, 'dx': dx, 'dy': dy}
+
+Captured against an archive node with `python simulator.py` (HTTP_RPC_URL
+set, plus CURVE_PLAIN_POOL / CURVE_CRYPTO_POOL addresses), which prints the
+entries to paste here. Empty until then: the __main__ check reports itself
+as skipped
+"""
+GET_DY_FIXTURES = []
+CRYPTO_GET_DY_FIXTURES = []
+
+
+def _read_uint(w3, to: str, selector: str, block: int, *args: int) -> int:
+    data = selector + ''.join(f'{a:064x}' for a in args)
+    return int.from_bytes(w3.eth.call({'to': to, 'data': data}, block), 'big')
+
+
+def _coin_decimals(w3, pool: str, n_coins: int, block: int) -> list:
+    decimals = []
+    for k in range(n_coins):
+        coin = f'0x{_read_uint(w3, pool, CURVE_COINS, block, k):040x}'
+        if coin.lower() == NATIVE_ETH.lower():
+            decimals.append(18)
+        else:
+            decimals.append(_read_uint(w3, w3.to_checksum_address(coin), ERC20_DECIMALS, block))
+    return decimals
+
+
+def capture_get_dy_fixture(w3, pool: str, n_coins: int, block: int, i: int, j: int, dx: int) -> dict:
+    """
+    Reads a StableSwap pool's state and its own get_dy(i, j, dx) at `block`
+    into a GET_DY_FIXTURES entry
+    """
+    try:
+        amp, a_precision = _read_uint(w3, pool, CURVE_A_PRECISE, block), 100
+    except Exception:
+        # 3pool-era pools have no A_precise and no A precision
+        amp, a_precision = _read_uint(w3, pool, CURVE_A, block), 1
+    return {'pool': pool, 'block': block,
+            'balances': [_read_uint(w3, pool, CURVE_BALANCES, block, k) for k in range(n_coins)],
+            'decimals': _coin_decimals(w3, pool, n_coins, block),
+            'amp': amp, 'a_precision': a_precision, 'fee': _read_uint(w3, pool, CURVE_FEE, block),
+            'i': i, 'j': j, 'dx': dx, 'dy': _read_uint(w3, pool, CURVE_GET_DY, block, i, j, dx)}
+
+
+def capture_crypto_get_dy_fixture(w3, pool: str, block: int, i: int, j: int, dx: int) -> dict:
+    """
+    Reads a 2-coin CryptoSwap pool's state and its own get_dy(i, j, dx) at
+    `block` into a CRYPTO_GET_DY_FIXTURES entry
+    """
+    def read(selector: str, *args: int) -> int:
+        return _read_uint(w3, pool, selector, block, *args)
+
+    # while A / gamma ramp the pool recomputes D from the balances instead of using the stored one
+    ramping = read(CRYPTO_RAMP_END) > 0
+    return {'pool': pool, 'block': block,
+            'balances': [read(CURVE_BALANCES, k) for k in range(2)],
+            'decimals': _coin_decimals(w3, pool, 2, block),
+            'A': read(CURVE_A), 'gamma': read(CRYPTO_GAMMA), 'price_scale': read(CRYPTO_PRICE_SCALE),
+            'D': None if ramping else read(CRYPTO_D),
+            'mid_fee': read(CRYPTO_MID_FEE), 'out_fee': read(CRYPTO_OUT_FEE), 'fee_gamma': read(CRYPTO_FEE_GAMMA),
+            'i': i, 'j': j, 'dx': dx, 'dy': read(CRYPTO_GET_DY, i, j, dx)}
+
+
+def check_get_dy_fixture(fixture: dict) -> int:
+    """
+    Local get_dy minus the on-chain one for a GET_DY_FIXTURES entry
+    """
+    pool = CurveStableSwapSimulator(fixture['balances'], fixture['decimals'], fixture['amp'], fixture['fee'],
+                                    a_precision=fixture['a_precision'])
+    return pool.get_dy(fixture['i'], fixture['j'], fixture['dx']) - fixture['dy']
+
+
+def check_crypto_get_dy_fixture(fixture: dict) -> int:
+    """
+    Local get_dy minus the on-chain one for a CRYPTO_GET_DY_FIXTURES entry
+    """
+    pool = CurveCryptoSwapSimulator(fixture['balances'], fixture['decimals'], fixture['A'], fixture['gamma'],
+                                    fixture['price_scale'], fixture['mid_fee'], fixture['out_fee'],
+                                    fixture['fee_gamma'], D=fixture['D'])
+    return pool.get_dy(fixture['i'], fixture['j'], fixture['dx']) - fixture['dy']
+
 if __name__ == '__main__':
-    pass
\ No newline at end of file
+    import time
+    import random
+    from decimal import Decimal, getcontext
+
+    """
+    CurveStableSwapSimulator checks on a 3pool-like state (DAI/USDC/USDT, A=2000):
+    integer get_y against the invariant solved in 80-digit Decimal, get_dy
+    against exchange, the float64 vectorized variant against get_dy, both
+    RemoveLiquidityOne topics, then timing. get_dy against the on-chain
+    GET_DY_FIXTURES / CRYPTO_GET_DY_FIXTURES (plus fresh quotes when
+    HTTP_RPC_URL is set; reported as skipped when there are none), and
+    CurveCryptoSwapSimulator's newton_y against the CryptoSwap invariant
+    """
+    getcontext().prec = 80
+    rng = random.Random(0)
+
+    def reference_y(pool, i, j, x, xp):
+        n, Ann = pool.n, Decimal(pool.A() * pool.n) / pool.a_precision
+        xp = [Decimal(v) for v in xp]
+
+        def f_D(D):
+            D_P = D ** (n + 1) / (n ** n * math.prod(xp))
+            return Ann * (sum(xp) - D) + D - D_P
+
+        lo, hi = Decimal(0), sum(xp) * 2
+        for _ in range(300):
+            mid = (lo + hi) / 2
+            lo, hi = (mid, hi) if f_D(mid) > 0 else (lo, mid)
+        D = lo
+
+        others = [Decimal(x) if k == i else xp[k] for k in range(n) if k != j]
+
+        def f_y(y):
+            return Ann * (sum(others) + y - D) + D - D ** (n + 1) / (n ** n * math.prod(others) * y)
+
+        lo, hi = Decimal(1), D * 2
+        for _ in range(300):
+            mid = (lo + hi) / 2
+            lo, hi = (mid, hi) if f_y(mid) < 0 else (lo, mid)
+        return lo
+
+    pool = CurveStableSwapSimulator(balances=[150_000_000 * 10 ** 18, 160_000_000 * 10 ** 6, 140_000_000 * 10 ** 6],
+                                    decimals=[18, 6, 6], amp=2000, fee=1_000_000, admin_fee=5_000_000_000)
+
+    worst = 0
+    for _ in range(200):
+        i, j = rng.sample(range(3), 2)
+        dx = rng.randint(1, 50_000_000) * 10 ** (18 if i == 0 else 6)
+        xp = pool.xp()
+        x = xp[i] + dx * pool.rates[i] // pool.PRECISION
+        worst = max(worst, abs(pool.get_y(i, j, x, xp) - reference_y(pool, i, j, x, xp)))
+        copy = CurveStableSwapSimulator(pool.balances, [18, 6, 6], 2000, pool.fee, pool.admin_fee)
+        # get_dy converts to coin units before the fee, exchange after: at most 1 unit apart
+        assert abs(pool.get_dy(i, j, dx) - copy.exchange(i, j, dx)) <= 1
+    print(f'get_y vs 80-digit Decimal invariant: max |diff| {worst} (18-decimal units)')
+
+    sizes = [10 ** k * 10 ** 18 for k in range(0, 8)]
+    exact = [pool.get_dy(0, 2, dx) for dx in sizes]
+    approx = pool.get_dy_many(0, 2, sizes)
+    print('get_dy_many vs get_dy: max |diff|', max(abs(a - e) for a, e in zip(approx.tolist(), exact)), '(USDT units)')
+
+    for topic in CurveStableSwapSimulator.REMOVE_LIQUIDITY_ONE_TOPICS:
+        copy = CurveStableSwapSimulator(pool.balances, [18, 6, 6], 2000, pool.fee, pool.admin_fee)
+        words = 3 if topic.startswith('0x9e96dd3b') else 4
+        assert copy.update_from_log({'topics': [topic], 'data': '0x' + '00' * 32 * words}) and copy.stale
+    print('RemoveLiquidityOne (3 and 4 argument topics) marks the state stale')
+
+    import os
+    import numpy as np
+
+    fixtures, crypto_fixtures = list(GET_DY_FIXTURES), list(CRYPTO_GET_DY_FIXTURES)
+    if os.getenv('HTTP_RPC_URL'):
+        from web3 import Web3
+
+        w3 = Web3(Web3.HTTPProvider(os.getenv('HTTP_RPC_URL')))
+        block = w3.eth.block_number - 64
+        captured = [capture_get_dy_fixture(w3, '0xbEbc44782C7dB0a1A60Cb6fe97d0b483032FF1C7', 3, block, i, j, dx)
+                    for i, j, dx in [(0, 1, 10 ** 21), (1, 2, 10 ** 12), (2, 0, 5 * 10 ** 13)]]
+        if os.getenv('CURVE_PLAIN_POOL'):
+            plain = Web3.to_checksum_address(os.getenv('CURVE_PLAIN_POOL'))
+            n_coins = int(os.getenv('CURVE_PLAIN_POOL_COINS', '2'))
+            decimals = _coin_decimals(w3, plain, n_coins, block)
+            captured += [capture_get_dy_fixture(w3, plain, n_coins, block, i, 1 - i, 1000 * 10 ** decimals[i])
+                         for i in range(2)]
+        crypto_captured = []
+        if os.getenv('CURVE_CRYPTO_POOL'):
+            pool_address = Web3.to_checksum_address(os.getenv('CURVE_CRYPTO_POOL'))
+            decimals = _coin_decimals(w3, pool_address, 2, block)
+            crypto_captured = [capture_crypto_get_dy_fixture(w3, pool_address, block, i, 1 - i, 10 ** decimals[i])
+                               for i in range(2)]
+        print('captured GET_DY_FIXTURES:', captured)
+        print('captured CRYPTO_GET_DY_FIXTURES:', crypto_captured)
+        fixtures += captured
+        crypto_fixtures += crypto_captured
+    for name, entries, check in (('StableSwap', fixtures, check_get_dy_fixture),
+                                 ('CryptoSwap', crypto_fixtures, check_crypto_get_dy_fixture)):
+        if not entries:
+            print(f'{name} get_dy vs on-chain get_dy: SKIPPED, no fixtures '
+                  f'(set HTTP_RPC_URL to an archive node to capture some)')
+            continue
+        for fixture in entries:
+            assert check(fixture) == 0, fixture
+        print(f'{name} get_dy vs on-chain get_dy: {len(entries)} fixtures match exactly')
+
+    def reference_crypto_y(crypto, x, D, j):
+        # K D S + x0 x1 = K D^2 + (D/2)^2 with K = A K0 gamma^2 / (gamma + 1 - K0)^2, K0 = 4 x0 x1 / D^2
+        A = Decimal(crypto.A) / (crypto.A_MULTIPLIER * 4)
+        gamma, D = Decimal(crypto.gamma) / 10 ** 18, Decimal(D)
+
+        def f(y):
+            x0, x1 = (Decimal(x[0]), y) if j == 1 else (y, Decimal(x[1]))
+            K0 = 4 * x0 * x1 / D ** 2
+            K = A * K0 * gamma ** 2 / (gamma + 1 - K0) ** 2
+            return K * D * (x0 + x1) + x0 * x1 - K * D ** 2 - D ** 2 / 4
+
+        lo, hi = Decimal(1), D * 2
+        for _ in range(300):
+            mid = (lo + hi) / 2
+            lo, hi = (mid, hi) if f(mid) < 0 else (lo, mid)
+        return lo
+
+    # WETH/CRV-like two-coin pool, CRV at 0.0003 WETH
+    crypto = CurveCryptoSwapSimulator(balances=[10_000 * 10 ** 18, 33_000_000 * 10 ** 18], decimals=[18, 18],
+                                      A=400_000, gamma=145_000_000_000_000, price_scale=3 * 10 ** 14,
+                                      mid_fee=26_000_000, out_fee=45_000_000, fee_gamma=230_000_000_000_000)
+    worst = 0
+    for _ in range(50):
+        i = rng.randrange(2)
+        dx = rng.randint(1, 3_000) * 10 ** 18 * (1 if i == 0 else 3_000)
+        balances = list(crypto.balances)
+        balances[i] += dx
+        xp = crypto.xp(balances)
+        y = crypto.newton_y(crypto.A, crypto.gamma, xp, crypto.D, 1 - i)
+        worst = max(worst, abs(Decimal(y) / reference_crypto_y(crypto, xp, crypto.D, 1 - i) - 1))
+    print(f'CryptoSwap newton_y vs 80-digit Decimal invariant: max relative diff {float(worst):.1e}',
+          {'1 WETH -> CRV': crypto.get_dy(0, 1, 10 ** 18) / 1e18, '3000 CRV -> WETH': crypto.get_dy(1, 0, 3000 * 10 ** 18) / 1e18})
+
+    n = 2000
+    s = time.perf_counter()
+    for k in range(n):
+        pool.get_dy(0, 1, (k + 1) * 10 ** 20)
+    print(f'get_dy: {(time.perf_counter() - s) / n * 1e6:.1f} us/quote')
+    many = np.linspace(1, 10_000_000, 100_000) * 1e18
+    s = time.perf_counter()
+    pool.get_dy_many(0, 1, many)
+    print(f'get_dy_many: {(time.perf_counter() - s) / len(many) * 1e6:.3f} us/quote over {len(many):,} sizes')
@@ -0,0 +1,471 @@
+"""
+Cache of block-pinned contract reads
+
+An eth_call pinned to a finalized block number always returns the same data,
+so StateCache keeps every result under (address, calldata, block): an
+in-memory LRU in front of an SQLite file. Blocks within `confirmations` of
+the head can still be reorged out under the same number, so their reads are
+neither looked up nor stored: callers reading near the tip pass head= (the
+live streams pass the block they just read). Misses are sent in as few requests as
+possible: grouped into Multicall3 aggregate3 calls (from the block Multicall3
+was deployed at, plain eth_calls before that), all sent as one JSON-RPC
+batch. Reads at 'latest' or 'pending' are never cached.
+
+cache = StateCache(HTTP_RPC_URL, path='state_cache.sqlite')
+states = cache.pool_states(pool, range(18_000_000, 18_000_100))   # SpreadBacktester states
+balances = cache.curve_balances(CURVE_3POOL, 3, blocks)
+
+w3 = cache.web3()    # Web3 whose pinned eth_calls go through the cache
+contract.functions.slot0().call(block_identifier=18_000_000)
+
+Replaying the same research a second time makes no RPC calls at all.
+"""
+import json
+import time
+import sqlite3
+import requests
+import numpy as np
+
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple, TYPE_CHECKING
+
+from web3 import Web3
+
+from constants import MULTICALL3
+
+if TYPE_CHECKING:
+    from rpc_client import RPCClient
+
+
+"""
+Selectors of the state reads pool_states / curve_balances make
+"""
+SLOT0 = '0x3850c7bd'         # slot0()
+LIQUIDITY = '0x1a686502'     # liquidity()
+GET_RESERVES = '0x0902f1ac'  # getReserves()
+BALANCES = '0x4903b0d1'      # balances(uint256)
+AGGREGATE3 = '0x82ad56cb'    # aggregate3((address,bool,bytes)[])
+
+Key = Tuple[str, str, int]
+
+
+def _word(data: bytes, i: int, signed: bool = False) -> int:
+    return int.from_bytes(data[32 * i:32 * (i + 1)], 'big', signed=signed)
+
+
+def _block_number(block_identifier: Any) -> Optional[int]:
+    """
+    Block number of a pinned block identifier, None for tags such as 'latest'
+    """
+    if isinstance(block_identifier, int):
+        return block_identifier
+    if isinstance(block_identifier, str) and block_identifier.startswith('0x'):
+        # 32 byte block hashes are pinned too, but not by number
+        return int(block_identifier, 16) if len(block_identifier) <= 18 else None
+    return None
+
+
+class StateCache:
+
+    def __init__(self,
+                 http_rpc_url: str,
+                 path: Optional[str] = 'state_cache.sqlite',
+                 memory_size: int = 100_000,
+                 multicall_size: int = 200,
+                 batch_size: int = 50,
+                 multicall: Optional[Tuple[str, int]] = tuple(MULTICALL3),
+                 confirmations: int = 64):
+        """
+        :param path: SQLite file of the on-disk store, None to keep results in memory only
+        :param confirmations: blocks behind the highest head seen before a block's reads are cached;
+                              with no head ever passed (historical research) every block is cached
+        :param multicall_size: calls per aggregate3
+        :param batch_size: eth_calls per JSON-RPC batch request
+        :param multicall: (address, deployed block) of Multicall3, None to send every call on its own
+        """
+        self.http_rpc_url = http_rpc_url
+        self.memory_size = memory_size
+        self.multicall_size = multicall_size
+        self.batch_size = batch_size
+        self.multicall = (multicall[0].lower(), multicall[1]) if multicall else None
+        self.confirmations = confirmations
+        self.head: Optional[int] = None
+        self.memory: 'OrderedDict[Key, Optional[bytes]]' = OrderedDict()
+        self.session = requests.Session()
+        self.stats = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0, 'unconfirmed': 0, 'rpc_requests': 0,
+                      'rpc_calls': 0}
+
+        self.db = sqlite3.connect(path or ':memory:')
+        self.db.execute('CREATE TABLE IF NOT EXISTS calls (address TEXT, data TEXT, block INTEGER, '
+                        'ok INTEGER, result BLOB, PRIMARY KEY (address, data, block)) WITHOUT ROWID')
+        self.db.execute('CREATE TABLE IF NOT EXISTS blocks (number INTEGER PRIMARY KEY, timestamp INTEGER)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS constants (method TEXT PRIMARY KEY, result TEXT)')
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+        self.session.close()
+
+    def _remember(self, key: Key, result: Optional[bytes]):
+        self.memory[key] = result
+        self.memory.move_to_end(key)
+        if len(self.memory) > self.memory_size:
+            self.memory.popitem(last=False)
+
+    def _lookup(self, keys: Sequence[Key]) -> Dict[Key, Optional[bytes]]:
+        """
+        Cached results of `keys`, memory first, then disk. A reverted call is
+        cached as None
+        """
+        found = {}
+        on_disk = []
+        for key in keys:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                found[key] = self.memory[key]
+                self.stats['memory_hits'] += 1
+            else:
+                on_disk.append(key)
+
+        for key in on_disk:
+            row = self.db.execute('SELECT ok, result FROM calls WHERE address = ? AND data = ? AND block = ?',
+                                  key).fetchone()
+            if row is not None:
+                found[key] = bytes(row[1]) if row[0] else None
+                self._remember(key, found[key])
+                self.stats['disk_hits'] += 1
+        return found
+
+    def final(self, block: int) -> bool:
+        """
+        Whether `block` is deep enough below the head that a reorg cannot replace it
+        """
+        return self.head is None or block <= self.head - self.confirmations
+
+    def set_head(self, head: Optional[int]):
+        if head is not None and (self.head is None or head > self.head):
+            self.head = head
+
+    def _store(self, results: Dict[Key, Optional[bytes]]):
+        results = {key: result for key, result in results.items() if self.final(key[2])}
+        self.db.executemany('INSERT OR REPLACE INTO calls VALUES (?, ?, ?, ?, ?)',
+                            [(*key, result is not None, result or b'') for key, result in results.items()])
+        self.db.commit()
+        for key, result in results.items():
+            self._remember(key, result)
+
+    def _rpc(self, payloads: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """
+        One JSON-RPC batch per batch_size requests, responses in request order
+        """
+        responses = []
+        for i in range(0, len(payloads), self.batch_size):
+            batch = [{'jsonrpc': '2.0', 'id': j, **payload} for j, payload in enumerate(payloads[i:i + self.batch_size])]
+            res = self.session.post(self.http_rpc_url, json=batch, timeout=30)
+            res.raise_for_status()
+            self.stats['rpc_requests'] += 1
+            self.stats['rpc_calls'] += len(batch)
+            body = res.json()
+            if not isinstance(body, list):
+                # a node that rejects the whole batch answers with one error object
+                error = body.get('error', body) if isinstance(body, dict) else body
+                raise RuntimeError(f'JSON-RPC batch of {len(batch)} calls to {self.http_rpc_url} failed: {error}')
+            by_id = {r.get('id'): r for r in body}
+            missing = [j for j in range(len(batch)) if j not in by_id]
+            if missing:
+                raise RuntimeError(f'{len(missing)} calls without a response from {self.http_rpc_url}')
+            responses.extend(by_id[j] for j in range(len(batch)))
+        return responses
+
+    def _requests(self, keys: List[Key]) -> List[Tuple[Dict[str, Any], List[Key], bool]]:
+        """
+        (payload, keys it answers, whether it is an aggregate3) of every
+        request that fetches `keys`
+        """
+        import eth_abi
+
+        requests_: List[Tuple[Dict[str, Any], List[Key], bool]] = []
+        by_block: Dict[int, List[Key]] = {}
+        for key in keys:
+            by_block.setdefault(key[2], []).append(key)
+
+        for block, block_keys in by_block.items():
+            if self.multicall and block >= self.multicall[1] and len(block_keys) > 1:
+                for i in range(0, len(block_keys), self.multicall_size):
+                    chunk = block_keys[i:i + self.multicall_size]
+                    calldata = eth_abi.encode(['(address,bool,bytes)[]'],
+                                              [[(address, True, bytes.fromhex(data[2:])) for address, data, _ in chunk]])
+                    call = {'to': self.multicall[0], 'data': AGGREGATE3 + calldata.hex()}
+                    requests_.append(({'method': 'eth_call', 'params': [call, hex(block)]}, chunk, True))
+            else:
+                for key in block_keys:
+                    address, data, _ = key
+                    call = {'to': address, 'data': data}
+                    requests_.append(({'method': 'eth_call', 'params': [call, hex(block)]}, [key], False))
+        return requests_
+
+    @staticmethod
+    def _decode(requests_: List[Tuple[Dict[str, Any], List[Key], bool]],
+                responses: List[Dict[str, Any]]) -> Dict[Key, Optional[bytes]]:
+        import eth_abi
+
+        results = {}
+        for (_, chunk, aggregated), response in zip(requests_, responses):
+            if 'error' in response:
+                error = response['error']
+                if aggregated or not (error.get('code') == 3 or 'revert' in str(error.get('message', '')).lower()):
+                    # node errors (pruned state, rate limits, ...) are not cached
+                    raise RuntimeError(f'eth_call at block {chunk[0][2]} failed: {error}')
+                # a reverted call: deterministic at a pinned block, so cached as well
+                results[chunk[0]] = None
+                continue
+            data = bytes.fromhex(response['result'][2:])
+            if aggregated:
+                returned, = eth_abi.decode(['(bool,bytes)[]'], data)
+                for key, (success, return_data) in zip(chunk, returned):
+                    results[key] = bytes(return_data) if success else None
+            else:
+                results[chunk[0]] = data
+        return results
+
+    def _fetch(self, keys: List[Key]) -> Dict[Key, Optional[bytes]]:
+        requests_ = self._requests(keys)
+        return self._decode(requests_, self._rpc([r[0] for r in requests_]))
+
+    def _misses(self,
+                calls: Iterable[Tuple[str, str, int]],
+                head: Optional[int] = None) -> Tuple[List[Key], Dict[Key, Optional[bytes]], List[Key]]:
+        self.set_head(head)
+        keys = [(address.lower(), data.lower(), int(block)) for address, data, block in calls]
+        unique = list(dict.fromkeys(keys))
+        found = self._lookup([key for key in unique if self.final(key[2])])
+        missing = [key for key in unique if key not in found]
+        self.stats['misses'] += len(missing)
+        self.stats['unconfirmed'] += sum(1 for key in missing if not self.final(key[2]))
+        return keys, found, missing
+
+    def call_many(self, calls: Iterable[Tuple[str, str, int]], head: Optional[int] = None) -> List[Optional[bytes]]:
+        """
+        Return data of each (address, calldata hex, block number), None for
+        calls that reverted. Only the misses go to the node, batched
+
+        :param head: current chain head; reads within `confirmations` of it are not cached
+        """
+        keys, found, missing = self._misses(calls, head)
+        if missing:
+            fetched = self._fetch(missing)
+            self._store(fetched)
+            found.update(fetched)
+        return [found[key] for key in keys]
+
+    async def call_many_async(self,
+                              calls: Iterable[Tuple[str, str, int]],
+                              client: 'RPCClient',
+                              head: Optional[int] = None) -> List[Optional[bytes]]:
+        """
+        call_many for the event loop: the misses are sent through an
+        rpc_client.RPCClient of the same endpoint instead of blocking on HTTP
+        """
+        keys, found, missing = self._misses(calls, head)
+        if missing:
+            requests_ = self._requests(missing)
+            responses = await client.batch([(r[0]['method'], r[0]['params']) for r in requests_], raw=True)
+            self.stats['rpc_requests'] += -(-len(requests_) // client.max_batch)
+            self.stats['rpc_calls'] += len(requests_)
+            fetched = self._decode(requests_, responses)
+            self._store(fetched)
+            found.update(fetched)
+        return [found[key] for key in keys]
+
+    def call(self, address: str, data: str, block: int) -> Optional[bytes]:
+        return self.call_many([(address, data, block)])[0]
+
+    def constant(self, method: str) -> Any:
+        """
+        Result of a parameterless method that never changes for the endpoint
+        (eth_chainId, net_version), fetched once
+        """
+        row = self.db.execute('SELECT result FROM constants WHERE method = ?', (method,)).fetchone()
+        if row is not None:
+            return json.loads(row[0])
+        result = self._rpc([{'method': method, 'params': []}])[0]['result']
+        self.db.execute('INSERT OR REPLACE INTO constants VALUES (?, ?)', (method, json.dumps(result)))
+        self.db.commit()
+        return result
+
+    def block_timestamps(self, blocks: Sequence[int]) -> np.ndarray:
+        """
+        Timestamps of `blocks` in milliseconds (the unit of the blocks / states
+        arrays SpreadBacktester takes), cached like the calls
+        """
+        blocks = [int(b) for b in blocks]
+        known = {}
+        for number in dict.fromkeys(blocks):
+            if not self.final(number):
+                continue
+            row = self.db.execute('SELECT timestamp FROM blocks WHERE number = ?', (number,)).fetchone()
+            if row is not None:
+                known[number] = row[0]
+        missing = [number for number in dict.fromkeys(blocks) if number not in known]
+        if missing:
+            responses = self._rpc([{'method': 'eth_getBlockByNumber', 'params': [hex(number), False]}
+                                   for number in missing])
+            fetched = {number: int(r['result']['timestamp'], 16) for number, r in zip(missing, responses)}
+            self.db.executemany('INSERT OR REPLACE INTO blocks VALUES (?, ?)',
+                                [(number, t) for number, t in fetched.items() if self.final(number)])
+            self.db.commit()
+            known.update(fetched)
+        return np.array([known[number] * 1000 for number in blocks], dtype=np.int64)
+
+    def pools_states(self,
+                     pools: Iterable[Any],
+                     blocks: Sequence[int],
+                     timestamps: bool = True) -> Dict[str, Dict[str, np.ndarray]]:
+        """
+        Uniswap pool states at every block, as the `states` SpreadBacktester and
+        sweep.states_from_history take, by pool address: block_number,
+        timestamp and either sqrtPriceX96 / tick / liquidity (V3) or
+        reserve0 / reserve1 (V2). Big integers are kept as float64, as the
+        backtester uses them. The reads of all pools at a block share one
+        aggregate3
+
+        :param pools: pool_registry.Pool objects or constants.POOLS dicts
+        """
+        pools = list(pools)
+        blocks = np.asarray(blocks, dtype=np.int64)
+        selectors = {address: (SLOT0, LIQUIDITY) if version == 3 else (GET_RESERVES,)
+                     for address, version in ((p['address'].lower(), p['version']) for p in pools)}
+        calls = [(address, selector, block) for block in blocks.tolist()
+                 for address, pool_selectors in selectors.items() for selector in pool_selectors]
+        results = dict(zip(((address, selector, block) for address, selector, block in calls), self.call_many(calls)))
+        block_timestamps = self.block_timestamps(blocks) if timestamps else None
+
+        states = {}
+        for address, pool_selectors in selectors.items():
+            state = {'block_number': blocks}
+            if block_timestamps is not None:
+                state['timestamp'] = block_timestamps
+            if pool_selectors == (SLOT0, LIQUIDITY):
+                slot0 = [results[(address, SLOT0, block)] for block in blocks.tolist()]
+                liquidity = [results[(address, LIQUIDITY, block)] for block in blocks.tolist()]
+                state['sqrtPriceX96'] = np.array([_word(r, 0) if r else np.nan for r in slot0], dtype=np.float64)
+                state['tick'] = np.array([_word(r, 1, signed=True) if r else 0 for r in slot0], dtype=np.int64)
+                state['liquidity'] = np.array([_word(r, 0) if r else np.nan for r in liquidity], dtype=np.float64)
+            else:
+                reserves = [results[(address, GET_RESERVES, block)] for block in blocks.tolist()]
+                state['reserve0'] = np.array([_word(r, 0) if r else np.nan for r in reserves], dtype=np.float64)
+                state['reserve1'] = np.array([_word(r, 1) if r else np.nan for r in reserves], dtype=np.float64)
+            states[address] = state
+        return states
+
+    def pool_states(self, pool: Any, blocks: Sequence[int], timestamps: bool = True) -> Dict[str, np.ndarray]:
+        return self.pools_states([pool], blocks, timestamps)[pool['address'].lower()]
+
+    def curve_balances(self, address: str, n_coins: int, blocks: Sequence[int]) -> np.ndarray:
+        """
+        balances(i) of a Curve pool at every block, a (len(blocks), n_coins)
+        array of contract units (the input of CurveStableSwapSimulator.set_balances)
+        """
+        calls = [(address, BALANCES + f'{i:064x}', block) for block in blocks for i in range(n_coins)]
+        results = self.call_many(calls)
+        return np.array([_word(r, 0) if r else 0 for r in results], dtype=object).reshape(len(blocks), n_coins)
+
+    def web3(self, **kwargs) -> Web3:
+        return Web3(CachingHTTPProvider(self, **kwargs))
+
+
+class CachingHTTPProvider(Web3.HTTPProvider):
+    """
+    HTTPProvider whose eth_calls pinned to a block number (and eth_chainId /
+    net_version) are answered from a StateCache. Calls with a sender, value
+    or gas, and calls at block tags, go to the node as usual
+    """
+
+    CONSTANT_METHODS = ('eth_chainId', 'net_version')
+
+    def __init__(self, cache: StateCache, **kwargs):
+        super().__init__(cache.http_rpc_url, **kwargs)
+        self.cache = cache
+
+    def make_request(self, method, params):
+        if method in self.CONSTANT_METHODS and not params:
+            return {'jsonrpc': '2.0', 'id': int(time.time() * 1000), 'result': self.cache.constant(method)}
+        if method == 'eth_call' and len(params) > 1:
+            call, block = params[0], _block_number(params[1])
+            data = call.get('data') or call.get('input')
+            if block is not None and data and set(call) <= {'to', 'data', 'input'}:
+                result = self.cache.call(call['to'], data, block)
+                if result is None:
+                    # a cached revert: the error a node returns for a revert without reason
+                    return {'jsonrpc': '2.0', 'id': int(time.time() * 1000),
+                            'error': {'code': 3, 'message': 'execution reverted', 'data': '0x'}}
+                return {'jsonrpc': '2.0', 'id': int(time.time() * 1000), 'result': '0x' + result.hex()}
+        return super().make_request(method, params)
+
+
+if __name__ == '__main__':
+    import os
+    import asyncio
+    import threading
+
+    from mock_servers import MockEthereumNode
+    from pool_registry import PoolRegistry
+    from constants import POOLS, TOKENS
+
+    """
+    Reads 100 blocks of state of every pool in POOLS from the mock node, then
+    replays the same reads from memory and from a fresh process' view of the
+    file: neither replay may make an RPC call
+    """
+    node = MockEthereumNode(port=8791, http_port=8792)
+    registry = PoolRegistry.from_pools(POOLS, TOKENS)
+    for pool in registry:
+        if pool.version == 3:
+            node.add_v3_pool(pool.address, 2 ** 96 * 10 ** 3, 10 ** 20)
+        else:
+            node.add_v2_pool(pool.address, 10 ** 22, 2 * 10 ** 13)
+    node.block_number = 18_000_100
+
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(node.start())
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+
+    path = '/tmp/state_cache_demo.sqlite'
+    blocks = range(18_000_000, 18_000_100)
+    for run in ('cold', 'memory', 'disk'):
+        if run == 'cold' and os.path.exists(path):
+            os.remove(path)
+        if run != 'memory':
+            cache = StateCache(node.http_url, path=path)
+        before = node.rpc_requests
+        s = time.perf_counter()
+        states = cache.pools_states(registry, blocks)
+        print(f'{run}: {len(registry)} pools x {len(blocks)} blocks in {time.perf_counter() - s:.3f}s, '
+              f'{node.rpc_requests - before} RPC calls', cache.stats)
+
+    w3 = cache.web3()
+    pool = next(p for p in registry if p.version == 3)
+    w3.eth.chain_id
+    before = node.rpc_requests
+    liquidity = w3.eth.call({'to': Web3.to_checksum_address(pool.address), 'data': LIQUIDITY}, 18_000_000)
+    print('web3 eth_call at a pinned block:', int.from_bytes(liquidity, 'big'), f'{node.rpc_requests - before} RPC calls')
+
+    # reads near the head are not cached: a reorg could replace the block under the same number
+    before = node.rpc_requests
+    for _ in range(2):
+        cache.call_many([(pool.address, SLOT0, 18_000_090)], head=18_000_100)
+    assert not cache.final(18_000_090) and node.rpc_requests - before == 2
+    print('reads 10 blocks below the head:', f'{node.rpc_requests - before} RPC calls for 2 reads, not cached',
+          {'unconfirmed': cache.stats['unconfirmed']})
+    cache.head = None
+
+    from web3.exceptions import ContractLogicError
+
+    # a revert cached by an earlier run must raise the same error as the node's, still without a call
+    cache._store({(pool.address.lower(), SLOT0, 18_000_000): None})
+    before = node.rpc_requests
+    try:
+        w3.eth.call({'to': Web3.to_checksum_address(pool.address), 'data': SLOT0}, 18_000_000)
+        raise AssertionError('cached revert returned a result')
+    except ContractLogicError as e:
+        print('web3 eth_call of a cached revert:', repr(e), f'{node.rpc_requests - before} RPC calls')
@@ -0,0 +1,288 @@
+"""
+Parameter sweeps over UniswapV2Simulator.get_max_amount_in
+
+Every combination of pool state x max_amount_in x step_size x slippage band
+is one cell. Cells are addressed by their flat index, so workers receive only
+(start, stop) ranges and rebuild the parameters themselves; the pool states
+and grid are shipped once per worker through the pool initializer.
+
+results = sweep_max_amount_in(states, {
+    'max_amount_in': [10, 100, 1000],
+    'step_size': [0.01, 0.1, 1],
+    'slippage_tolerance_lower': [0, 0.0009],
+    'slippage_tolerance_upper': [0.001, 0.005],
+})
+summarize(results)
+"""
+import os
+import time
+import numpy as np
+
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, List, Optional, Sequence
+
+from simulator import UniswapV2Simulator
+
+
+PARAMS = ('max_amount_in', 'step_size', 'slippage_tolerance_lower', 'slippage_tolerance_upper')
+
+STATE_DTYPE = np.dtype([
+    ('reserve0', 'f8'),
+    ('reserve1', 'f8'),
+    ('decimals0', 'i4'),
+    ('decimals1', 'i4'),
+    ('fee', 'i4'),
+    ('token0_in', '?'),
+])
+
+RESULT_DTYPE = np.dtype([
+    ('state', 'i8'),
+    *[(param, 'f8') for param in PARAMS],
+    ('amount_in', 'f8'),     # NaN for invalid cells (lower > upper band)
+    ('amount_out', 'f8'),
+    ('slippage', 'f8'),
+    ('elapsed_us', 'f4'),
+])
+
+
+def make_states(reserve0, reserve1, decimals0, decimals1, fee=3000, token0_in=True) -> np.ndarray:
+    """
+    Pool states from scalars or arrays (broadcast against each other), reserves in raw units
+    """
+    columns = np.broadcast_arrays(*[np.asarray(v) for v in (reserve0, reserve1, decimals0, decimals1, fee, token0_in)])
+    states = np.zeros(columns[0].shape, dtype=STATE_DTYPE).ravel()
+    for name, column in zip(STATE_DTYPE.names, columns):
+        states[name] = column.ravel()
+    return states
+
+
+def states_from_history(pool: Dict[str, Any],
+                        states: Dict[str, np.ndarray],
+                        tokens: Dict[str, List[Any]],
+                        token0_in: bool = True) -> np.ndarray:
+    """
+    Recorded pool states, in the format SpreadBacktester takes. V3 pools are
+    swept on their virtual reserves
+    """
+    from backtester import v3_virtual_reserves
+
+    if pool['version'] == 2:
+        reserve0, reserve1 = states['reserve0'], states['reserve1']
+    else:
+        reserve0, reserve1 = v3_virtual_reserves(states['sqrtPriceX96'].astype(np.float64),
+                                                 states['liquidity'].astype(np.float64))
+    return make_states(reserve0, reserve1,
+                       tokens[pool['token0']][1], tokens[pool['token1']][1],
+                       pool['fee'], token0_in)
+
+
+def _event_decimals(event: Dict[str, Any]) -> List[int]:
+    """
+    [decimals0, decimals1] of a pool_update, whose decimals are keyed by
+    token symbol and put in pool order by token_idx
+    """
+    decimals = [0, 0]
+    for token, idx in event['token_idx'].items():
+        decimals[idx] = event['decimals'][token]
+    return decimals
+
+
+def states_from_events(events: Sequence[Dict[str, Any]], token0_in: bool = True) -> np.ndarray:
+    """
+    Live snapshots: the last pool_update events of the pools to sweep
+    (dicts or events.PoolUpdateEvent)
+    """
+    from backtester import v3_virtual_reserves
+
+    reserve0, reserve1, decimals = [], [], []
+    for event in events:
+        decimals.append(_event_decimals(event))
+        if event.get('version') == 3:
+            r0, r1 = v3_virtual_reserves(float(event['sqrtPriceX96']), float(event['liquidity']))
+        else:
+            r0, r1 = event['reserve0'], event['reserve1']
+        reserve0.append(r0)
+        reserve1.append(r1)
+    return make_states(reserve0, reserve1,
+                       [d[0] for d in decimals],
+                       [d[1] for d in decimals],
+                       [event['fee'] for event in events],
+                       token0_in)
+
+
+_WORKER: Dict[str, Any] = {}
+
+
+def _init_worker(states: np.ndarray, grid: Dict[str, np.ndarray]):
+    _WORKER['states'] = states
+    _WORKER['grid'] = grid
+    _WORKER['shape'] = (len(states), *[len(grid[param]) for param in PARAMS])
+    _WORKER['simulator'] = UniswapV2Simulator()
+
+
+def _run_chunk(start: int, stop: int) -> np.ndarray:
+    states, grid, sim = _WORKER['states'], _WORKER['grid'], _WORKER['simulator']
+    idx = np.unravel_index(np.arange(start, stop), _WORKER['shape'])
+
+    out = np.empty(stop - start, dtype=RESULT_DTYPE)
+    out['state'] = idx[0]
+    for i, param in enumerate(PARAMS):
+        out[param] = grid[param][idx[i + 1]]
+
+    amount_in = out['amount_in']
+    amount_out = out['amount_out']
+    slippage = out['slippage']
+    elapsed = out['elapsed_us']
+    # plain Python scalars: the simulator is scalar code and numpy scalars slow it down
+    rows = zip(out['state'].tolist(), *[out[param].tolist() for param in PARAMS])
+    state_rows = states.tolist()
+    perf_counter = time.perf_counter
+
+    for i, (s, max_amount_in, step_size, lower, upper) in enumerate(rows):
+        if lower > upper:
+            amount_in[i] = amount_out[i] = slippage[i] = np.nan
+            elapsed[i] = 0
+            continue
+
+        reserve0, reserve1, decimals0, decimals1, fee, token0_in = state_rows[s]
+        t = perf_counter()
+        optimized_in = sim.get_max_amount_in(reserve0, reserve1, decimals0, decimals1, fee, token0_in,
+                                             max_amount_in, step_size, lower, upper)
+        elapsed[i] = (perf_counter() - t) * 1e6
+        amount_in[i] = optimized_in
+
+        if optimized_in > 0:
+            if token0_in:
+                decimal_in, decimal_out, reserve_in, reserve_out = decimals0, decimals1, reserve0, reserve1
+            else:
+                decimal_in, decimal_out, reserve_in, reserve_out = decimals1, decimals0, reserve1, reserve0
+            out_amount = sim.get_amount_out(optimized_in * 10 ** decimal_in, reserve_in, reserve_out, fee) / 10 ** decimal_out
+            quote = sim.reserves_to_price(reserve0, reserve1, decimals0, decimals1, token0_in) * (1 - fee / 1e6)
+            amount_out[i] = out_amount
+            slippage[i] = (quote - out_amount / optimized_in) / quote
+        else:
+            amount_out[i] = 0.0
+            slippage[i] = np.nan
+
+    return out
+
+
+def sweep_max_amount_in(states: np.ndarray,
+                        grid: Dict[str, Sequence[float]],
+                        processes: Optional[int] = None,
+                        chunk_size: Optional[int] = None) -> np.ndarray:
+    """
+    Runs get_max_amount_in on every (state, grid combination) cell
+
+    :param states: STATE_DTYPE array, see make_states / states_from_history / states_from_events
+    :param grid: values for each name in PARAMS
+    :param processes: worker processes, defaults to the CPU count; 1 runs in-process
+    :param chunk_size: cells per task, defaults to ~8 tasks per worker (1k-200k cells)
+    :return: RESULT_DTYPE array, one row per cell in (state, *PARAMS) C order
+    """
+    missing = [param for param in PARAMS if param not in grid]
+    if missing:
+        raise ValueError(f'Missing grid values for {missing}')
+
+    grid = {param: np.asarray(grid[param], dtype=np.float64) for param in PARAMS}
+    total = len(states) * int(np.prod([len(grid[param]) for param in PARAMS]))
+    processes = processes or os.cpu_count() or 1
+    if chunk_size is None:
+        chunk_size = min(200_000, max(1_000, -(-total // (processes * 8))))
+    chunks = [(start, min(start + chunk_size, total)) for start in range(0, total, chunk_size)]
+
+    results = np.empty(total, dtype=RESULT_DTYPE)
+    if processes == 1:
+        _init_worker(states, grid)
+        for start, stop in chunks:
+            results[start:stop] = _run_chunk(start, stop)
+        return results
+
+    with ProcessPoolExecutor(processes, initializer=_init_worker, initargs=(states, grid)) as pool:
+        starts, stops = zip(*chunks) if chunks else ((), ())
+        for (start, stop), chunk in zip(chunks, pool.map(_run_chunk, starts, stops)):
+            results[start:stop] = chunk
+    return results
+
+
+def summarize(results: np.ndarray, by: Sequence[str] = PARAMS) -> np.ndarray:
+    """
+    Per parameter combination (across pool states): mean amount_in, hit rate
+    (share of cells that found an amount_in), mean slippage of the hits and
+    mean / max call time. Invalid cells are left out
+    """
+    valid = results[~np.isnan(results['amount_in'])]
+    keys, inverse = np.unique(np.stack([valid[name] for name in by], axis=1), axis=0, return_inverse=True)
+    inverse = inverse.ravel()
+    counts = np.bincount(inverse, minlength=len(keys))
+    hits = valid['amount_in'] > 0
+    hit_counts = np.bincount(inverse, weights=hits, minlength=len(keys))
+
+    summary = np.zeros(len(keys), dtype=[*[(name, 'f8') for name in by],
+                                         ('cells', 'i8'), ('mean_amount_in', 'f8'), ('hit_rate', 'f8'),
+                                         ('mean_slippage', 'f8'), ('mean_us', 'f8'), ('max_us', 'f8')])
+    for i, name in enumerate(by):
+        summary[name] = keys[:, i]
+    summary['cells'] = counts
+    summary['mean_amount_in'] = np.bincount(inverse, weights=valid['amount_in'], minlength=len(keys)) / counts
+    summary['hit_rate'] = hit_counts / counts
+    with np.errstate(invalid='ignore', divide='ignore'):
+        summary['mean_slippage'] = np.bincount(inverse, weights=np.where(hits, valid['slippage'], 0),
+                                               minlength=len(keys)) / hit_counts
+    summary['mean_us'] = np.bincount(inverse, weights=valid['elapsed_us'], minlength=len(keys)) / counts
+    max_us = np.zeros(len(keys))
+    np.maximum.at(max_us, inverse, valid['elapsed_us'])
+    summary['max_us'] = max_us
+    return summary
+
+
+if __name__ == '__main__':
+    from constants import TOKENS, POOLS
+    from events import PoolUpdateEvent
+    from pool_registry import PoolRegistry
+
+    """
+    Live states from the pool_update events the streams publish, typed and as dicts
+    """
+    events = []
+    registry = PoolRegistry.from_pools(POOLS, TOKENS)
+    for p in registry:
+        state = {'sqrtPriceX96': 2 ** 96, 'liquidity': 10 ** 18} if p.version == 3 else {'reserve0': 10 ** 21, 'reserve1': 10 ** 21}
+        events.append(PoolUpdateEvent(18_000_000, p.exchange, p.version, p.symbol, p.address, p.fee,
+                                      p.token_idx, p.decimals, **state))
+    for live in (states_from_events(events), states_from_events([event.to_dict() for event in events])):
+        assert live['decimals0'].tolist() == [p.decimals0 for p in registry]
+        assert live['decimals1'].tolist() == [p.decimals1 for p in registry]
+    print({'live_states': len(live), 'decimals': list(zip(live['decimals0'].tolist(), live['decimals1'].tolist()))})
+
+    """
+    Sweeps 1M cells: 250 recorded states of the ETH/USDT V2 pool (synthetic
+    random walk) x 4,000 parameter combinations
+    """
+    rng = np.random.default_rng(0)
+    pool = next(p for p in POOLS if p['version'] == 2 and p['name'] == 'ETH/USDT')
+    n = 250
+    reserve0 = 20_000 * 1e18 * np.exp(rng.normal(0, 0.05, n))
+    price = 2000 * np.exp(np.cumsum(rng.normal(0, 1e-3, n)))
+    history = {'reserve0': reserve0, 'reserve1': reserve0 / 1e18 * price * 1e6}
+    states = states_from_history(pool, history, TOKENS, token0_in=pool['token0'] == 'ETH')
+
+    grid = {
+        'max_amount_in': [1, 10, 50, 100, 250, 500, 1000, 5000, 10_000, 50_000],
+        'step_size': [0.001, 0.01, 0.1, 1, 10],
+        'slippage_tolerance_lower': [0, 0.0005, 0.0009, 0.002, 0.004, 0.008, 0.009, 0.01],
+        'slippage_tolerance_upper': [0.001, 0.002, 0.005, 0.007, 0.01, 0.02, 0.03, 0.05, 0.07, 0.1],
+    }
+
+    s = time.perf_counter()
+    results = sweep_max_amount_in(states, grid)
+    elapsed = time.perf_counter() - s
+    print(f'{len(results):,} cells on {os.cpu_count()} processes: {elapsed:.1f}s '
+          f'({len(results) / elapsed:,.0f} cells/s)')
+
+    summary = summarize(results)
+    summary = summary[np.argsort(-summary['mean_amount_in'] * summary['hit_rate'])]
+    names = [name.replace('slippage_tolerance_', 'slippage_') for name in summary.dtype.names]
+    print(' '.join(f'{name:>16}' for name in names))
+    for row in summary[:10]:
+        print(' '.join(f'{value:>16.6g}' for value in row.tolist()))
@@ -0,0 +1,239 @@
+import os
+import numpy as np
+
+from typing import Any, Dict, List, Optional, Tuple
+
+
+HEADER_SIZE = 64
+MAGIC = 0x4B434954  # 'TICK'
+VERSION = 1
+
+
+def book_dtype(depth: int) -> np.dtype:
+    """
+    Fixed-width record layout for a top-N orderbook snapshot
+
+    timestamp is in milliseconds (the unit Binance 'E' and OKX 'ts' use),
+    missing levels are filled with NaN
+    """
+    return np.dtype([
+        ('timestamp', '<i8'),
+        ('bid_price', '<f8', (depth,)),
+        ('bid_qty', '<f8', (depth,)),
+        ('ask_price', '<f8', (depth,)),
+        ('ask_qty', '<f8', (depth,)),
+    ])
+
+
+class TickStore:
+    """
+    Append-only, memory-mapped store of orderbook snapshots for one (exchange, symbol)
+
+    File layout: a 64 byte header (magic, version, depth, count) followed by
+    fixed-width records (see book_dtype). The file grows in chunks of `capacity`
+    records, so appends are a single row write into the mapping.
+
+    A sparse timestamp index (one entry every `index_stride` records) narrows
+    lookups down to one stride before the final searchsorted, so queries touch
+    only a few pages of the file. Query results are NumPy views on the mapping.
+    """
+
+    def __init__(self,
+                 path: str,
+                 depth: int = 5,
+                 capacity: int = 1 << 16,
+                 index_stride: int = 1024):
+        self.path = path
+        self.depth = depth
+        self.capacity = capacity
+        self.index_stride = index_stride
+        self.dtype = book_dtype(depth)
+        self.dropped = 0
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+        if os.path.exists(path) and os.path.getsize(path) >= HEADER_SIZE:
+            header = np.fromfile(path, dtype='<i8', count=4)
+            if header[0] != MAGIC or header[1] != VERSION:
+                raise ValueError(f'{path} is not a tick store file')
+            if header[2] != depth:
+                raise ValueError(f'{path} was written with depth={header[2]}, not {depth}')
+        else:
+            with open(path, 'wb') as f:
+                np.array([MAGIC, VERSION, depth, 0], dtype='<i8').tofile(f)
+                f.truncate(HEADER_SIZE + capacity * self.dtype.itemsize)
+
+        self._map()
+        self.count = int(self._header[3])
+        self._sparse = np.array(self._records['timestamp'][:self.count:index_stride])
+        self._last_ts = int(self._records['timestamp'][self.count - 1]) if self.count else None
+
+    def _map(self):
+        n_records = (os.path.getsize(self.path) - HEADER_SIZE) // self.dtype.itemsize
+        self._header = np.memmap(self.path, dtype='<i8', mode='r+', shape=(4,))
+        self._records = np.memmap(self.path,
+                                  dtype=self.dtype,
+                                  mode='r+',
+                                  offset=HEADER_SIZE,
+                                  shape=(n_records,))
+        # every field is 8 bytes wide, so the price/qty columns can be written
+        # in one go through a flat float64 view of the same pages
+        self._timestamps = self._records['timestamp']
+        self._values = self._records.view('<f8').reshape(n_records, -1)[:, 1:]
+
+    def _grow(self):
+        self.flush()
+        new_size = HEADER_SIZE + (len(self._records) + self.capacity) * self.dtype.itemsize
+        # views already handed out keep their own reference to the old mapping
+        del self._records, self._header, self._timestamps, self._values
+        with open(self.path, 'r+b') as f:
+            f.truncate(new_size)
+        self._map()
+
+    def append(self,
+               timestamp: int,
+               bids: List[List[Any]],
+               asks: List[List[Any]]) -> bool:
+        """
+        Appends one snapshot, returns False (and counts it in self.dropped)
+        if the timestamp goes backwards, so the time index stays sorted
+        """
+        if self._last_ts is not None and timestamp < self._last_ts:
+            self.dropped += 1
+            return False
+
+        if self.count == len(self._records):
+            self._grow()
+
+        depth = self.depth
+        nan = float('nan')
+        values = []
+        for levels in (bids, asks):
+            top = levels[:depth]
+            pad = [nan] * (depth - len(top))
+            values += [float(l[0]) for l in top] + pad
+            values += [float(l[1]) for l in top] + pad
+
+        self._values[self.count] = values
+        self._timestamps[self.count] = timestamp
+
+        if self.count % self.index_stride == 0:
+            self._sparse = np.append(self._sparse, timestamp)
+
+        self.count += 1
+        self._header[3] = self.count
+        self._last_ts = timestamp
+        return True
+
+    def _search(self, timestamp: int, side: str) -> int:
+        """
+        Like np.searchsorted over all timestamps, but only one stride of
+        the mapped file is read after the sparse index lookup
+        """
+        block = int(np.searchsorted(self._sparse, timestamp, side=side))
+        lo = max(block - 1, 0) * self.index_stride
+        hi = min(block * self.index_stride + 1, self.count) if block < len(self._sparse) else self.count
+        return lo + int(np.searchsorted(self._timestamps[lo:hi], timestamp, side=side))
+
+    def records(self) -> np.ndarray:
+        return self._records[:self.count]
+
+    def range(self, start: int, end: int) -> np.ndarray:
+        """
+        Returns the snapshots with start <= timestamp < end as a view
+        """
+        lo = self._search(start, 'left')
+        hi = self._search(end, 'left')
+        return self._records[lo:hi]
+
+    def asof(self, timestamp: int) -> Optional[np.ndarray]:
+        """
+        Returns the latest snapshot with timestamp <= `timestamp` as a
+        0-d view, or None if the store has nothing that old
+        """
+        i = self._search(timestamp, 'right')
+        if i == 0:
+            return None
+        return self._records[i - 1:i].reshape(())
+
+    def flush(self):
+        self._records.flush()
+        self._header.flush()
+
+    def __len__(self):
+        return self.count
+
+
+class TickRecorder:
+    """
+    Keeps one TickStore per (exchange, symbol) under `root`:
+
+    root/
+        binance/ETHUSDT.ticks
+        okx/ETHUSDT.ticks
+
+    Feed it the 'cex' orderbook events published by cex_streams
+    """
+
+    def __init__(self, root: str, depth: int = 5, flush_every: int = 1000):
+        self.root = root
+        self.depth = depth
+        self.flush_every = flush_every
+        self.stores: Dict[Tuple[str, str], TickStore] = {}
+        self._since_flush = 0
+
+    def store(self, exchange: str, symbol: str) -> TickStore:
+        key = (exchange, symbol)
+        if key not in self.stores:
+            path = os.path.join(self.root, exchange, f'{symbol}.ticks')
+            self.stores[key] = TickStore(path, depth=self.depth)
+        return self.stores[key]
+
+    def record(self, orderbook: Dict[str, Any]) -> bool:
+        store = self.store(orderbook['exchange'], orderbook['symbol'])
+        ok = store.append(orderbook['timestamp'], orderbook['bids'], orderbook['asks'])
+
+        self._since_flush += 1
+        if self._since_flush >= self.flush_every:
+            self.flush()
+        return ok
+
+    def flush(self):
+        for store in self.stores.values():
+            store.flush()
+        self._since_flush = 0
+
+    def close(self):
+        self.flush()
+        self.stores.clear()
+
+
+if __name__ == '__main__':
+    import time
+    import tempfile
+    from decimal import Decimal
+
+    with tempfile.TemporaryDirectory() as root:
+        recorder = TickRecorder(root)
+
+        n = 200_000
+        t0 = 1_700_000_000_000
+        s = time.perf_counter()
+        for i in range(n):
+            mid = Decimal(2000) + Decimal(i % 100) / 10
+            recorder.record({
+                'source': 'cex',
+                'type': 'orderbook',
+                'exchange': 'binance',
+                'symbol': 'ETHUSDT',
+                'timestamp': t0 + i * 100,
+                'bids': [[mid - Decimal(k) / 100, Decimal('1.5')] for k in range(1, 6)],
+                'asks': [[mid + Decimal(k) / 100, Decimal('2.5')] for k in range(1, 6)],
+            })
+        took = time.perf_counter() - s
+        print(f'Ingested (incl. building Decimal events) {n} snapshots: {took / n * 1e6:.2f} us/snapshot')
+
+        store = recorder.store('binance', 'ETHUSDT')
+        window = store.range(t0 + 1_000_000, t0 + 2_000_000)
+        print(f'Range: {len(window)} rows, shares memory: {np.shares_memory(window, store.records())}')
+        print(f'As-of: {store.asof(t0 + 1_000_050)}')
@@ -1,37 +1,303 @@
+import time
 import random
+import inspect
 import asyncio
 import websockets
 
-from typing import Any, Callable, Dict
+from functools import partial
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
 
-async def reconnecting_websocket_loop(stream_fn: Callable, tag: str):
+def backoff_delay(attempt: int, base: float = 0.5, cap: float = 30.0) -> float:
+    """
+    Exponential backoff with full jitter: uniform(0, min(cap, base * 2 ** attempt))
+    Jitter keeps parallel connections from reconnecting in lockstep
+    """
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+async def reconnecting_websocket_loop(stream_fn: Callable,
+                                      tag: str,
+                                      base_backoff: float = 0.5,
+                                      max_backoff: float = 30.0,
+                                      reset_after: float = 60.0,
+                                      on_reconnect: Optional[Callable[[], None]] = None):
     """Run a streaming coroutine with resilient reconnection.
 
-    Any exception triggers a short backoff and a retry, so transient
-    decode/timeout errors do not permanently stop the stream.
+    Any exception triggers a jittered exponential backoff and a retry, so
+    transient decode/timeout errors do not permanently stop the stream.
+    The backoff resets once a connection has stayed up for `reset_after` seconds.
     """
-    backoff = 2
+    attempt = 0
     while True:
+        started = time.monotonic()
         try:
             await stream_fn()
-            # If the stream_fn returns normally, restart after short delay
-            await asyncio.sleep(backoff)
 
         except (websockets.ConnectionClosedError, websockets.ConnectionClosedOK) as e:
             print(f'{tag} websocket connection closed: {e}')
-            print('Reconnecting...')
-            await asyncio.sleep(backoff)
 
         except asyncio.TimeoutError as e:
             print(f'{tag} websocket timeout: {e}')
-            print('Reconnecting...')
-            await asyncio.sleep(backoff)
+
+        except asyncio.CancelledError:
+            raise
 
         except Exception as e:
             print(f'An error has occurred with {tag} websocket: {e}')
-            print('Reconnecting...')
-            await asyncio.sleep(backoff)
+
+        # If the stream_fn returns normally, restart the same way
+        if time.monotonic() - started > reset_after:
+            attempt = 0
+        delay = backoff_delay(attempt, base_backoff, max_backoff)
+        attempt += 1
+
+        print(f'Reconnecting in {delay:.2f}s...')
+        if on_reconnect is not None:
+            on_reconnect()
+        await asyncio.sleep(delay)
+
+
+def event_key(event: Dict[str, Any]) -> Tuple:
+    """
+    Identity of a published event across redundant connections:
+    the exchange update id when there is one, else the exchange timestamp
+    """
+    # typed events always have an update_id slot, None when the exchange sends none
+    update_id = event.get('update_id')
+    return (
+        event.get('exchange'),
+        event.get('symbol'),
+        update_id if update_id is not None else event.get('timestamp'),
+    )
+
+
+class BookChangeFilter:
+    """
+    Suppresses orderbook snapshots identical to the last one published for
+    the same symbol, before they are parsed and queued
+
+    The fingerprint is whatever cheap, comparable form the stream already has
+    (e.g. the raw [price, qty] string lists). With `heartbeat` set, an unchanged
+    book is still forwarded when nothing was published for that many seconds,
+    so staleness checks downstream keep working; heartbeat=0 forwards everything.
+
+    Suppressed updates still advance the update-id chain: a forwarded event's
+    prev_update_id is rewritten to the last forwarded update_id when no update
+    was actually missed in between, and left as is when one was, so gap
+    detection keeps seeing real gaps only.
+    """
+
+    def __init__(self, heartbeat: Optional[float] = 1.0):
+        self.heartbeat = heartbeat
+        self.forwarded = 0
+        self.suppressed = 0
+        self.heartbeats = 0
+        # symbol -> [fingerprint, last seen id, last forwarded id, last forward time, chain broken]
+        self._last: Dict[Any, List[Any]] = {}
+
+    def check(self, symbol: Any, fingerprint: Any,
+              update_id: Any = None, prev_update_id: Any = None) -> Tuple[bool, Any]:
+        """
+        :return: (forward, prev_update_id to publish)
+        """
+        now = time.monotonic()
+        last = self._last.get(symbol)
+        if last is None:
+            self._last[symbol] = [fingerprint, update_id, update_id, now, False]
+            self.forwarded += 1
+            return True, prev_update_id
+
+        if update_id is not None and update_id == last[1]:
+            # the same update again, e.g. from another connection of the same feed
+            self.suppressed += 1
+            return False, prev_update_id
+        if prev_update_id is not None and last[1] is not None and prev_update_id != last[1]:
+            last[4] = True
+        last[1] = update_id
+
+        if fingerprint == last[0]:
+            if self.heartbeat is None or now - last[3] < self.heartbeat:
+                self.suppressed += 1
+                return False, prev_update_id
+            self.heartbeats += 1
+
+        if prev_update_id is not None and not last[4]:
+            prev_update_id = last[2]
+        last[0], last[2], last[3], last[4] = fingerprint, update_id, now, False
+        self.forwarded += 1
+        return True, prev_update_id
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.forwarded + self.suppressed
+        return {
+            'forwarded': self.forwarded,
+            'suppressed': self.suppressed,
+            'heartbeats': self.heartbeats,
+            'suppressed_ratio': self.suppressed / total if total else 0.0,
+        }
+
+
+class _ConnectionQueue:
+    """
+    Stands in for the event_queue of one redundant connection, so the
+    existing stream_* functions can be used as they are
+    """
+
+    def __init__(self, feed: 'RedundantFeed', index: int):
+        self.feed = feed
+        self.index = index
+
+    def put(self, event: Dict[str, Any]):
+        self.feed.offer(self.index, event)
+
+
+class RedundantFeed:
+    """
+    Runs M parallel connections of one feed (the same or alternate endpoints)
+    and forwards each event once, from whichever connection delivers it first
+
+    feed = RedundantFeed('binance', event_queue)
+    await feed.run([
+        partial(stream_binance_usdm_orderbook, symbols, ws_urls=[url])
+        for url in ['wss://fstream.binance.com/ws/'] * 3
+    ])
+
+    Each stream function is called with event_queue=<proxy> and wrapped in
+    reconnecting_websocket_loop, so one connection dropping never opens a gap
+    as long as another one is up. stats() reports per-connection win rates,
+    lead over / lag behind the other connections and exchange-to-arrival latency.
+
+    With max_avg_lag_ms set, a connection that has delivered at least
+    `min_events` copies and trails the winner by more than that on average is
+    cancelled (the last remaining connection is never dropped).
+
+    Stream functions that take a `change_filter` get a BookChangeFilter of
+    their own per connection: a filter shared across connections would let a
+    lagging connection's stale book reset the fingerprint and suppress the
+    next real change, and would hide the duplicates the lag stats are built on.
+    """
+
+    def __init__(self,
+                 tag: str,
+                 event_queue,
+                 key_fn: Callable[[Dict[str, Any]], Tuple] = event_key,
+                 window: int = 4096,
+                 max_avg_lag_ms: Optional[float] = None,
+                 min_events: int = 500,
+                 heartbeat: Optional[float] = 1.0):
+        """
+        :param heartbeat: heartbeat of the per-connection change filters
+        """
+        self.tag = tag
+        self.event_queue = event_queue
+        self.key_fn = key_fn
+        self.window = window
+        self.max_avg_lag_ms = max_avg_lag_ms
+        self.min_events = min_events
+        self._seen: 'OrderedDict[Tuple, Tuple[float, int]]' = OrderedDict()
+        self.heartbeat = heartbeat
+        self.connections: List[Dict[str, Any]] = []
+        self.change_filters: List[Optional[BookChangeFilter]] = []
+        self._tasks: List[asyncio.Future] = []
+
+    def _new_stats(self, name: str) -> Dict[str, Any]:
+        return {
+            'name': name,
+            'received': 0,
+            'wins': 0,
+            'duplicates': 0,
+            'lead_sum': 0.0,
+            'lead_count': 0,
+            'lag_sum': 0.0,
+            'latency_sum': 0.0,
+            'latency_count': 0,
+            'reconnects': 0,
+            'dropped': False,
+        }
+
+    def offer(self, index: int, event: Dict[str, Any]):
+        now = time.perf_counter()
+        stats = self.connections[index]
+        stats['received'] += 1
+
+        timestamp = event.get('timestamp')
+        if timestamp is not None:
+            stats['latency_sum'] += time.time() * 1000 - timestamp
+            stats['latency_count'] += 1
+
+        key = self.key_fn(event)
+        seen = self._seen.get(key)
+        if seen is not None:
+            first_seen, winner = seen
+            stats['duplicates'] += 1
+            stats['lag_sum'] += now - first_seen
+            if winner != index:
+                self.connections[winner]['lead_sum'] += now - first_seen
+                self.connections[winner]['lead_count'] += 1
+            if self.max_avg_lag_ms is not None and stats['duplicates'] >= self.min_events:
+                self._maybe_drop(index)
+            return
+
+        self._seen[key] = (now, index)
+        if len(self._seen) > self.window:
+            self._seen.popitem(last=False)
+
+        stats['wins'] += 1
+        self.event_queue.put(event)
+
+    def _maybe_drop(self, index: int):
+        stats = self.connections[index]
+        avg_lag_ms = stats['lag_sum'] / stats['duplicates'] * 1000
+        alive = [s for s in self.connections if not s['dropped']]
+        if avg_lag_ms > self.max_avg_lag_ms and len(alive) > 1 and not stats['dropped']:
+            stats['dropped'] = True
+            self._tasks[index].cancel()
+            print(f'{self.tag}: dropping {stats["name"]} (avg lag {avg_lag_ms:.1f}ms)')
+
+    async def run(self, stream_fns: List[Callable], names: Optional[List[str]] = None):
+        """
+        :param names: labels for stats(), e.g. the endpoint URLs
+        """
+        names = names or [str(i) for i in range(len(stream_fns))]
+        for index, stream_fn in enumerate(stream_fns):
+            self.connections.append(self._new_stats(names[index]))
+            proxy = _ConnectionQueue(self, index)
+            kwargs: Dict[str, Any] = {'event_queue': proxy}
+            change_filter = None
+            if 'change_filter' in inspect.signature(stream_fn).parameters \
+                    and not (isinstance(stream_fn, partial) and 'change_filter' in stream_fn.keywords):
+                change_filter = kwargs['change_filter'] = BookChangeFilter(heartbeat=self.heartbeat)
+            self.change_filters.append(change_filter)
+
+            def _on_reconnect(stats=self.connections[index]):
+                stats['reconnects'] += 1
+
+            self._tasks.append(asyncio.ensure_future(reconnecting_websocket_loop(
+                partial(stream_fn, **kwargs),
+                tag=f'{self.tag}[{names[index]}]',
+                on_reconnect=_on_reconnect,
+            )))
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def stats(self) -> List[Dict[str, Any]]:
+        total_wins = sum(s['wins'] for s in self.connections) or 1
+        report = []
+        for index, s in enumerate(self.connections):
+            report.append({
+                'connection': index,
+                'name': s['name'],
+                'received': s['received'],
+                'win_rate': s['wins'] / total_wins,
+                'avg_lead_ms': s['lead_sum'] / s['lead_count'] * 1000 if s['lead_count'] else 0.0,
+                'avg_lag_ms': s['lag_sum'] / s['duplicates'] * 1000 if s['duplicates'] else 0.0,
+                'avg_latency_ms': s['latency_sum'] / s['latency_count'] if s['latency_count'] else None,
+                'reconnects': s['reconnects'],
+                'dropped': s['dropped'],
+                'suppressed': self.change_filters[index].suppressed if self.change_filters[index] else None,
+            })
+        return report
 
 
 def calculate_next_block_base_fee(block: Dict[str, Any]):